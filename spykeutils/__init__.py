@@ -7,6 +7,22 @@
     :undoc-members:
     :show-inheritance:
 
+:mod:`conversions` Module
+-------------------------
+
+.. automodule:: spykeutils.conversions
+    :members:
+    :undoc-members:
+    :show-inheritance:
+
+:mod:`plot_data` Module
+-----------------------
+
+.. automodule:: spykeutils.plot_data
+    :members:
+    :undoc-members:
+    :show-inheritance:
+
 :mod:`progress_indicator` Module
 --------------------------------
 
@@ -23,6 +39,22 @@
     :undoc-members:
     :show-inheritance:
 
+:mod:`result_cache` Module
+--------------------------
+
+.. automodule:: spykeutils.result_cache
+    :members:
+    :undoc-members:
+    :show-inheritance:
+
+:mod:`sampling` Module
+----------------------
+
+.. automodule:: spykeutils.sampling
+    :members:
+    :undoc-members:
+    :show-inheritance:
+
 :mod:`sorting_quality_assesment` Module
 ---------------------------------------
 
@@ -31,6 +63,14 @@
     :undoc-members:
     :show-inheritance:
 
+:mod:`spike_train_set` Module
+-----------------------------
+
+.. automodule:: spykeutils.spike_train_set
+    :members:
+    :undoc-members:
+    :show-inheritance:
+
 :mod:`spyke_exception` Module
 -----------------------------
 
@@ -38,4 +78,6 @@
     :members:
     :undoc-members:
     :show-inheritance:
-"""
\ No newline at end of file
+"""
+
+__version__ = '0.1.0'
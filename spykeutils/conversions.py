@@ -0,0 +1,81 @@
+""" Functions for converting quantities to plain float arrays.
+
+The analysis functions in spykeutils convert their quantity parameters
+and spike trains with these functions once when they are called, work on
+plain ``float64`` arrays in a common unit internally and attach units
+only to their results. This avoids the overhead of unit handling in
+inner loops.
+"""
+
+import scipy as sp
+
+_factors = {}
+
+
+def conversion_factor(quantity, units):
+    """ Return the factor that converts values from the units of a
+    quantity to other units. Factors are cached, so this is cheap to call
+    for many objects with the same units.
+
+    :param Quantity quantity: A quantity (or unit) with the source units.
+    :param Quantity units: The target units.
+    :rtype: float
+    """
+    key = (quantity.dimensionality.string, units.dimensionality.string)
+    try:
+        return _factors[key]
+    except KeyError:
+        factor = float(quantity.units.rescale(units))
+        _factors[key] = factor
+        return factor
+
+
+def magnitude(quantity, units):
+    """ Return the magnitude of a quantity in the given units as float
+    array. The returned array can be a view of the quantity, so it should
+    not be modified in place.
+
+    :param Quantity quantity: The quantity to convert.
+    :param Quantity units: The units of the returned values.
+    :rtype: ndarray
+    """
+    factor = conversion_factor(quantity, units)
+    values = sp.asarray(quantity, dtype=sp.float64)
+    if factor != 1.0:
+        return values * factor
+    return values
+
+
+def scalar(quantity, units):
+    """ Return the magnitude of a scalar quantity in the given units.
+
+    :param Quantity quantity: The scalar quantity to convert.
+    :param Quantity units: The units of the returned value.
+    :rtype: float
+    """
+    return float(quantity) * conversion_factor(quantity, units)
+
+
+def spike_times(trains, units):
+    """ Return the spike times of a sequence of spike trains as float
+    arrays.
+
+    :param sequence trains: A sequence of SpikeTrain objects.
+    :param Quantity units: The units of the returned spike times.
+    :returns: A list of one-dimensional arrays, one per spike train.
+    :rtype: list
+    """
+    return [magnitude(t, units) for t in trains]
+
+
+def train_intervals(trains, units):
+    """ Return start and stop times of a sequence of spike trains.
+
+    :param sequence trains: A sequence of SpikeTrain objects.
+    :param Quantity units: The units of the returned times.
+    :returns: Two arrays with the start and stop time for each train.
+    :rtype: ndarray, ndarray
+    """
+    starts = sp.array([scalar(t.t_start, units) for t in trains])
+    stops = sp.array([scalar(t.t_stop, units) for t in trains])
+    return starts, stops
@@ -3,16 +3,21 @@ from collections import OrderedDict
 
 import quantities as pq
 
-from progress_indicator import ProgressIndicator
+from progress_indicator import ProgressIndicator, CancelException
 from spyke_exception import SpykeException
+from result_cache import cached
+import conversions
+from spike_train_set import as_spike_train_set
 
+@cached()
 def correlogram(trains, bin_size, cut_off, border_correction,
-                unit=pq.ms, progress=ProgressIndicator()):
+                unit=pq.ms, progress=ProgressIndicator(), checkpoint=None):
     """ Return (cross-)correlograms from a dictionary of SpikeTrain
         lists for different units.
 
-    :param dict trains: Dictionary of SpikeTrain lists indexed by neo `Unit`
+    :param trains: Dictionary of SpikeTrain lists indexed by neo `Unit`
         objects.
+    :type trains: dict or :class:`spykeutils.spike_train_set.SpikeTrainSet`
     :param bin_size: Bin size (time).
     :type bin_size: Quantity scalar
     :param cut_off: Cut off (end time of calculated correlogram).
@@ -24,6 +29,11 @@ def correlogram(trains, bin_size, cut_off, border_correction,
         used.
     :param progress: A ProgressIndicator object for the operation.
     :type progress: :class:`spykeutils.progress_indicator.ProgressIndicator`
+    :param checkpoint: If given, completed correlograms are stored in
+        this checkpoint after each pair of units. If the operation is
+        cancelled, they are kept and a later call with the same
+        checkpoint only computes the remaining pairs.
+    :type checkpoint: :class:`spykeutils.result_cache.Checkpoint`
     :returns: Two values:
 
         * An ordered dictionary indexed with the indices of `trains` of
@@ -34,73 +44,113 @@ def correlogram(trains, bin_size, cut_off, border_correction,
         * The bins used for the correlogram calculation.
     :rtype: dict, Quantity 1D
     """
-    bin_size.rescale(unit)
-    cut_off.rescale(unit)
+    if checkpoint is not None:
+        checkpoint.start(correlogram, {'trains': trains,
+            'bin_size': bin_size, 'cut_off': cut_off,
+            'border_correction': border_correction, 'unit': unit})
+
+    bin_size = conversions.scalar(bin_size, unit)
+    cut_off = conversions.scalar(cut_off, unit)
 
     # Create bins, making sure that 0 is at the center of central bin
     half_bins = sp.arange(bin_size / 2, cut_off, bin_size)
-    all_bins = list(reversed(-half_bins))
-    all_bins.extend(half_bins)
-    bins = sp.array(all_bins) * unit
-    middle_bin = len(bins) / 2 - 1
+    bins = sp.concatenate((-half_bins[::-1], half_bins))
+    middle_bin = len(bins) // 2 - 1
+
+    # Sorted spike times in the unit of the x-axis
+    train_set = as_spike_train_set(trains, unit).sorted()
+    rows = {}
+    for i, u in enumerate(train_set.units):
+        rows[u] = train_set.unit_trains(i)
 
-    indices = sorted(trains.keys(), key=lambda (u):u.name if u else None)
-    num_trains = len(trains[indices[0]])
+    indices = sorted(rows.keys(), key=lambda (u):u.name if u else None)
+    num_trains = len(rows[indices[0]])
     if not num_trains:
         raise SpykeException('Could not create correlogram: No spike trains!')
     for u in range(1, len(indices)):
-        if len(trains[indices[u]]) != num_trains:
+        if len(rows[indices[u]]) != num_trains:
             raise SpykeException('Could not create correlogram: All units ' +
                                  'need the same number of spike trains!')
 
-    progress.set_ticks(sp.sum(range(len(trains) + 1) * num_trains))
+    progress.set_ticks(sp.sum(range(len(indices) + 1) * num_trains))
 
     corrector = 1
     if border_correction:
-        # Need safe min/max functions
-        def safe_max(seq):
-            if len(seq) < 1:
-                return 0
-            return max(seq)
-        def safe_min(seq):
-            if len(seq) < 1:
-                return 1073741824 #Some arbitrary large value (2**20)
-            return min(seq)
-
-        max_w = max([max([safe_max(t) for t in l])
-                     for l in trains.itervalues()])
-        min_w = min([min([safe_min(t) for t in l])
-                     for l in trains.itervalues()])
+        if len(train_set.times):
+            max_w = train_set.times.max()
+            min_w = train_set.times.min()
+        else:
+            max_w = 0
+            min_w = 1073741824 #Some arbitrary large value (2**30)
 
         train_length = (max_w - min_w)
-        l = int(round(middle_bin)) + 1
-        cE = max(train_length-(l*bin_size)+1*unit, 1*unit)
+        l = middle_bin + 1
+        cE = max(train_length-(l*bin_size)+1, 1)
 
         corrector = train_length / sp.concatenate(
             (sp.linspace(cE, train_length, l-1, False),
              sp.linspace(train_length, cE, l)))
 
     correlograms = OrderedDict()
-    for i1 in xrange(len(indices)): # For each index
-        # For all later indices, including itself
-        for i2 in xrange(i1, len(indices)):
-            histogram = sp.zeros(len(bins) - 1)
-            for t in xrange(num_trains):
-                train2 = trains[indices[i2]][t].rescale(unit)
-                for s in trains[indices[i1]][t]:
-                    histogram += sp.histogram(train2,
-                        bins + s.rescale(unit))[0]
-                if i1 == i2: # Correction for autocorrelogram
-                    histogram[middle_bin] -= len(train2)
-
-                progress.step()
-            crg = corrector*histogram/num_trains
-            if indices[i1] not in correlograms:
-                correlograms[indices[i1]] = OrderedDict()
-            correlograms[indices[i1]][indices[i2]] = crg
-            if i1 != i2:
-                if indices[i2] not in correlograms:
-                    correlograms[indices[i2]] = OrderedDict()
-                correlograms[indices[i2]][indices[i1]] = crg
-
-    return correlograms, bins
\ No newline at end of file
+    try:
+        for i1 in xrange(len(indices)): # For each index
+            # For all later indices, including itself
+            for i2 in xrange(i1, len(indices)):
+                part = None
+                if checkpoint is not None:
+                    part = (checkpoint.token(indices[i1]),
+                            checkpoint.token(indices[i2]))
+                if part is not None and part in checkpoint:
+                    crg = checkpoint.get(part)
+                else:
+                    histogram = sp.zeros(len(bins) - 1)
+                    for t in xrange(num_trains):
+                        train2 = train_set.train(rows[indices[i2]][t])
+                        histogram += _difference_histogram(
+                            train_set.train(rows[indices[i1]][t]), train2,
+                            bins)
+                        if i1 == i2: # Correction for autocorrelogram
+                            histogram[middle_bin] -= len(train2)
+                    crg = corrector*histogram/num_trains
+                    if part is not None:
+                        checkpoint.add(part, crg)
+
+                if indices[i1] not in correlograms:
+                    correlograms[indices[i1]] = OrderedDict()
+                correlograms[indices[i1]][indices[i2]] = crg
+                if i1 != i2:
+                    if indices[i2] not in correlograms:
+                        correlograms[indices[i2]] = OrderedDict()
+                    correlograms[indices[i2]][indices[i1]] = crg
+                progress.step(num_trains)
+    except CancelException:
+        if checkpoint is not None:
+            checkpoint.save()
+        raise
+
+    if checkpoint is not None:
+        checkpoint.clear()
+    return correlograms, bins * unit
+
+
+def _difference_histogram(train1, train2, bins):
+    """ Return a histogram of all time differences between spikes in
+    ``train2`` and spikes in ``train1``.
+
+    :param ndarray train1: Spike times.
+    :param ndarray train2: Sorted spike times.
+    :param ndarray bins: The bin edges for the time differences.
+    :rtype: ndarray
+    """
+    # Range of train2 spikes within the bins for each spike in train1
+    lower = sp.searchsorted(train2, train1 + bins[0], 'left')
+    upper = sp.searchsorted(train2, train1 + bins[-1], 'right')
+    counts = upper - lower
+    total = counts.sum()
+    if not total:
+        return sp.zeros(len(bins) - 1)
+
+    offsets = sp.repeat(lower - (sp.cumsum(counts) - counts), counts)
+    differences = train2[sp.arange(total) + offsets] - \
+                  sp.repeat(train1, counts)
+    return sp.histogram(differences, bins)[0]
@@ -1,23 +1,32 @@
 from __future__ import division
 
 import scipy as sp
-import neo
 import quantities as pq
 
 from guiqwt.builder import make
 from guiqwt.baseplot import BasePlot
 from guiqwt.plot import BaseCurveWidget
+from PyQt4.QtCore import Qt
+from PyQt4.QtGui import QScrollBar
 
 from ..spyke_exception import SpykeException
+from .. import sampling
+from ..plot_data import MinMaxPyramid, stack_waveforms, nan_separated
 from dialogs import PlotDialog
 import helper
 
 @helper.needs_qt
 def signal(signal, events=None, epochs=None, spike_trains=None,
-                spike_waveforms=None):
+                spike_waveforms=None, sampling_rate=None, units=None,
+                max_spike_waveforms=None):
     """ Create a plot from an AnalogSignal.
 
-    :param AnalogSignal signal: The signal to plot.
+    :param signal: The signal to plot. Instead of an AnalogSignal, a
+        one-dimensional array can be given (e.g. a memory-mapped array
+        created by ``numpy.load(filename, mmap_mode='r')`` or
+        ``numpy.memmap``). Only the parts of the signal that are needed
+        for the visible range of the plot are then read into memory.
+    :type signal: AnalogSignal or ndarray
     :param sequence events: A list of Event objects to be included in the
         plot.
     :param sequence epochs: A list of Epoch objects to be included in the
@@ -30,29 +39,46 @@ def signal(signal, events=None, epochs=None, spike_trains=None,
         to be included in the plot. Waveforms of spikes are overlaid on
         the signal. Indices of the dictionary (typically Unit objects) are
         used for color and legend entries.
+    :param Quantity sampling_rate: The sampling rate of ``signal``. Only
+        used (and required) if ``signal`` is not an AnalogSignal.
+    :param Quantity units: The units of ``signal``. Only used if
+        ``signal`` is not an AnalogSignal. Default: dimensionless
+    :param int max_spike_waveforms: If a unit has more spikes in
+        ``spike_waveforms``, only a random subsample of this many
+        waveforms is drawn, together with the mean and the 5th and 95th
+        percentiles of all waveforms of the unit. Default: All waveforms
+        are drawn.
     """
     # Plot title
     win_title = 'Analog Signal'
-    if signal.recordingchannel:
+    if getattr(signal, 'recordingchannel', None):
         win_title += ' | Recording Channel: %s' % \
                      signal.recordingchannel.name
-    if signal.segment:
+    if getattr(signal, 'segment', None):
         win_title += ' | Segment: %s' % signal.segment.name
     win = PlotDialog(toolbar=True, wintitle=win_title)
 
-    signalarray = neo.AnalogSignalArray(sp.atleast_2d(sp.asarray(signal)).T,
-        units=signal.units, sampling_rate=signal.sampling_rate)
+    samples, sampling_rate, units = _signal_data(
+        signal, sampling_rate, units)
 
-    _plot_signal_array_on_window(win, signalarray, events, epochs,
-        spike_trains, spike_waveforms, False)
+    _plot_signal_array_on_window(win, samples[:, None], sampling_rate,
+        units, events, epochs, spike_trains, spike_waveforms, False,
+        max_spike_waveforms=max_spike_waveforms)
 
 @helper.needs_qt
 def signal_array(signalarray, events=None, epochs=None,
                       spike_trains=None, spike_waveforms=None,
-                      plot_separate=True):
+                      plot_separate=True, sampling_rate=None, units=None,
+                      visible_channels=16, max_spike_waveforms=None):
     """ Create a plot dialog from an AnalogSignalArray.
 
-    :param AnalogSignalArray signalarray: The signal array to plot.
+    :param signalarray: The signal array to plot. Instead of an
+        AnalogSignalArray, a two-dimensional array (samples x channels)
+        can be given (e.g. a memory-mapped array created by
+        ``numpy.load(filename, mmap_mode='r')`` or ``numpy.memmap``).
+        Only the parts of the signals that are needed for the visible
+        range of the plot are then read into memory.
+    :type signalarray: AnalogSignalArray or ndarray
     :param sequence events: A list of Event objects to be included in the
         plot.
     :param sequence epochs: A list of Epoch objects to be included in the
@@ -67,44 +93,290 @@ def signal_array(signalarray, events=None, epochs=None,
         used for color and legend entries.
     :param bool plot_separate: Determines if a separate plot for is created
         each channel in ``signalarray``.
+    :param Quantity sampling_rate: The sampling rate of ``signalarray``.
+        Only used (and required) if ``signalarray`` is not an
+        AnalogSignalArray.
+    :param Quantity units: The units of ``signalarray``. Only used if
+        ``signalarray`` is not an AnalogSignalArray. Default: dimensionless
+    :param int visible_channels: The number of channels that are shown
+        initially. If ``plot_separate`` is ``True``, at most this many
+        plots are created and a scroll bar selects the visible channels.
+        Otherwise, the y axis initially covers this many channels and only
+        channels in the visible y range are drawn.
+    :param int max_spike_waveforms: If a unit has more spikes in
+        ``spike_waveforms``, only a random subsample of this many
+        waveforms is drawn, together with the mean and the 5th and 95th
+        percentiles of all waveforms of the unit. Default: All waveforms
+        are drawn.
     """
     # Plot title
     win_title = 'Analog Signals'
-    if signalarray.recordingchannelgroup:
+    if getattr(signalarray, 'recordingchannelgroup', None):
         win_title += ' | Recording Channel Group: %s' % \
                      signalarray.recordingchannelgroup.name
-    if signalarray.segment:
+    if getattr(signalarray, 'segment', None):
         win_title += ' | Segment: %s' % signalarray.segment.name
     win = PlotDialog(toolbar=True, wintitle=win_title)
 
-    _plot_signal_array_on_window(win, signalarray, events, epochs,
-        spike_trains, spike_waveforms, plot_separate)
+    samples, sampling_rate, units = _signal_data(
+        signalarray, sampling_rate, units)
+    if samples.ndim != 2:
+        raise SpykeException(
+            'Cannot create signal plot: Signal array has to be 2D!')
 
+    _plot_signal_array_on_window(win, samples, sampling_rate, units,
+        events, epochs, spike_trains, spike_waveforms, plot_separate,
+        visible_channels, max_spike_waveforms)
 
-def _add_spike_waveforms(plot, spikes, x_units, channel, offset):
-    for spike in spikes:
-        color = helper.get_object_color(spike.unit)
-        # TODO: Is this usage of Spike.left_sweep correct?
-        if spike.left_sweep:
-            lsweep = spike.left_sweep
-        else:
-            lsweep = 0.0 * pq.ms
-        start = (spike.time-lsweep).rescale(x_units)
-        stop = (spike.waveform.shape[0] / spike.sampling_rate +
-                spike.time - lsweep).rescale(x_units)
-        spike_x = sp.arange(start, stop,
-            (1.0 / spike.sampling_rate).rescale(x_units)) * x_units
-
-        plot.add_item(make.curve(spike_x,
-            spike.waveform[:, channel] + offset,
-            color=color, linewidth=2))
-
-def _plot_signal_array_on_window(win, signalarray, events=None, epochs=None,
-                                 spike_trains=None, spikes=None,
-                                 plot_separate=True):
-    if signalarray is None:
+
+def _signal_data(signal, sampling_rate, units):
+    """ Return samples (without copying), sampling rate and units of a
+    neo signal object or a plain (possibly memory-mapped) array.
+    """
+    if signal is None:
         raise SpykeException(
             'Cannot create signal plot: No signal data provided!')
+    if isinstance(signal, pq.Quantity) and \
+            hasattr(signal, 'sampling_rate'):
+        return signal.magnitude, signal.sampling_rate, signal.units
+    if sampling_rate is None:
+        raise SpykeException('Cannot create signal plot: '
+                             'No sampling rate for signal data provided!')
+    if units is None:
+        units = pq.dimensionless
+    return signal, sampling_rate, units
+
+
+class _CurveDecimation(object):
+    """ Updates the data of a curve from a channel of a
+    :class:`spykeutils.plot_data.MinMaxPyramid` when the visible x range
+    of the plot changes, so that only about two points per pixel of the
+    visible range are drawn. Outside of the visible range, a coarse
+    envelope is used, so the curve still covers the whole signal (e.g.
+    for autoscaling).
+    """
+
+    def __init__(self, plot, curve, pyramid, channel, sample_period,
+                 offset=0.0):
+        self.plot = plot
+        self.curve = curve
+        self.pyramid = pyramid
+        self.channel = channel
+        self.period = sample_period
+        self.offset = offset
+        self.visible = None
+        curve._decimation = self # Keep alive as long as the curve
+        plot.axisWidget(BasePlot.X_BOTTOM).scaleDivChanged.connect(
+            self.axis_changed)
+
+    def axis_changed(self):
+        vmin, vmax = self.plot.get_axis_limits(BasePlot.X_BOTTOM)
+        self.visible = (int(sp.floor(vmin / self.period)),
+                        int(sp.ceil(vmax / self.period)) + 1)
+        self.update()
+
+    def update(self):
+        if self.channel is None or not self.curve.isVisible():
+            return
+        num_points = 2 * max(self.plot.canvas().width(), 100)
+        n = self.pyramid.num_samples
+        start, stop = self.visible or (0, n)
+        parts = [self.pyramid.envelope(self.channel, 0, start, num_points),
+                 self.pyramid.envelope(self.channel, start, stop,
+                                       num_points),
+                 self.pyramid.envelope(self.channel, stop, n, num_points)]
+        x = sp.concatenate([p[0] for p in parts]) * self.period
+        y = sp.concatenate([p[1] for p in parts]) + self.offset
+        self.curve.set_data(x, y)
+
+
+def _add_signal_curve(plot, pyramid, channel, sample_period, offset=0.0,
+                      **kwargs):
+    """ Add a curve showing a signal to a plot. Only a decimated
+    version of the signal depending on the visible range is drawn.
+
+    :param plot: The plot.
+    :param pyramid: The :class:`spykeutils.plot_data.MinMaxPyramid` of
+        the signal.
+    :param int channel: The channel of the signal in ``pyramid``.
+    :param float sample_period: The time between samples (in the units
+        of the x axis).
+    :param float offset: Offset added to all sample values.
+    :returns: The curve item.
+    """
+    curve = make.curve([], [], **kwargs)
+    _CurveDecimation(plot, curve, pyramid, channel, sample_period,
+                     offset).update()
+    plot.add_item(curve)
+    return curve
+
+
+class _ChannelView(object):
+    """ Shows a window of consecutive channels in a fixed set of plots.
+    When the window is moved (e.g. with a scroll bar), the plots and
+    their signal curves are reused for the newly visible channels.
+    """
+
+    def __init__(self, plots, pyramid, sample_period, units, x_units,
+                 spikes, max_waveforms=None):
+        self.plots = plots
+        self.pyramid = pyramid
+        self.mins = pyramid.minimum()
+        self.maxs = pyramid.maximum()
+        self.units = units
+        self.x_units = x_units
+        self.spikes = spikes
+        self.max_waveforms = max_waveforms
+        self.channels = [None] * len(plots)
+        self.waveforms = [[] for _ in plots]
+        self.decimations = []
+        for plot in plots:
+            curve = make.curve([], [])
+            plot.add_item(curve)
+            self.decimations.append(
+                _CurveDecimation(plot, curve, pyramid, None, sample_period))
+
+    def show(self, first):
+        """ Show the channels starting with index ``first``. """
+        for i, plot in enumerate(self.plots):
+            c = first + i
+            if c == self.channels[i]:
+                continue
+
+            plot.del_items(self.waveforms[i])
+            self.decimations[i].channel = c
+            self.decimations[i].update()
+            self.waveforms[i] = _add_spike_waveforms(
+                plot, self.spikes, self.x_units, c, self.units,
+                max_waveforms=self.max_waveforms)
+
+            vmin, vmax = self.mins[c], self.maxs[c]
+            if vmin == vmax:
+                vmin, vmax = vmin - 1, vmax + 1
+            plot.set_axis_title(BasePlot.Y_LEFT, 'Channel %d' % c)
+            plot.set_axis_limits(BasePlot.Y_LEFT, vmin, vmax)
+            plot.replot()
+            self.channels[i] = c
+
+
+class _StackedChannelView(object):
+    """ Shows channels stacked on top of each other in one plot. Signal
+    curves and spike waveforms are only created for channels in the
+    visible y range of the plot. When channels leave the visible range,
+    their items are removed and their curves are reused for channels that
+    become visible.
+    """
+
+    def __init__(self, plot, pyramid, channels, offsets, sample_period,
+                 units, x_units, spikes, max_waveforms=None):
+        self.plot = plot
+        self.pyramid = pyramid
+        self.channels = channels
+        self.offsets = offsets
+        self.lower = pyramid.minimum()[channels] + offsets
+        self.upper = pyramid.maximum()[channels] + offsets
+        self.period = sample_period
+        self.units = units
+        self.x_units = x_units
+        self.spikes = spikes
+        self.max_waveforms = max_waveforms
+        self.shown = {} # Index in channels -> (decimation, waveform items)
+        self.unused = []
+        plot._stacked_view = self # Keep alive as long as the plot
+        plot.axisWidget(BasePlot.Y_LEFT).scaleDivChanged.connect(
+            self.axis_changed)
+
+    def axis_changed(self):
+        self.show_range(*self.plot.get_axis_limits(BasePlot.Y_LEFT))
+
+    def show_range(self, vmin, vmax):
+        """ Show the channels that overlap the y range from ``vmin`` to
+        ``vmax``.
+        """
+        visible = set(sp.flatnonzero((self.upper >= vmin) &
+                                     (self.lower <= vmax)))
+        for i in set(self.shown) - visible:
+            decimation, waveforms = self.shown.pop(i)
+            self.plot.del_items([decimation.curve] + waveforms)
+            decimation.channel = None
+            self.unused.append(decimation)
+
+        for i in sorted(visible - set(self.shown)):
+            if self.unused:
+                decimation = self.unused.pop()
+            else:
+                decimation = _CurveDecimation(self.plot, make.curve([], []),
+                    self.pyramid, None, self.period)
+            decimation.channel = self.channels[i]
+            decimation.offset = self.offsets[i]
+            decimation.update()
+            self.plot.add_item(decimation.curve)
+            waveforms = _add_spike_waveforms(self.plot, self.spikes,
+                self.x_units, self.channels[i], self.units, self.offsets[i],
+                self.max_waveforms)
+            self.shown[i] = (decimation, waveforms)
+
+
+def _add_spike_waveforms(plot, spikes, x_units, channel, units, offset=0.0,
+                         max_waveforms=None, percentiles=(5, 95)):
+    """ Add the waveforms of spikes to a plot. The waveforms of each unit
+    are drawn as one curve, with NaN values separating the spikes.
+
+    :param plot: The plot.
+    :param sequence spikes: The Spike objects.
+    :param Quantity x_units: The units of the x axis.
+    :param int channel: The waveform channel to draw.
+    :param Quantity units: The units of the y axis.
+    :param float offset: Offset added to all waveform values.
+    :param int max_waveforms: If a unit has more spikes, only a random
+        subsample of this many waveforms is drawn. The mean waveform and
+        the ``percentiles`` of all waveforms of the unit are then drawn
+        once, at the position of the drawn spike that is closest to the
+        mean waveform.
+    :returns: A list of the added plot items.
+    """
+    unit_spikes = {}
+    for spike in spikes:
+        unit_spikes.setdefault(spike.unit, []).append(spike)
+
+    # Fixed seed: the same spikes are drawn whenever a channel is shown
+    rng = sp.random.RandomState(0)
+    items = []
+    for unit, s in unit_spikes.iteritems():
+        color = helper.get_object_color(unit)
+        starts, steps, waveforms = stack_waveforms(s, x_units, channel,
+                                                   units)
+        waveforms += offset
+
+        summary = None
+        if max_waveforms is not None and len(s) > max_waveforms:
+            mean = sp.nanmean(waveforms, axis=0)
+            summary = [(mean, '--')] + \
+                [(p, ':') for p in sp.nanpercentile(waveforms, percentiles,
+                                                    axis=0)]
+            drawn = sampling.sample_indices(rng, len(s), max_waveforms)
+            starts, steps = starts[drawn], steps[drawn]
+            waveforms = waveforms[drawn]
+
+        x, y = nan_separated(starts, steps, waveforms)
+        items.append(make.curve(x, y, color=color, linewidth=2))
+        if summary:
+            r = sp.argmin(sp.nansum((waveforms - mean) ** 2, axis=1))
+            x = starts[r] + sp.arange(len(mean)) * steps[r]
+            for shape, style in summary:
+                items.append(make.curve(x, shape, color=color,
+                                        linestyle=style))
+
+    for item in items:
+        plot.add_item(item)
+    return items
+
+
+def _plot_signal_array_on_window(win, samples, sampling_rate, units,
+                                 events=None, epochs=None,
+                                 spike_trains=None, spikes=None,
+                                 plot_separate=True, visible_channels=16,
+                                 max_spike_waveforms=None):
     if events is None:
         events = []
     if epochs is None:
@@ -115,70 +387,84 @@ def _plot_signal_array_on_window(win, signalarray, events=None, epochs=None,
         spikes = {}
 
     # X-Axis
-    sample = (1 / signalarray.sampling_rate).simplified
-    x = sp.arange(signalarray.shape[0]) * sample
+    sample = (1 / sampling_rate).simplified
+    x_units = sample.units
+    period = float(sample)
 
-    offset = 0 * signalarray.units
-    channels = range(signalarray.shape[1])
+    num_channels = samples.shape[1]
+    pyramid = MinMaxPyramid(samples)
     if plot_separate:
-        plot = None
-        for c in channels:
+        plots = []
+        for i in xrange(min(num_channels, visible_channels)):
             pW = BaseCurveWidget(win)
             plot = pW.plot
 
-            helper.add_epochs(plot, epochs, x.units)
-            plot.add_item(make.curve(x, signalarray[:, c]))
-            helper.add_events(plot, events, x.units)
-
-            _add_spike_waveforms(plot, spikes, x.units, c, offset)
+            helper.add_epochs(plot, epochs, x_units)
+            helper.add_events(plot, events, x_units)
 
             for train in spike_trains:
                 color = helper.get_object_color(train.unit)
-                helper.add_spikes(plot, train, color, units=x.units)
-
-            win.add_plot_widget(pW, c)
-            plot.set_axis_unit(BasePlot.Y_LEFT,
-                signalarray.dimensionality.string)
-
+                helper.add_spikes(plot, train, color, units=x_units)
+
+            win.add_plot_widget(pW, i)
+            plot.set_axis_unit(BasePlot.Y_LEFT, units.dimensionality.string)
+            plots.append(plot)
+
+        view = _ChannelView(plots, pyramid, period, units, x_units, spikes,
+                            max_spike_waveforms)
+        view.show(0)
+        if num_channels > len(plots):
+            scroll = QScrollBar(Qt.Vertical, win)
+            scroll.setRange(0, num_channels - len(plots))
+            scroll.setPageStep(len(plots))
+            scroll.valueChanged.connect(view.show)
+            scroll._view = view # Keep alive as long as the scroll bar
+            win.plot_layout.addWidget(scroll, 0, 1, -1, 1)
+
+        plot = plots[-1]
         plot.set_axis_title(BasePlot.X_BOTTOM, 'Time')
-        plot.set_axis_unit(BasePlot.X_BOTTOM, x.dimensionality.string)
+        plot.set_axis_unit(BasePlot.X_BOTTOM, x_units.dimensionality.string)
 
-        win.add_x_synchronization_option(True, channels)
-        win.add_y_synchronization_option(False, channels)
+        ids = range(len(plots))
+        win.add_x_synchronization_option(True, ids)
+        win.add_y_synchronization_option(False, ids)
     else:
-        channels.reverse()
+        channels = sp.arange(num_channels)[::-1]
 
         pW = BaseCurveWidget(win)
         plot = pW.plot
 
-        helper.add_epochs(plot, epochs, x.units)
-
-        # Find plot y offset
-        max_offset = 0 * signalarray.units
-        for i, c in enumerate(channels[1:], 1):
-            cur_offset = signalarray[:, channels[i - 1]].max() -\
-                         signalarray[:, c].min()
-            if cur_offset > max_offset:
-                max_offset = cur_offset
+        helper.add_epochs(plot, epochs, x_units)
 
-        offset -= signalarray[:, channels[0]].min()
+        # Find plot y offsets: all channels are separated by the largest
+        # distance between the maximum and the minimum of neighbors
+        mins = pyramid.minimum()[channels]
+        maxs = pyramid.maximum()[channels]
+        max_offset = max((maxs[:-1] - mins[1:]).max(), 0) \
+            if num_channels > 1 else 0
+        offsets = sp.arange(num_channels) * max_offset - mins[0]
 
-        for c in channels:
-            plot.add_item(make.curve(x, signalarray[:, c] + offset))
-            _add_spike_waveforms(plot, spikes, x.units, c, offset)
-            offset += max_offset
+        # Initially show the first channels (at the top)
+        view = _StackedChannelView(plot, pyramid, channels, offsets, period,
+            units, x_units, spikes, max_spike_waveforms)
+        first = max(num_channels - visible_channels, 0)
+        vmin, vmax = view.lower[first:].min(), view.upper[first:].max()
+        if vmin == vmax:
+            vmin, vmax = vmin - 1, vmax + 1
+        plot.set_axis_limits(BasePlot.Y_LEFT, vmin, vmax)
+        view.show_range(vmin, vmax)
 
-        helper.add_events(plot, events, x.units)
+        helper.add_events(plot, events, x_units)
 
         for train in spike_trains:
             color = helper.get_object_color(train.unit)
-            helper.add_spikes(plot, train, color, units=x.units)
+            helper.add_spikes(plot, train, color, units=x_units)
 
         win.add_plot_widget(pW, 0)
 
         plot.set_axis_title(BasePlot.X_BOTTOM, 'Time')
-        plot.set_axis_unit(BasePlot.X_BOTTOM, x.dimensionality.string)
-        plot.set_axis_unit(BasePlot.Y_LEFT, signalarray.dimensionality.string)
+        plot.set_axis_unit(BasePlot.X_BOTTOM, x_units.dimensionality.string)
+        plot.set_axis_unit(BasePlot.Y_LEFT, units.dimensionality.string)
 
     win.add_custom_curve_tools(False)
 
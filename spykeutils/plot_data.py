@@ -0,0 +1,220 @@
+""" Data preparation for the signal plots in :mod:`spykeutils.plot`.
+
+The classes and functions in this module do not depend on guiqwt, so
+they can be used (and tested) without it.
+"""
+
+from __future__ import division
+from collections import OrderedDict
+
+import scipy as sp
+import quantities as pq
+
+import conversions
+
+
+class MinMaxPyramid(object):
+    """ Minimum and maximum envelopes of all channels of a signal at
+    multiple resolutions. Level ``k`` contains the minimum and maximum of
+    blocks of ``factor**(base_level + k)`` samples.
+
+    The pyramid is built in one pass over chunks of consecutive samples
+    of all channels, so a memory-mapped array with one row per sample is
+    read sequentially and not loaded completely. Views that need finer
+    resolution than the first level are created from windows of raw
+    samples of one channel. They are read when needed and include a
+    prefetch margin (relative to the size of the requested range) on both
+    sides. The least recently used windows are dropped when their total
+    size exceeds ``window_bytes``.
+
+    :param samples: Two-dimensional array (samples x channels), can be
+        memory-mapped.
+    :param int factor: Ratio of the block sizes of consecutive levels.
+    :param int base_level: The first level has blocks of
+        ``factor**base_level`` samples.
+    :param int min_blocks: Levels are added until a level has at most
+        this many blocks.
+    :param int chunk_size: The maximum number of values (samples x
+        channels) read at once when building the pyramid.
+    :param float prefetch: Size of the prefetch margin relative to the
+        size of the requested range.
+    :param int window_bytes: Maximum total size of cached raw windows.
+    """
+
+    def __init__(self, samples, factor=4, base_level=4, min_blocks=1024,
+                 chunk_size=2**20, prefetch=0.5,
+                 window_bytes=256 * 1024 * 1024):
+        self.samples = samples
+        self.factor = factor
+        self.base_size = factor ** base_level
+        self.prefetch = prefetch
+        self.window_bytes = window_bytes
+        self.num_samples, self.num_channels = samples.shape
+        self._windows = OrderedDict()
+        self._cached_bytes = 0
+
+        size = self.base_size
+        rows = max(chunk_size // max(self.num_channels, 1), size)
+        rows -= rows % size
+        num_blocks = -(-self.num_samples // size)
+        mins = sp.empty((num_blocks, self.num_channels))
+        maxs = sp.empty((num_blocks, self.num_channels))
+        for start in xrange(0, self.num_samples, rows):
+            data = sp.asarray(samples[start:start + rows], dtype=sp.float64)
+            first = start // size
+            last = first + -(-len(data) // size)
+            mins[first:last] = _block_reduce(data, size, sp.minimum)
+            maxs[first:last] = _block_reduce(data, size, sp.maximum)
+
+        self.mins = [mins]
+        self.maxs = [maxs]
+        while len(self.mins[-1]) > min_blocks:
+            self.mins.append(_block_reduce(self.mins[-1], factor,
+                                           sp.minimum))
+            self.maxs.append(_block_reduce(self.maxs[-1], factor,
+                                           sp.maximum))
+
+    def minimum(self):
+        """ Return the minimum of each channel.
+
+        :rtype: ndarray
+        """
+        return self.mins[-1].min(axis=0)
+
+    def maximum(self):
+        """ Return the maximum of each channel.
+
+        :rtype: ndarray
+        """
+        return self.maxs[-1].max(axis=0)
+
+    def read(self, channel, start, stop):
+        """ Return the raw samples of a channel between the indices
+        ``start`` and ``stop`` as float array. Samples are read from the
+        cached window of the channel if possible.
+
+        :rtype: ndarray
+        """
+        window = self._windows.pop(channel, None)
+        if window is None or start < window[0] or stop > window[1]:
+            if window is not None:
+                self._cached_bytes -= window[2].nbytes
+            margin = int((stop - start) * self.prefetch)
+            w_start = max(start - margin, 0)
+            w_stop = min(stop + margin, self.num_samples)
+            window = (w_start, w_stop, sp.asarray(
+                self.samples[w_start:w_stop, channel], dtype=sp.float64))
+            self._cached_bytes += window[2].nbytes
+            while self._windows and self._cached_bytes > self.window_bytes:
+                self._cached_bytes -= \
+                    self._windows.popitem(last=False)[1][2].nbytes
+        self._windows[channel] = window
+        return window[2][start - window[0]:stop - window[0]]
+
+    def envelope(self, channel, start, stop, num_points):
+        """ Return sample positions and values that show a channel
+        between the sample indices ``start`` and ``stop`` with at most
+        about ``num_points`` points. If there are more samples, the
+        minimum and maximum of consecutive blocks of samples are returned.
+
+        :returns: Two arrays: sample positions and values.
+        :rtype: ndarray, ndarray
+        """
+        start = max(start, 0)
+        stop = min(stop, self.num_samples)
+        if stop <= start:
+            return sp.zeros(0), sp.zeros(0)
+        if stop - start <= num_points:
+            return (sp.arange(start, stop, dtype=sp.float64),
+                    self.read(channel, start, stop))
+
+        block_size = 2.0 * (stop - start) / num_points
+        if block_size < self.base_size:
+            size = 1
+            first, last = start, stop
+            mins = maxs = self.read(channel, start, stop)
+        else: # Use the finest level with blocks of at most the required size
+            level = 0
+            size = self.base_size
+            while level + 1 < len(self.mins) and \
+                    size * self.factor <= block_size:
+                level += 1
+                size *= self.factor
+            first = start // size
+            last = -(-stop // size)
+            mins = self.mins[level][first:last, channel]
+            maxs = self.maxs[level][first:last, channel]
+
+        group = max(int(block_size // size), 1)
+        mins = _block_reduce(mins, group, sp.minimum)
+        maxs = _block_reduce(maxs, group, sp.maximum)
+
+        centers = first * size + (sp.arange(len(mins)) + 0.5) * group * size
+        centers = sp.minimum(centers, self.num_samples - 1)
+        return (sp.repeat(centers, 2),
+                sp.column_stack((mins, maxs)).ravel())
+
+
+def _block_reduce(data, size, function):
+    """ Reduce consecutive blocks of ``size`` rows with a ufunc like
+    ``sp.minimum``. The last block can be shorter.
+    """
+    full = len(data) - len(data) % size
+    reduced = function.reduce(
+        data[:full].reshape((-1, size) + data.shape[1:]), axis=1)
+    if full < len(data):
+        rest = function.reduce(data[full:], axis=0)
+        reduced = sp.concatenate((reduced, rest[sp.newaxis]))
+    return reduced
+
+
+def stack_waveforms(spikes, x_units, channel, units):
+    """ Return start times, sampling intervals and waveforms of spikes
+    as float arrays. Waveforms are padded with NaN to the longest
+    waveform.
+
+    :param sequence spikes: The Spike objects.
+    :param Quantity x_units: The units of start times and intervals.
+    :param int channel: The waveform channel.
+    :param Quantity units: The units of the waveforms.
+    :returns: Start times, sampling intervals (one per spike) and
+        waveforms (spikes x samples).
+    :rtype: ndarray, ndarray, ndarray
+    """
+    n = len(spikes)
+    starts = sp.empty(n)
+    steps = sp.empty(n)
+    waveforms = sp.empty((n, max(s.waveform.shape[0] for s in spikes)))
+    waveforms.fill(sp.nan)
+    for i, spike in enumerate(spikes):
+        # TODO: Is this usage of Spike.left_sweep correct?
+        if spike.left_sweep:
+            lsweep = spike.left_sweep
+        else:
+            lsweep = 0.0 * pq.ms
+        starts[i] = conversions.scalar(spike.time - lsweep, x_units)
+        steps[i] = conversions.scalar(1.0 / spike.sampling_rate, x_units)
+        waveform = spike.waveform[:, channel]
+        waveforms[i, :len(waveform)] = conversions.magnitude(waveform, units)
+    return starts, steps, waveforms
+
+
+def nan_separated(starts, steps, waveforms):
+    """ Return x and y data of a single curve containing all waveforms,
+    each followed by a NaN value.
+
+    :param ndarray starts: The start time of each waveform.
+    :param ndarray steps: The sampling interval of each waveform.
+    :param ndarray waveforms: The waveforms (waveforms x samples).
+    :returns: x and y values.
+    :rtype: ndarray, ndarray
+    """
+    n, length = waveforms.shape
+    x = sp.empty((n, length + 1))
+    x[:, :length] = starts[:, None] + \
+        sp.arange(length)[None, :] * steps[:, None]
+    x[:, length] = sp.nan
+    y = sp.empty((n, length + 1))
+    y[:, :length] = waveforms
+    y[:, length] = sp.nan
+    return x.ravel(), y.ravel()
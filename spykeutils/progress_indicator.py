@@ -1,4 +1,14 @@
 import functools
+import json
+import multiprocessing
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
 
 class CancelException(Exception):
     """ This is raised when a user cancels a progress process. It is used
@@ -57,4 +67,329 @@ class ProgressIndicator(object):
 
     def done(self):
         """ Signal that the operation is done. """
-        pass
\ No newline at end of file
+        pass
+
+
+class ThrottledProgressIndicator(ProgressIndicator):
+    """ Wraps a :class:`ProgressIndicator` and forwards steps to it only
+    after a number of steps have accumulated or some time has passed.
+    Use this for indicators where each call is expensive (e.g. a GUI
+    progress bar that repaints on every step) and the operation steps
+    often.
+
+    Calls to :meth:`begin`, :meth:`set_ticks`, :meth:`set_status` and
+    :meth:`done` forward accumulated steps first and are then forwarded
+    immediately.
+
+    :param indicator: The indicator that receives the steps.
+    :type indicator: :class:`ProgressIndicator`
+    :param int min_steps: Steps are forwarded when at least this many
+        steps have accumulated. If None, only ``interval`` is used.
+    :param float interval: Steps are forwarded when at least this many
+        milliseconds have passed since the last forwarded steps.
+    """
+
+    def __init__(self, indicator, min_steps=None, interval=100):
+        self.indicator = indicator
+        self.min_steps = min_steps
+        self.interval = interval / 1000.0
+        self._pending = 0
+        self._last = time.time()
+
+    def flush(self):
+        """ Forward all accumulated steps to the wrapped indicator.
+        """
+        self._last = time.time()
+        if self._pending:
+            pending = self._pending
+            self._pending = 0
+            self.indicator.step(pending)
+
+    def set_ticks(self, ticks):
+        self.flush()
+        self.indicator.set_ticks(ticks)
+
+    def begin(self, title=''):
+        self.flush()
+        self.indicator.begin(title)
+
+    def step(self, num_steps=1):
+        self._pending += num_steps
+        if self.min_steps is not None and self._pending >= self.min_steps:
+            self.flush()
+        elif time.time() - self._last >= self.interval:
+            self.flush()
+
+    def set_status(self, new_status):
+        self.flush()
+        self.indicator.set_status(new_status)
+
+    def done(self):
+        self.flush()
+        self.indicator.done()
+
+
+class InstrumentedProgressIndicator(ProgressIndicator):
+    """ A progress indicator that records timing and throughput of an
+    operation. Every call to :meth:`set_status` starts a new phase. When
+    :meth:`done` is called, a report with the wall time and steps of
+    each phase, the overall throughput and the peak memory use of the
+    process is available from :meth:`report`.
+
+    Since all analysis functions take a progress indicator, passing an
+    instance of this class profiles them without changes to their code.
+
+    :param indicator: An optional indicator that all calls are forwarded
+        to, e.g. a GUI progress bar.
+    :type indicator: :class:`ProgressIndicator`
+    """
+
+    def __init__(self, indicator=None):
+        self.indicator = indicator
+        self.title = ''
+        self.ticks = None
+        self.steps = 0
+        self.tick_steps = 0
+        self.phases = []
+        self._start = None
+        self._end = None
+        self._report = None
+
+    def _forward(self, name, *args):
+        if self.indicator is not None:
+            getattr(self.indicator, name)(*args)
+
+    def _start_phase(self, status):
+        now = time.time()
+        if self._start is None:
+            self._start = now
+        if self.phases:
+            self.phases[-1]['time'] = now - self.phases[-1]['start']
+        self.phases.append({'status': status, 'start': now, 'time': None,
+                            'steps': 0})
+
+    def set_ticks(self, ticks):
+        self.ticks = ticks
+        self.tick_steps = 0
+        self._forward('set_ticks', ticks)
+
+    def begin(self, title=''):
+        self.title = title
+        self._start_phase(title)
+        self._forward('begin', title)
+
+    def step(self, num_steps=1):
+        if not self.phases:
+            self._start_phase('')
+        self.steps += num_steps
+        self.tick_steps += num_steps
+        self.phases[-1]['steps'] += num_steps
+        self._forward('step', num_steps)
+
+    def set_status(self, new_status):
+        self._start_phase(new_status)
+        self._forward('set_status', new_status)
+
+    def elapsed(self):
+        """ Return the wall time in seconds since the operation started.
+        """
+        if self._start is None:
+            return 0.0
+        end = self._end if self._end is not None else time.time()
+        return end - self._start
+
+    def steps_per_second(self):
+        """ Return the average number of steps per second.
+        """
+        elapsed = self.elapsed()
+        if not elapsed:
+            return None
+        return self.steps / elapsed
+
+    def eta(self):
+        """ Return the estimated remaining time in seconds, based on the
+        steps remaining since the last :meth:`set_ticks` call and the
+        average throughput so far. Returns None if it cannot be estimated
+        yet.
+        """
+        rate = self.steps_per_second()
+        if not rate or self.ticks is None:
+            return None
+        return max(self.ticks - self.tick_steps, 0) / rate
+
+    def done(self):
+        self._end = time.time()
+        if self._start is None:
+            self._start = self._end
+        if self.phases:
+            self.phases[-1]['time'] = self._end - self.phases[-1]['start']
+        phases = []
+        for p in self.phases:
+            phases.append({'status': p['status'], 'time': p['time'],
+                           'steps': p['steps'],
+                           'steps_per_second': p['steps'] / p['time']
+                           if p['time'] else None})
+        self._report = {'title': self.title,
+                        'time': self.elapsed(),
+                        'ticks': self.ticks,
+                        'steps': self.steps,
+                        'steps_per_second': self.steps_per_second(),
+                        'peak_rss': peak_rss(),
+                        'phases': phases}
+        self._forward('done')
+
+    def report(self):
+        """ Return the report of the operation as dictionary. It is
+        available after :meth:`done` has been called, before that, None is
+        returned. Times are in seconds, ``peak_rss`` is the peak resident
+        memory of the process in bytes (None if unknown).
+        """
+        return self._report
+
+    def report_json(self, **kwargs):
+        """ Return the report of the operation as JSON string. Keyword
+        arguments are passed to :func:`json.dumps`.
+        """
+        return json.dumps(self._report, **kwargs)
+
+
+def peak_rss():
+    """ Return the peak resident memory size of the current process in
+    bytes, or None if it is not available on this platform.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+class WorkerProgressIndicator(ProgressIndicator):
+    """ A progress indicator for worker processes, created by
+    :meth:`ProgressProxy.worker`. Steps are added to a counter in shared
+    memory. :meth:`step` raises a :class:`CancelException` when the
+    operation has been cancelled in the parent process. Status and tick
+    changes are ignored, the parent process controls them.
+    """
+
+    def __init__(self, counter, cancelled):
+        self._counter = counter
+        self._cancelled = cancelled
+
+    def step(self, num_steps=1):
+        if self._cancelled.is_set():
+            raise CancelException()
+        with self._counter.get_lock():
+            self._counter.value += num_steps
+
+
+class ProgressProxy(object):
+    """ Forwards progress from worker processes to a
+    :class:`ProgressIndicator` in the parent process.
+
+    Workers step a :class:`WorkerProgressIndicator` from :meth:`worker`,
+    which adds to a shared counter. A thread in the parent process
+    polls the counter and forwards new steps to the indicator. When the
+    indicator raises a :class:`CancelException` (e.g. because the user
+    cancelled in a GUI), the workers raise a :class:`CancelException` on
+    their next step and :meth:`stop` raises it in the parent.
+
+    Worker indicators use shared memory, so they have to be passed to
+    workers when the processes are created: as argument of a
+    :class:`multiprocessing.Process` or in ``initargs`` of a
+    :class:`multiprocessing.Pool`. The proxy can be used as context
+    manager that starts and stops polling.
+
+    :param indicator: The indicator in the parent process.
+    :type indicator: :class:`ProgressIndicator`
+    :param float interval: Polling interval in milliseconds.
+    :param bool thread: If ``False``, no polling thread is started and
+        :meth:`poll` has to be called regularly instead, e.g. if the
+        indicator may only be used from the main thread.
+    """
+
+    def __init__(self, indicator, interval=100, thread=True):
+        self.indicator = indicator
+        self.interval = interval / 1000.0
+        self.use_thread = thread
+        self._counter = multiprocessing.Value('l', 0)
+        self._cancelled = multiprocessing.Event()
+        self._stopped = threading.Event()
+        self._forwarded = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def worker(self):
+        """ Return a progress indicator for a worker process.
+
+        :rtype: :class:`WorkerProgressIndicator`
+        """
+        return WorkerProgressIndicator(self._counter, self._cancelled)
+
+    def cancel(self):
+        """ Cancel the operation in all workers.
+        """
+        self._cancelled.set()
+
+    def cancelled(self):
+        """ Return if the operation has been cancelled.
+        """
+        return self._cancelled.is_set()
+
+    def poll(self):
+        """ Forward new steps of the workers to the indicator. Raises
+        a :class:`CancelException` if the operation was cancelled.
+        """
+        with self._lock:
+            if self._cancelled.is_set():
+                raise CancelException()
+            total = self._counter.value
+            new_steps = total - self._forwarded
+            self._forwarded = total
+            if new_steps:
+                try:
+                    self.indicator.step(new_steps)
+                except CancelException:
+                    self._cancelled.set()
+                    raise
+
+    def start(self):
+        """ Start polling in a separate thread (if enabled).
+        """
+        self._stopped.clear()
+        if self.use_thread and self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """ Stop polling and forward remaining steps. Raises a
+        :class:`CancelException` if the operation was cancelled.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.poll()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.poll()
+            except CancelException:
+                return
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.stop()
+            return
+        # Do not mask the original exception
+        try:
+            self.stop()
+        except CancelException:
+            pass
@@ -1,32 +1,83 @@
 from __future__ import division
 
 import scipy as sp
+from scipy.spatial.distance import pdist
 import quantities as pq
 import neo
 from progress_indicator import ProgressIndicator
 from spyke_exception import SpykeException
+from result_cache import cached, unseeded_bootstrap
+import conversions
+import sampling
+from spike_train_set import as_spike_train_set
+
+# Maximum number of spike distances evaluated at once in density estimation
+_KERNEL_CHUNK_ELEMENTS = 2**20
+
+def _binned_spike_trains(train_set, bins):
+    """ Return a binned representation of spike trains.
+
+    :param train_set: The spike trains.
+    :type train_set: :class:`spykeutils.spike_train_set.SpikeTrainSet`
+    :param ndarray bins: The bin edges, including the rightmost edge
+        (in the time unit of ``train_set``).
+    :returns: Two-dimensional array of spike counts with one row per
+        spike train.
+    :rtype: ndarray
+    """
+    num_trains = train_set.num_trains
+    num_bins = max(len(bins) - 1, 0)
+    if not num_trains or not num_bins:
+        return sp.zeros((num_trains, num_bins), dtype=int)
+
+    times = train_set.times
+    train_index = train_set.train_index()
+    bin_index = sp.searchsorted(bins, times, 'right') - 1
+    # Like in a histogram, the last bin includes its right edge
+    bin_index[times == bins[-1]] = num_bins - 1
+
+    valid = (bin_index >= 0) & (bin_index < num_bins)
+    counts = sp.bincount(
+        train_index[valid] * num_bins + bin_index[valid],
+        minlength=num_trains * num_bins)
+    return counts.reshape((num_trains, num_bins))
+
+
+def _binned_counts(trains, bin_size, start, stop):
+    """ Return a dictionary of two-dimensional count arrays for a
+    dictionary of SpikeTrain lists or a
+    :class:`spykeutils.spike_train_set.SpikeTrainSet` and the bin
+    borders as float array (in units of ``bin_size``).
+    """
+    units = bin_size.units
+    train_set = as_spike_train_set(trains, units)
 
-def _binned_spike_trains(trains, bins):
-    """ Return a binned representation of SpikeTrain objects.
+    # Do not create bins that do not include all spike trains
+    max_start, max_stop = train_set.shared_interval()
+    start = max(conversions.scalar(start, units), max_start)
+    if stop is not None:
+        stop = min(conversions.scalar(stop, units), max_stop)
+    else:
+        stop = max_stop
 
-    :param sequencs trains: A sequence of SpikeTrain objects.
-    :param bins: The bin edges, including the rightmost edge.
-    :type bins: Quantity 1D
-    :returns: List of one-dimensional arrays of spike counts.
-    :rtype: list
-    """
-    counts = []
-    for t in trains:
-        counts.append(sp.histogram(t.rescale(bins.units), bins)[0])
+    bins = sp.arange(start, stop, conversions.scalar(bin_size, units))
 
-    return counts
+    counts = _binned_spike_trains(train_set, bins)
+    binned = {}
+    for i, u in enumerate(train_set.units):
+        rows = train_set.unit_trains(i)
+        if len(rows):
+            binned[u] = counts[rows]
+
+    return binned, bins
 
 
 def binned_spike_trains(trains, bin_size, start=0*pq.ms, stop=None):
     """ Return dictionary of binned rates for a dictionary of
     SpikeTrain lists.
 
-    :param dict trains: A sequence of `SpikeTrain` lists.
+    :param trains: A dictionary of `SpikeTrain` lists.
+    :type trains: dict or :class:`spykeutils.spike_train_set.SpikeTrainSet`
     :param bin_size: The desired bin size (as a time quantity).
     :type bin_size: Quantity scalar
     :type start: The desired time for the start of the first bin.
@@ -41,35 +92,20 @@ def binned_spike_trains(trains, bin_size, start=0*pq.ms, stop=None):
         of spike train counts and the bin borders.
     :rtype: dict, Quantity 1D
     """
-    # Do not create bins that do not include all spike trains
-    max_start, max_stop = minimum_spike_train_interval(trains)
-
-    start = max(start, max_start)
-    start.units = bin_size.units
-    if stop is not None:
-        stop = min(stop, max_stop)
-    else:
-        stop = max_stop
-    stop.units = bin_size.units
-
-    # Calculate bin size
-    bins = sp.arange(start, stop, bin_size)*bin_size.units
-
-    # Create dictionary for all SpikeTrain lists
-    binned = {}
-    for s in trains:
-        b = _binned_spike_trains(trains[s], bins)
-        if b:
-            binned[s] = b
+    binned, bins = _binned_counts(trains, bin_size, start, stop)
+    for u in binned:
+        binned[u] = list(binned[u])
 
-    return binned, bins
+    return binned, bins * bin_size.units
 
 
+@cached()
 def psth(trains, bin_size, rate_correction=True, start=0*pq.ms, stop=None):
     """ Return dictionary of peri stimulus time histograms for a dictionary
     of SpikeTrain lists.
 
-    :param dict trains: A dictionary of lists of SpikeTrain objects.
+    :param trains: A dictionary of lists of SpikeTrain objects.
+    :type trains: dict or :class:`spykeutils.spike_train_set.SpikeTrainSet`
     :param bin_size: The desired bin size (as a time quantity).
     :type bin_size: Quantity scalar
     :param bool rate_correction: Determine if a rates (``True``) or
@@ -90,18 +126,103 @@ def psth(trains, bin_size, rate_correction=True, start=0*pq.ms, stop=None):
     if not trains:
         raise SpykeException('No spike trains for PSTH!')
 
-    binned, bins = binned_spike_trains(trains, bin_size, start, stop)
+    binned, bins = _binned_counts(trains, bin_size, start, stop)
 
     cumulative = {}
-    time_multiplier = 1.0 / float(bin_size.rescale(pq.s))
-    for u in binned:
+    time_multiplier = 1.0 / conversions.scalar(bin_size, pq.s)
+    for u, counts in binned.iteritems():
         if rate_correction:
-            cumulative[u] = sp.mean(sp.array(binned[u]), 0)
+            cumulative[u] = sp.mean(counts, 0)
         else:
-            cumulative[u] = sp.sum(sp.array(binned[u]), 0)
+            cumulative[u] = sp.sum(counts, 0)
         cumulative[u] *= time_multiplier
 
-    return cumulative, bins
+    return cumulative, bins * bin_size.units
+
+
+@cached(unseeded_bootstrap)
+def psth_bootstrap_interval(trains, bin_size, rate_correction=True,
+                            start=0*pq.ms, stop=None, bootstrap_samples=1000,
+                            confidence=0.95, random_state=None,
+                            batch_size=500):
+    """ Return bootstrap confidence intervals for the peri stimulus time
+    histograms of :func:`psth`. The trials (spike trains) of each unit
+    are resampled with replacement.
+
+    :param trains: A dictionary of lists of SpikeTrain objects.
+    :type trains: dict or :class:`spykeutils.spike_train_set.SpikeTrainSet`
+    :param bin_size: The desired bin size (as a time quantity).
+    :type bin_size: Quantity scalar
+    :param bool rate_correction: Determine if intervals for rates
+        (``True``) or counts (``False``) are returned.
+    :param start: The desired time for the start of the first bin. It
+        will be recalculated if there are spike trains which start
+        later than this time.
+    :type start: Quantity scalar
+    :param stop: The desired time for the end of the last bin. It will
+        be recalculated if there are spike trains which end earlier
+        than this time.
+    :type stop: Quantity scalar
+    :param int bootstrap_samples: The number of bootstrap resamplings of
+        the trials.
+    :param float confidence: The confidence level of the intervals.
+    :param random_state: Seed (int) or ``RandomState`` object used to
+        draw the bootstrap samples. If None, a new unseeded
+        ``RandomState`` is used.
+    :param int batch_size: The number of bootstrap samples that are
+        computed at once. Limits the size of the resampling weight matrix.
+    :returns: A dictionary (with the same indices as ``trains``) of
+        (lower, upper) tuples of arrays with the confidence interval for
+        each bin and the bin borders.
+    :rtype: dict, Quantity 1D
+    """
+    if not trains:
+        raise SpykeException('No spike trains for PSTH!')
+
+    binned, bins = _binned_counts(trains, bin_size, start, stop)
+
+    intervals = {}
+    rng = sampling.random_state(random_state)
+    time_multiplier = 1.0 / conversions.scalar(bin_size, pq.s)
+    for u, counts in binned.iteritems():
+        lower, upper = _bootstrap_interval(counts, bootstrap_samples,
+            confidence, rng, batch_size)
+        if not rate_correction:
+            lower *= len(counts)
+            upper *= len(counts)
+        intervals[u] = (lower * time_multiplier, upper * time_multiplier)
+
+    return intervals, bins * bin_size.units
+
+
+def _bootstrap_interval(trials, num_samples, confidence, rng, batch_size):
+    """ Return bootstrap confidence interval bounds for the mean over
+    trials.
+
+    Each bootstrap sample is a row of multinomial trial weights, so a
+    whole batch of samples is evaluated with one matrix multiplication.
+
+    :param ndarray trials: Two-dimensional array with one row per trial.
+    :param int num_samples: The number of bootstrap samples.
+    :param float confidence: The confidence level.
+    :param RandomState rng: Random number generator for the resampling.
+    :param int batch_size: Maximum number of samples per multiplication.
+    :returns: Lower and upper bounds for each column of ``trials``.
+    :rtype: ndarray, ndarray
+    """
+    num_trials = trials.shape[0]
+    trial_prob = sp.ones(num_trials) / num_trials
+    batch_size = max(int(batch_size), 1)
+
+    means = sp.empty((num_samples, trials.shape[1]))
+    for b in xrange(0, num_samples, batch_size):
+        size = min(batch_size, num_samples - b)
+        weights = rng.multinomial(num_trials, trial_prob, size)
+        means[b:b+size] = sp.dot(weights, trials) / num_trials
+
+    alpha = 50.0 * (1.0 - confidence)
+    return (sp.percentile(means, alpha, axis=0),
+            sp.percentile(means, 100.0 - alpha, axis=0))
 
 
 def aligned_spike_trains(trains, events, copy=True):
@@ -161,15 +282,35 @@ def minimum_spike_train_interval(trains):
     :returns: Maximum shared start time and minimum shared stop time.
     :rtype: Quantity scalar, Quantity scalar
     """
+    units = pq.s
+    for st in trains.itervalues():
+        if st:
+            units = st[0].t_start.units
+            break
+
+    start, stop = _shared_interval(trains, units)
+
     # Hoping that nobody needs a 1000 year long spike train
-    start = -1000 * pq.year
-    stop = 1000 * pq.year
+    if sp.isinf(start):
+        start = -1000 * conversions.scalar(pq.year, units)
+    if sp.isinf(stop):
+        stop = 1000 * conversions.scalar(pq.year, units)
+
+    return start * units, stop * units
+
 
-    # Load data and find shortest spike train
+def _shared_interval(trains, units):
+    """ Return the maximum start time and minimum stop time of a
+    dictionary of SpikeTrain lists as floats in the given units.
+    """
+    start = -sp.inf
+    stop = sp.inf
     for st in trains.itervalues():
-        # Minimum length of spike of all spike trains for this unit
-        start = max(start, max((t.t_start for t in st)))
-        stop = min(stop, min((t.t_stop for t in st)))
+        if not st:
+            continue
+        starts, stops = conversions.train_intervals(st, units)
+        start = max(start, starts.max())
+        stop = min(stop, stops.min())
 
     return start, stop
 
@@ -179,6 +320,7 @@ def gauss_kernel(x, kernel_size):
            sp.exp(-x**2 / (2 * kernel_size)**2)
 
 
+@cached()
 def spike_density_estimation(trains, start=0*pq.ms, stop=None,
                              evaluation_points=None, kernel=gauss_kernel,
                              kernel_size=100*pq.ms, optimize_steps=None,
@@ -188,7 +330,8 @@ def spike_density_estimation(trains, start=0*pq.ms, stop=None,
     an estimate of the instantaneous rate. Optionally finds optimal
     kernel size for given data.
 
-    :param dict trains: A dictionary of SpikeTrain lists.
+    :param trains: A dictionary of SpikeTrain lists.
+    :type trains: dict or :class:`spykeutils.spike_train_set.SpikeTrainSet`
     :param start: The desired time for the start of the first bin. It
         will be recalculated if there are spike trains which start later
         than this time. This parameter can be negative (which could be
@@ -230,55 +373,124 @@ def spike_density_estimation(trains, start=0*pq.ms, stop=None,
     """
     if optimize_steps is None or len(optimize_steps) < 1:
         units = kernel_size.units
-        kernel_size = {u:kernel_size for u in trains}
+        train_set = as_spike_train_set(trains, units)
+        kernel_size = {u:kernel_size for u in train_set.units}
     else:
         # Find optimal kernel size for all spike train sets
-        progress.set_ticks(len(optimize_steps)*len(trains))
-        progress.set_status('Calculating optimal kernel size')
         units = optimize_steps.units
+        train_set = as_spike_train_set(trains, units)
+        progress.set_ticks(len(optimize_steps)*len(train_set.units))
+        progress.set_status('Calculating optimal kernel size')
+        steps = conversions.magnitude(optimize_steps, units)
         kernel_size = {}
-        for u,t in trains.iteritems():
-            c = collapsed_spike_trains(t)
-            kernel_size[u] = optimal_gauss_kernel_size(c, optimize_steps,
-                progress)
+        for i, u in enumerate(train_set.units):
+            c = train_set.unit_spikes(i)
+            cost = _gauss_kernel_cost(c, steps, progress)
+            kernel_size[u] = steps[sp.argmin(cost)] * units
 
     # Prepare evaluation points
     if evaluation_points is None:
-        max_start, max_stop = minimum_spike_train_interval(trains)
+        max_start, max_stop = train_set.shared_interval()
 
-        start = max(start, max_start)
-        start.units = units
+        start = max(conversions.scalar(start, units), max_start)
         if stop is not None:
-            stop = min(stop, max_stop)
+            stop = min(conversions.scalar(stop, units), max_stop)
         else:
             stop = max_stop
-        stop.units = units
 
-        evaluation_points = sp.linspace(start, stop, 1000)
+        evaluation_points = sp.linspace(start, stop, 1000) * units
+    points = conversions.magnitude(evaluation_points, units)
 
-    progress.set_ticks(len(trains) * len(evaluation_points))
+    progress.set_ticks(len(train_set.units) * len(evaluation_points))
     progress.set_status('Creating spike density plot')
     # Calculate KDEs
     kde = {}
-    for u,t in trains.iteritems():
-        this_kde = []
-
-        # Collapse spike trains
-        collapsed = sp.asarray(collapsed_spike_trains(t).rescale(units))
-        ksize = float(kernel_size[u])
+    rate_factor = conversions.conversion_factor(1 / units, pq.Hz)
+    for i, u in enumerate(train_set.units):
+        ksize = conversions.scalar(kernel_size[u], units)
+        rows = train_set.unit_trains(i)
 
-        # Create density estimation
-        for p in evaluation_points:
-            dist = collapsed - float(p)
+        # Collapse spike trains and create density estimation
+        collapsed = train_set.unit_spikes(i)
+        density = _kernel_density(collapsed, points, kernel, ksize,
+            progress)
 
-            this_kde.append(sum(kernel(dist, ksize)))
-            progress.step()
+        kde[u] = density / len(rows) * rate_factor * pq.Hz
 
-        kde[u] = sp.asarray(this_kde) / len(trains[u]) / units
-        kde[u].units = pq.Hz
     return kde, kernel_size, evaluation_points
 
 
+@cached(unseeded_bootstrap)
+def spike_density_bootstrap_interval(trains, evaluation_points,
+                                     kernel=gauss_kernel,
+                                     kernel_size=100*pq.ms,
+                                     bootstrap_samples=1000, confidence=0.95,
+                                     random_state=None, batch_size=500,
+                                     progress=ProgressIndicator()):
+    """ Return bootstrap confidence intervals for the spike density
+    estimations of :func:`spike_density_estimation`. The trials (spike
+    trains) of each unit are resampled with replacement.
+
+    :param trains: A dictionary of SpikeTrain lists.
+    :type trains: dict or :class:`spykeutils.spike_train_set.SpikeTrainSet`
+    :param evaluation_points: An array of time points at which the
+        intervals are evaluated, e.g. the evaluation points returned by
+        :func:`spike_density_estimation`.
+    :type evaluation_points: Quantity 1D
+    :param func kernel: The kernel function to use, should accept
+        two parameters: A ndarray of distances and a kernel size.
+        The total area under the kernel function sould be 1.
+        Default: Gaussian kernel
+    :param kernel_size: A uniform kernel size for all spike trains or a
+        dictionary of kernel sizes indexed the same as ``trains`` (e.g.
+        the kernel sizes returned by :func:`spike_density_estimation`).
+    :type kernel_size: Quantity scalar or dict
+    :param int bootstrap_samples: The number of bootstrap resamplings of
+        the trials.
+    :param float confidence: The confidence level of the intervals.
+    :param random_state: Seed (int) or ``RandomState`` object used to
+        draw the bootstrap samples. If None, a new unseeded
+        ``RandomState`` is used.
+    :param int batch_size: The number of bootstrap samples that are
+        computed at once. Limits the size of the resampling weight matrix.
+    :param progress: Set this parameter to report progress.
+    :type progress: :class:`spykeutils.progress_indicator.ProgressIndicator`
+    :returns: A dictionary (indexed the same as ``trains``) of
+        (lower, upper) tuples of Quantity 1D in Hz with the confidence
+        interval at each evaluation point.
+    :rtype: dict
+    """
+    units = evaluation_points.units
+    train_set = as_spike_train_set(trains, units)
+    points = conversions.magnitude(evaluation_points, units)
+
+    progress.set_ticks(len(train_set.units) * len(points))
+    progress.set_status('Calculating spike density confidence intervals')
+    intervals = {}
+    rng = sampling.random_state(random_state)
+    rate_factor = conversions.conversion_factor(1 / units, pq.Hz)
+    for i, u in enumerate(train_set.units):
+        if isinstance(kernel_size, dict):
+            ksize = conversions.scalar(kernel_size[u], units)
+        else:
+            ksize = conversions.scalar(kernel_size, units)
+        rows = train_set.unit_trains(i)
+
+        # Density contribution of each trial
+        trials = sp.empty((len(rows), len(points)))
+        for j, r in enumerate(rows):
+            trials[j] = _kernel_density(train_set.train(r), points,
+                kernel, ksize)
+        progress.step(len(points))
+
+        lower, upper = _bootstrap_interval(trials, bootstrap_samples,
+            confidence, rng, batch_size)
+        intervals[u] = (lower * rate_factor * pq.Hz,
+                        upper * rate_factor * pq.Hz)
+
+    return intervals
+
+
 def collapsed_spike_trains(trains):
     """ Return a superposition of a list of spike trains.
 
@@ -289,15 +501,49 @@ def collapsed_spike_trains(trains):
     if not trains:
         return neo.SpikeTrain([], 0)
 
-    start = min((t.t_start for t in trains))
-    stop = max((t.t_stop for t in trains))
+    starts, stops = conversions.train_intervals(trains, pq.s)
+    units = trains[sp.argmax(stops)].t_stop.units
+    factor = conversions.conversion_factor(pq.s, units)
+
+    return neo.SpikeTrain(_collapsed_times(trains, units) * units,
+        t_stop=stops.max() * factor * units,
+        t_start=starts.min() * factor * units)
+
+
+def _collapsed_times(trains, units):
+    """ Return the spike times of a list of spike trains in one float
+    array.
+    """
+    if not trains:
+        return sp.array([])
+    return sp.concatenate(conversions.spike_times(trains, units))
 
-    collapsed = []
-    for t in trains:
-        collapsed.extend(sp.asarray(t.rescale(stop.units)))
 
-    return neo.SpikeTrain(collapsed*stop.units, t_stop=stop, t_start=start)
+def _kernel_density(times, points, kernel, kernel_size,
+                    progress=ProgressIndicator()):
+    """ Return the sum of kernels centered on all ``times``, evaluated
+    at ``points``. The distances are calculated in chunks of evaluation
+    points to limit memory usage.
 
+    :param ndarray times: Spike times.
+    :param ndarray points: Evaluation points (same units as ``times``).
+    :param func kernel: The kernel function.
+    :param float kernel_size: The kernel size (same units as ``times``).
+    :param progress: Advanced by one step per evaluation point.
+    :type progress: :class:`spykeutils.progress_indicator.ProgressIndicator`
+    :rtype: ndarray
+    """
+    density = sp.empty(len(points))
+    chunk = max(1, _KERNEL_CHUNK_ELEMENTS // max(len(times), 1))
+    for i in xrange(0, len(points), chunk):
+        p = points[i:i+chunk]
+        dist = times[sp.newaxis, :] - p[:, sp.newaxis]
+        density[i:i+chunk] = sp.sum(kernel(dist, kernel_size), 1)
+        progress.step(len(p))
+
+    return density
+
+@cached()
 def optimal_gauss_kernel_size(train, optimize_steps,
                               progress=ProgressIndicator()):
     """ Return the optimal kernel size for a spike density estimation
@@ -318,19 +564,106 @@ def optimal_gauss_kernel_size(train, optimize_steps,
     :returns: Best of the given kernel sizes
     :rtype: Quantity scalar
     """
-    x = sp.asarray(train.rescale(optimize_steps.units))
-    steps = sp.asarray(optimize_steps)
-
-    N = len(train)
-    tau = sp.triu(sp.vstack([x] * N) - sp.vstack([x] * N).T, 1)
-    idx = sp.triu(sp.ones((N,N)), 1)
-    TAU = tau.T[idx.T==1]**2
-
-    C = {}
-    for s in steps:
-        C[s] = N/s + 1/s * sum(2 * sp.exp(-TAU/(4 * s**2)) -
-                               4 * sp.sqrt(2) * sp.exp(-TAU/(2 * s**2)))
-        progress.step()
+    units = optimize_steps.units
+    steps = conversions.magnitude(optimize_steps, units)
+    cost = _gauss_kernel_cost(conversions.magnitude(train, units), steps,
+        progress)
 
     # Return kernel size with smallest cost
-    return min(C, key=C.get)*train.units
\ No newline at end of file
+    return steps[sp.argmin(cost)] * units
+
+
+def _gauss_kernel_cost(x, steps, progress=ProgressIndicator()):
+    """ Return the cost function of gaussian kernel sizes for the spike
+    times ``x`` (see :func:`optimal_gauss_kernel_size`).
+    """
+    N = len(x)
+    TAU = pdist(x[:, sp.newaxis], 'sqeuclidean')
+
+    cost = sp.empty(len(steps))
+    for i, s in enumerate(steps):
+        cost[i] = N/s + 1/s * sp.sum(2 * sp.exp(-TAU/(4 * s**2)) -
+                                     4 * sp.sqrt(2) *
+                                     sp.exp(-TAU/(2 * s**2)))
+        progress.step()
+
+    return cost
+
+
+def optimal_hist_bin_size(trains, optimize_steps, start=0*pq.ms, stop=None,
+                          progress=ProgressIndicator()):
+    """ Return the optimal bin size for a peri stimulus time histogram
+    of a list of spike trains and the cost function for all tried
+    bin sizes.
+    See (Shimazaki, Shinomoto. Neural Computation. 2007).
+
+    The spikes of all trains are collapsed and sorted once, the histograms
+    for all bin sizes are then read from the cumulative spike count at the
+    bin borders of all candidates in a single pass.
+
+    :param sequence trains: A list of SpikeTrain objects (e.g. all
+        trials of one unit).
+    :param optimize_steps: Array of bin sizes to try (the best of
+        these sizes will be returned).
+    :type optimize_steps: Quantity 1D
+    :param start: The desired time for the start of the first bin.
+        It will be recalculated if there are spike trains which start
+        later than this time.
+    :type start: Quantity scalar
+    :param stop: The desired time for the end of the last bin. It will
+        be recalculated if there are spike trains which end earlier
+        than this time.
+    :type stop: Quantity scalar
+    :param progress: Set this parameter to report progress. Will be
+        advanced by len(`optimize_steps`) steps.
+    :type progress: :class:`spykeutils.progress_indicator.ProgressIndicator`
+    :returns: Two values:
+
+        * Best of the given bin sizes (Quantity scalar).
+        * The cost function value for each of the given bin sizes
+          (1D array, ``inf`` for bin sizes larger than the analyzed
+          interval).
+    :rtype: Quantity scalar, ndarray
+    """
+    if not trains:
+        raise SpykeException('No spike trains for bin size optimization!')
+
+    units = optimize_steps.units
+    max_start, max_stop = _shared_interval({0: trains}, units)
+    start = max(conversions.scalar(start, units), max_start)
+    if stop is not None:
+        stop = min(conversions.scalar(stop, units), max_stop)
+    else:
+        stop = max_stop
+
+    x = sp.sort(_collapsed_times(trains, units))
+    steps = conversions.magnitude(optimize_steps, units)
+    num_bins = sp.floor((stop - start) / steps).astype(int)
+    num_bins[num_bins < 0] = 0
+
+    # Bin borders of all candidates, concatenated
+    num_edges = num_bins + 1
+    edge_step = sp.repeat(sp.arange(len(steps)), num_edges)
+    edge_index = sp.arange(len(edge_step)) - \
+                 sp.repeat(sp.cumsum(num_edges) - num_edges, num_edges)
+    edges = start + edge_index * steps[edge_step]
+
+    # Spike counts are differences of the cumulative count at the borders,
+    # differences across two candidates are discarded
+    counts = sp.diff(sp.searchsorted(x, edges))
+    same_step = edge_step[1:] == edge_step[:-1]
+    counts = counts[same_step].astype(float)
+    count_step = edge_step[1:][same_step]
+
+    sums = sp.bincount(count_step, counts, len(steps))
+    squares = sp.bincount(count_step, counts**2, len(steps))
+
+    cost = sp.empty(len(steps))
+    cost.fill(sp.inf)
+    valid = num_bins > 0
+    mean = sums[valid] / num_bins[valid]
+    variance = squares[valid] / num_bins[valid] - mean**2
+    cost[valid] = (2 * mean - variance) / (len(trains) * steps[valid])**2
+    progress.step(len(steps))
+
+    return steps[sp.argmin(cost)] * units, cost
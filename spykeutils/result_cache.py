@@ -0,0 +1,718 @@
+""" Optional caching of analysis results.
+
+Caching is disabled by default. After calling :func:`enable_memory_cache`,
+results of the functions decorated with :func:`cached` (e.g.
+:func:`spykeutils.rate_estimation.psth`,
+:func:`spykeutils.rate_estimation.spike_density_estimation`,
+:func:`spykeutils.rate_estimation.optimal_gauss_kernel_size` and
+:func:`spykeutils.correlogram.correlogram`) are stored in memory and
+returned directly when the function is called again with identical data
+and parameters. :func:`enable_disk_cache` additionally stores results
+as files in a directory, so they can be reused by other processes and
+sessions.
+
+Cache keys are computed from the content of all spike arrays (including
+their units, start and stop times) and all other parameters. In the
+memory cache, dictionary keys that are not simple values (e.g. neo
+``Unit`` objects) are identified by object identity, so results are only
+reused for the same unit objects. In the disk cache, they are identified
+by their ``name`` attribute and the key also includes the spykeutils
+version.
+
+Long analyses can also keep partial results in a :class:`Checkpoint`.
+When such an analysis is cancelled, the completed parts are kept and a
+later call with the same parameters and checkpoint continues from there.
+"""
+
+import cPickle as pickle
+import functools
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import scipy as sp
+import quantities as pq
+
+from spykeutils import __version__
+from spyke_exception import SpykeException
+from progress_indicator import ProgressIndicator
+from spike_train_set import SpikeTrainSet
+
+
+class ResultCache(object):
+    """ In-memory result cache with a memory budget and least recently
+    used (LRU) eviction.
+
+    :param int max_bytes: The maximum total size of the cached results in
+        bytes. If adding a result exceeds the budget, the least recently
+        used results are removed. Results larger than the budget are not
+        stored.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return the result stored for a key and mark it as recently
+        used.
+
+        :param str key: The cache key.
+        :raises KeyError: If no result is stored for the key.
+        """
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """ Store a result, evicting least recently used results if the
+        memory budget would be exceeded.
+
+        :param str key: The cache key.
+        :param value: The result to store.
+        """
+        size = _result_size(value)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            while self._entries and \
+                    self.current_bytes + size > self.max_bytes:
+                self.current_bytes -= self._entries.popitem(False)[1][1]
+                self.evictions += 1
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+
+    def clear(self):
+        """ Remove all results from the cache. The statistics are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def statistics(self):
+        """ Return a dictionary with the number of hits, misses and
+        evictions as well as the number of entries and the size of the
+        cache.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'bytes': self.current_bytes,
+                    'max_bytes': self.max_bytes}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_memory_cache = None
+
+
+def enable_memory_cache(max_bytes=256 * 1024 * 1024):
+    """ Enable the in-memory result cache. If it is already enabled, the
+    existing cache is kept and its budget is set to ``max_bytes``.
+
+    :param int max_bytes: The memory budget of the cache in bytes.
+    :returns: The cache object, which can be used to query statistics.
+    :rtype: :class:`ResultCache`
+    """
+    global _memory_cache
+    if _memory_cache is None:
+        _memory_cache = ResultCache(max_bytes)
+    else:
+        _memory_cache.max_bytes = max_bytes
+    return _memory_cache
+
+
+def disable_memory_cache():
+    """ Disable the in-memory result cache and free all cached results.
+    """
+    global _memory_cache
+    _memory_cache = None
+
+
+def memory_cache():
+    """ Return the active in-memory cache or None if caching is disabled.
+
+    :rtype: :class:`ResultCache`
+    """
+    return _memory_cache
+
+
+class DiskCache(object):
+    """ Persistent result cache that stores each result as a ``.npz`` file
+    in a directory. When the total size of the files exceeds the size
+    limit, the least recently used files are deleted. Multiple processes
+    can use the same directory.
+
+    :param str directory: The cache directory. It is created if it does
+        not exist.
+    :param int max_bytes: The maximum total size of the cache files in
+        bytes.
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key, keys=None):
+        """ Return the result stored for a key and mark it as recently
+        used.
+
+        :param str key: The cache key.
+        :param dict keys: Dictionary of objects that were used as
+            dictionary keys in the result, indexed by their stable token
+            (see :func:`fingerprint`).
+        :raises KeyError: If no valid result is stored for the key.
+        """
+        path = self._path(key)
+        try:
+            data = sp.load(path)
+        except IOError:
+            with self._lock:
+                self.misses += 1
+            raise KeyError(key)
+
+        try:
+            structure = json.loads(str(data['structure']))
+            arrays = [data['a%d' % i] for i in xrange(len(data.files) - 1)]
+            value = _decode(structure, arrays, keys or {})
+        except Exception:
+            # Damaged or incompatible file
+            with self._lock:
+                self.misses += 1
+            _remove_file(path)
+            raise KeyError(key)
+        finally:
+            data.close()
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value, keys=None):
+        """ Store a result and evict least recently used files if the
+        size limit is exceeded. Results that cannot be stored (e.g.
+        because they contain objects other than arrays, numbers, strings
+        and containers of those) are ignored.
+
+        :param str key: The cache key.
+        :param value: The result to store.
+        :param dict keys: Dictionary of objects that may be used as
+            dictionary keys in the result, indexed by their stable token.
+        """
+        tokens = dict((id(o), t) for t, o in (keys or {}).iteritems())
+        arrays = []
+        try:
+            structure = _encode(value, arrays, tokens)
+        except _Unhashable:
+            return
+
+        contents = {'structure': sp.array(json.dumps(structure))}
+        for i, a in enumerate(arrays):
+            contents['a%d' % i] = a
+
+        # Write to temporary file first so that other processes never
+        # read incomplete files
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                sp.savez(f, **contents)
+            os.rename(temp_path, self._path(key))
+        except (IOError, OSError):
+            _remove_file(temp_path)
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(e[1] for e in entries)
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if _remove_file(path):
+                with self._lock:
+                    self.evictions += 1
+            total -= size
+
+    def clear(self):
+        """ Remove all result files from the cache directory. The
+        statistics are kept.
+        """
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                _remove_file(os.path.join(self.directory, name))
+
+    def statistics(self):
+        """ Return a dictionary with the number of hits, misses and
+        evictions of this object as well as the number of files and the
+        size of the cache directory.
+        """
+        sizes = [os.path.getsize(os.path.join(self.directory, n))
+                 for n in os.listdir(self.directory) if n.endswith('.npz')]
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(sizes),
+                    'bytes': sum(sizes), 'max_bytes': self.max_bytes}
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        return False
+    return True
+
+
+_disk_cache = None
+
+
+def enable_disk_cache(directory, max_bytes=1024 * 1024 * 1024):
+    """ Enable the persistent result cache.
+
+    :param str directory: The cache directory.
+    :param int max_bytes: The maximum total size of the cache files in
+        bytes.
+    :returns: The cache object, which can be used to query statistics.
+    :rtype: :class:`DiskCache`
+    """
+    global _disk_cache
+    _disk_cache = DiskCache(directory, max_bytes)
+    return _disk_cache
+
+
+def disable_disk_cache():
+    """ Disable the persistent result cache. The cache files are kept.
+    """
+    global _disk_cache
+    _disk_cache = None
+
+
+def disk_cache():
+    """ Return the active persistent cache or None if it is disabled.
+
+    :rtype: :class:`DiskCache`
+    """
+    return _disk_cache
+
+
+class Checkpoint(object):
+    """ Stores the completed parts of a long analysis, so that a cancelled
+    analysis can be resumed. Functions that support checkpoints (e.g.
+    :func:`spykeutils.correlogram.correlogram` and
+    :func:`spykeutils.sorting_quality_assesment.calculate_overlap_fp_fn`)
+    take a ``checkpoint`` parameter. They check for cancellation (by
+    stepping their progress indicator) after each completed part and
+    store it in the checkpoint. When the analysis is cancelled, the
+    checkpoint is saved. Calling the function again with the same
+    parameters and checkpoint only computes the missing parts. When the
+    analysis is complete, the checkpoint is cleared.
+
+    A checkpoint belongs to one call: if it is used for a call with
+    different data or parameters, the stored parts are discarded.
+
+    :param str filename: If given, the checkpoint is saved to this file
+        on cancellation and loaded from it when it exists. This allows to
+        resume an analysis in a different process. Dictionary keys in the
+        data (e.g. neo ``Unit`` objects) then need unique ``name``
+        attributes, like for :func:`enable_disk_cache`. If None, the
+        checkpoint only exists in memory.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.key = None
+        self.results = {}
+        self._token = _identity_token
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename, 'rb') as f:
+                    self.key, self.results = pickle.load(f)
+            except Exception:
+                self.key, self.results = None, {} # Damaged file
+
+    def start(self, function, call_args):
+        """ Bind the checkpoint to a call. Stored parts are discarded if
+        they belong to a different call.
+
+        :param function function: The called function.
+        :param dict call_args: All arguments of the call that determine
+            the result.
+        """
+        if self.filename is None:
+            self._token = _identity_token
+        else:
+            self._token = _StableTokens()
+        key = _fingerprint(function, call_args, self._token)
+        if key is None:
+            raise SpykeException('Cannot use checkpoint: Parameters ' +
+                                 'can not be identified!')
+        if key != self.key:
+            self.key = key
+            self.results = {}
+
+    def token(self, obj):
+        """ Return a string that identifies a dictionary key of the data
+        of the current call. Use it to build part identifiers.
+        """
+        return self._token(obj)
+
+    def __contains__(self, part):
+        return part in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def get(self, part):
+        """ Return the stored result of a part.
+        """
+        return self.results[part]
+
+    def add(self, part, result):
+        """ Store the result of a completed part.
+        """
+        self.results[part] = result
+
+    def save(self):
+        """ Write the checkpoint to its file (if it has one).
+        """
+        if self.filename is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((self.key, self.results), f, 2)
+            os.rename(temp_path, self.filename)
+        except (IOError, OSError):
+            _remove_file(temp_path)
+            raise
+
+    def clear(self):
+        """ Remove all stored parts and the checkpoint file.
+        """
+        self.key = None
+        self.results = {}
+        if self.filename is not None:
+            _remove_file(self.filename)
+
+
+class _Unhashable(Exception):
+    """ Raised when a parameter cannot be included in a cache key.
+    """
+    pass
+
+
+def _is_simple(obj):
+    return obj is None or isinstance(obj, (bool, int, long, float,
+                                           basestring))
+
+
+def _identity_token(key):
+    """ Return a string identifying a dictionary key in this process.
+    """
+    if _is_simple(key):
+        return '%s:%r' % (type(key).__name__, key)
+    return 'id:%x' % id(key)
+
+
+class _StableTokens(object):
+    """ Creates strings identifying dictionary keys across processes and
+    collects the keys by token.
+    """
+    def __init__(self):
+        self.keys = {}
+
+    def __call__(self, key):
+        if _is_simple(key):
+            return '%s:%r' % (type(key).__name__, key)
+
+        name = getattr(key, 'name', None)
+        if not _is_simple(name):
+            raise _Unhashable()
+        token = 'name:%s:%r' % (type(key).__name__, name)
+        if self.keys.setdefault(token, key) is not key:
+            raise _Unhashable() # Ambiguous name
+        return token
+
+
+def _update_hash(h, obj, key_token):
+    """ Add the content of ``obj`` to the hash object ``h``.
+    """
+    if obj is None or isinstance(obj, (bool, int, long, float, complex,
+                                       basestring)):
+        h.update('%s:%r;' % (type(obj).__name__, obj))
+    elif isinstance(obj, sp.ndarray):
+        if obj.dtype.hasobject:
+            raise _Unhashable()
+        if isinstance(obj, pq.Quantity):
+            h.update('u:%s;' % obj.dimensionality.string)
+        for attr in ('t_start', 't_stop'):
+            if hasattr(obj, attr):
+                _update_hash(h, getattr(obj, attr), key_token)
+        data = sp.ascontiguousarray(obj)
+        h.update('a:%s%r;' % (data.dtype.str, data.shape))
+        h.update(data.data)
+    elif isinstance(obj, SpikeTrainSet):
+        h.update('set:%s;' % obj.time_unit.dimensionality.string)
+        for attr in ('times', 'offsets', 'unit_index', 't_start', 't_stop'):
+            _update_hash(h, getattr(obj, attr), key_token)
+        h.update(';'.join(key_token(u) for u in obj.units))
+    elif isinstance(obj, dict):
+        h.update('d%d:' % len(obj))
+        for token, value in sorted(((key_token(k), v)
+                                    for k, v in obj.iteritems()),
+                                   key=lambda (t, v): t):
+            h.update(token)
+            _update_hash(h, value, key_token)
+    elif isinstance(obj, (list, tuple)):
+        h.update('l%d:' % len(obj))
+        for value in obj:
+            _update_hash(h, value, key_token)
+    elif inspect.isbuiltin(obj):
+        h.update('f:%s.%s;' % (obj.__module__, obj.__name__))
+    elif inspect.isfunction(obj):
+        # Closures can behave differently with the same code
+        if obj.__closure__:
+            raise _Unhashable()
+        h.update('f:%s.%s:%d;' % (obj.__module__, obj.__name__,
+                                  obj.__code__.co_firstlineno))
+    else:
+        raise _Unhashable()
+
+
+def fingerprint(function, args, kwargs, stable=False):
+    """ Return a cache key for a call of a function or None if the call
+    cannot be cached.
+
+    All parameters of the call (including default values) are part of the
+    key, except for :class:`spykeutils.progress_indicator.ProgressIndicator`
+    and :class:`Checkpoint` objects.
+
+    :param function function: The called function.
+    :param tuple args: Positional arguments of the call.
+    :param dict kwargs: Keyword arguments of the call.
+    :param bool stable: If ``True``, the key is valid across processes
+        and includes the spykeutils version: Dictionary keys are
+        identified by value or by their ``name`` attribute. Otherwise,
+        they are identified by value or object identity.
+    :rtype: str
+    """
+    call_args = inspect.getcallargs(function, *args, **kwargs)
+    if stable:
+        return _fingerprint(function, call_args, _StableTokens())
+    return _fingerprint(function, call_args, _identity_token)
+
+
+def _fingerprint(function, call_args, key_token):
+    h = hashlib.md5()
+    h.update('%s.%s;' % (function.__module__, function.__name__))
+    if isinstance(key_token, _StableTokens):
+        h.update('version:%s;' % __version__)
+    try:
+        for name in sorted(call_args):
+            value = call_args[name]
+            if isinstance(value, (ProgressIndicator, Checkpoint)):
+                continue
+            h.update(name)
+            _update_hash(h, value, key_token)
+    except _Unhashable:
+        return None
+    return h.hexdigest()
+
+
+def _encode(value, arrays, tokens):
+    """ Return a JSON compatible description of a result. Arrays are
+    appended to ``arrays`` and referenced by index. Dictionary keys that
+    are not simple values are referenced by their token in ``tokens``
+    (indexed by object id).
+    """
+    if isinstance(value, sp.ndarray):
+        if value.dtype.hasobject:
+            raise _Unhashable()
+        arrays.append(sp.asarray(value))
+        ret = {'a': len(arrays) - 1}
+        if isinstance(value, pq.Quantity):
+            ret['u'] = value.dimensionality.string
+        return ret
+    if isinstance(value, sp.generic):
+        arrays.append(sp.asarray(value))
+        return {'a': len(arrays) - 1, 's': True}
+    if _is_simple(value):
+        return {'v': value}
+    if isinstance(value, dict):
+        items = []
+        for k, v in value.iteritems():
+            if _is_simple(k):
+                key = {'v': k}
+            elif id(k) in tokens:
+                key = {'k': tokens[id(k)]}
+            else:
+                raise _Unhashable()
+            items.append([key, _encode(v, arrays, tokens)])
+        return {'d': items, 'o': isinstance(value, OrderedDict)}
+    if isinstance(value, (list, tuple)):
+        return {'t' if isinstance(value, tuple) else 'l':
+                [_encode(v, arrays, tokens) for v in value]}
+    raise _Unhashable()
+
+
+def _decode(structure, arrays, keys):
+    """ Reverse :func:`_encode`. ``keys`` is a dictionary of key objects
+    indexed by token.
+    """
+    if 'a' in structure:
+        a = arrays[structure['a']]
+        if structure.get('s'):
+            return a[()]
+        if 'u' in structure:
+            return pq.Quantity(a, str(structure['u']))
+        return a
+    if 'v' in structure:
+        v = structure['v']
+        if isinstance(v, unicode):
+            return str(v)
+        return v
+    if 'd' in structure:
+        ret = OrderedDict() if structure['o'] else {}
+        for k, v in structure['d']:
+            if 'k' in k:
+                key = keys[k['k']]
+            else:
+                key = _decode(k, arrays, keys)
+            ret[key] = _decode(v, arrays, keys)
+        return ret
+    if 't' in structure:
+        return tuple(_decode(v, arrays, keys) for v in structure['t'])
+    return [_decode(v, arrays, keys) for v in structure['l']]
+
+
+def _result_size(value):
+    """ Return the approximate memory size of a result in bytes.
+    """
+    if isinstance(value, sp.ndarray):
+        return value.nbytes + 100
+    if isinstance(value, dict):
+        return sum(_result_size(v) for v in value.itervalues()) + \
+               100 * (len(value) + 1)
+    if isinstance(value, (list, tuple)):
+        return sum(_result_size(v) for v in value) + 50 * (len(value) + 1)
+    return 50
+
+
+def _copy_result(value):
+    """ Return a copy of a result, so that modifications by the caller
+    do not change the cached result. Dictionary keys are not copied.
+    """
+    if isinstance(value, sp.ndarray):
+        return value.copy()
+    if isinstance(value, dict):
+        ret = type(value)()
+        for k, v in value.iteritems():
+            ret[k] = _copy_result(v)
+        return ret
+    if isinstance(value, (list, tuple)):
+        return type(value)(_copy_result(v) for v in value)
+    return value
+
+
+def cached(volatile=None):
+    """ Decorator factory for functions whose results can be cached.
+    The decorated function uses the active caches (see
+    :func:`enable_memory_cache` and :func:`enable_disk_cache`) and behaves
+    unchanged when no cache is active.
+
+    :param func volatile: A function that is called with a dictionary of
+        all call arguments and returns ``True`` if the result of this call
+        must not be cached (e.g. because it is random). Optional.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def inner(*args, **kwargs):
+            memory, disk = _memory_cache, _disk_cache
+            if memory is None and disk is None:
+                return function(*args, **kwargs)
+            call_args = inspect.getcallargs(function, *args, **kwargs)
+            if volatile is not None and volatile(call_args):
+                return function(*args, **kwargs)
+
+            memory_key = disk_key = None
+            if memory is not None:
+                memory_key = _fingerprint(function, call_args,
+                    _identity_token)
+                if memory_key is not None:
+                    try:
+                        return _copy_result(memory.get(memory_key))
+                    except KeyError:
+                        pass
+
+            if disk is not None:
+                tokens = _StableTokens()
+                disk_key = _fingerprint(function, call_args, tokens)
+                if disk_key is not None:
+                    try:
+                        result = disk.get(disk_key, tokens.keys)
+                    except KeyError:
+                        pass
+                    else:
+                        if memory_key is not None:
+                            memory.put(memory_key, _copy_result(result))
+                        return result
+
+            result = function(*args, **kwargs)
+            if memory_key is not None:
+                memory.put(memory_key, _copy_result(result))
+            if disk_key is not None:
+                disk.put(disk_key, result, tokens.keys)
+            return result
+        return inner
+    return decorator
+
+
+def unseeded_bootstrap(call_args):
+    """ Volatility test for functions with bootstrap intervals: Results
+    are random if bootstrap samples are requested without a seed.
+    """
+    return call_args.get('bootstrap_samples', 0) > 0 and \
+           not isinstance(call_args.get('random_state'), (int, long))
@@ -0,0 +1,39 @@
+""" Helpers for random sampling shared by the analysis functions.
+"""
+
+import scipy as sp
+
+
+def random_state(seed):
+    """ Return a ``RandomState`` object for a seed, an existing
+    ``RandomState`` object or None.
+
+    :param seed: Seed (int), ``RandomState`` object or None (a new
+        unseeded ``RandomState`` is created).
+    :rtype: RandomState
+    """
+    if isinstance(seed, sp.random.RandomState):
+        return seed
+    return sp.random.RandomState(seed)
+
+
+def sample_indices(rng, n, k):
+    """ Return ``k`` distinct random indices smaller than ``n`` in
+    ascending order. Each subset is equally likely. The time needed
+    depends only on ``k``, not on ``n``: indices are drawn with
+    replacement and duplicates are drawn again.
+
+    :param RandomState rng: The random number generator.
+    :param int n: The size of the population.
+    :param int k: The number of indices to draw (at most ``n``).
+    :rtype: ndarray
+    """
+    if k > n:
+        raise ValueError('Cannot draw more indices than population size!')
+    if 2 * k > n: # Few duplicates to reject would be left, n is small
+        return sp.sort(rng.permutation(n)[:k])
+    index = sp.unique(rng.randint(0, n, k))
+    while len(index) < k:
+        index = sp.unique(sp.concatenate(
+            (index, rng.randint(0, n, k - len(index)))))
+    return index
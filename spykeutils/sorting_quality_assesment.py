@@ -6,17 +6,31 @@ from __future__ import division
 
 import scipy as sp
 from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
+from scipy.linalg import cholesky, solve_triangular
+from scipy.special import chdtrc
+from scipy.stats import norm
+from multiprocessing.pool import ThreadPool
+import weakref
 import quantities as pq
 
-from spykeutils.progress_indicator import ProgressIndicator
+from spykeutils.progress_indicator import ProgressIndicator, CancelException
+from spykeutils.spike_train_set import as_spike_train_set
+from spykeutils import conversions
+from spykeutils import sampling
+from spykeutils.result_cache import ResultCache
+
+_whitening_factors = ResultCache(64 * 1024 * 1024)
 
 def get_refperiod_violations(spike_trains, refperiod,
                              progress=ProgressIndicator()):
     """ Return the refractory period violations in the given spike trains
     for the specified refractory period.
 
-    :param dict spike_trains: Dictionary of lists of `SpikeTrain` objects,
+    :param spike_trains: Dictionary of lists of `SpikeTrain` objects,
         indexed by unit.
+    :type spike_trains: dict or
+        :class:`spykeutils.spike_train_set.SpikeTrainSet`
     :param refperiod: The refractory period (time).
     :type refperiod: Quantity scalar
     :param progress: A `ProgressIndicator` object for the operation.
@@ -29,82 +43,254 @@ def get_refperiod_violations(spike_trains, refperiod,
           `refperiod`) for each spike train.
     :rtype: int, dict """
 
+    total_violations, _, train_set, indices, bounds = \
+        get_refperiod_violation_indices(spike_trains, refperiod)
+
+    units = refperiod.units
+    violation_times = train_set.times[indices]
+    violations = {}
+    for i, u in enumerate(train_set.units):
+        violations[u] = [violation_times[bounds[r]:bounds[r + 1]] * units
+                         for r in train_set.unit_trains(i)]
+    progress.step(train_set.num_trains)
+
+    return total_violations, violations
+
+def get_refperiod_violation_indices(spike_trains, refperiod):
+    """ Return the refractory period violations in the given spike trains
+    as indices into a :class:`spykeutils.spike_train_set.SpikeTrainSet`.
+    All spike trains are processed at once: The interspike intervals are
+    computed with a single difference over the whole set, excluding
+    intervals that cross spike train borders.
+
+    :param spike_trains: Dictionary of lists of `SpikeTrain` objects,
+        indexed by unit.
+    :type spike_trains: dict or
+        :class:`spykeutils.spike_train_set.SpikeTrainSet`
+    :param refperiod: The refractory period (time).
+    :type refperiod: Quantity scalar
+    :returns: Five values:
+
+        * The total number of violations.
+        * A dictionary (with the same indices as `spike_trains`) of
+          the number of violations for each unit.
+        * The spike trains as sorted
+          :class:`spykeutils.spike_train_set.SpikeTrainSet` with the same
+          time unit as `refperiod`.
+        * An array of indices into the ``times`` array of the set. Each
+          index refers to the first spike of a violating pair.
+        * An array of boundaries: The violations of spike train ``i`` in
+          the set are ``indices[bounds[i]:bounds[i + 1]]``.
+    :rtype: int, dict, :class:`spykeutils.spike_train_set.SpikeTrainSet`,
+        ndarray, ndarray
+    """
     if type(refperiod) != pq.Quantity or \
        refperiod.simplified.dimensionality != pq.s.dimensionality:
         raise ValueError('refperiod must be a time quantity!')
 
-    total_violations = 0
-    violations = {}
-    for u, tL in spike_trains.iteritems():
-        violations[u] = []
-        for i,t in enumerate(tL):
-            st = t.copy()
-            st.sort()
-            isi = sp.diff(st)
+    train_set = as_spike_train_set(spike_trains, refperiod.units).sorted()
 
-            violations[u].append(st[isi < refperiod].rescale(refperiod.units))
-            total_violations += len(violations[u][i])
+    indices = sp.flatnonzero(_interspike_intervals(train_set) <
+                             float(refperiod))
+    bounds = sp.searchsorted(indices, train_set.offsets)
 
-            progress.step()
+    per_unit = sp.bincount(train_set.unit_index, sp.diff(bounds),
+                           len(train_set.units)).astype(int)
+    unit_violations = dict(zip(train_set.units, per_unit))
 
-    return total_violations, violations
+    return len(indices), unit_violations, train_set, indices, bounds
+
+def _interspike_intervals(train_set):
+    """ Return the differences between all consecutive spikes of a sorted
+    :class:`spykeutils.spike_train_set.SpikeTrainSet`. Differences between
+    the last spike of a train and the first spike of the next train are
+    not interspike intervals, they are set to infinity.
+    """
+    isi = sp.diff(train_set.times)
+    borders = train_set.offsets[1:-1] - 1
+    isi[borders[(borders >= 0) & (borders < len(isi))]] = sp.inf
+    return isi
 
 def calculate_refperiod_fp(num_spikes, refperiod, violations, total_time):
     """ Return the rate of false positives calculated from refractory period
     calculations for each unit. The equation used is described in
     (Hill et al. The Journal of Neuroscience. 2011)
 
-    :param dict num_spikes: Dictionary of total number of spikes,
-        indexed by unit.
+    Instead of dictionaries, arrays of spike and violation counts (e.g. a
+    units x sessions matrix) can be passed. All rates are then computed
+    at once and returned as array.
+
+    :param num_spikes: Dictionary of total number of spikes, indexed by
+        unit, or array of spike counts.
+    :type num_spikes: dict or ndarray
     :param refperiod: The refractory period (time). If the spike sorting
         algorithm includes a censored period (a time after a spike during
         which no new spikes can be found), subtract it from the refractory
         period before passing it to this function.
     :type refperiod: Quantity scalar
-    :param dict violations: Dictionary of total number of violations,
-        indexed by unit.
+    :param violations: Dictionary of total number of violations,
+        indexed by unit, or array of violation counts with the same shape
+        as ``num_spikes``.
+    :type violations: dict or ndarray
+    :param total_time: The total recording time. When using arrays, this
+        can also be an array that is broadcast against ``num_spikes``
+        (e.g. one time per session).
+    :type total_time: Quantity scalar or Quantity 1D
 
-    :returns: A dictionary of false positive rates indexed by unit.
+    :returns: A dictionary of false positive rates indexed by unit (or
+        an array if arrays were passed).
         Note that values above 0.5 can not be directly interpreted as a
         false positive rate! These very high values can e.g. indicate
         that the chosen refractory period was too large.
+    :rtype: dict or ndarray
     """
     if type(refperiod) != pq.Quantity or \
        refperiod.simplified.dimensionality != pq.s.dimensionality:
         raise ValueError('refperiod must be a time quantity!')
 
-    fp = {}
-    factor = total_time / (2 * refperiod)
-    for u,n in num_spikes.iteritems():
-        if n == 0:
-            fp[u] = 0
-            continue
-        zw = (violations[u] * factor / n**2).simplified
+    factor = sp.asarray((total_time / (2 * refperiod)).simplified)
 
-        if zw > 0.25:
-            fp[u] = 0.5 + sp.sqrt(0.25 - zw).imag
-            continue
-        fp[u] = 0.5 - sp.sqrt(0.25 - zw)
+    if not isinstance(num_spikes, dict):
+        return _refperiod_fp(num_spikes,
+                             sp.asarray(violations, dtype=sp.float64),
+                             factor)
+
+    units = num_spikes.keys()
+    fp = _refperiod_fp([num_spikes[u] for u in units],
+                       sp.array([violations[u] for u in units],
+                                dtype=sp.float64), factor)
+    return dict(zip(units, fp))
+
+def _refperiod_fp(num_spikes, violations, factor):
+    """ Return false positive rates from refractory period violations
+    for arrays of spike counts and violation counts. ``factor`` is the
+    total time divided by twice the refractory period.
+    """
+    num_spikes = sp.asarray(num_spikes, dtype=sp.float64)
+    with sp.errstate(divide='ignore', invalid='ignore'):
+        zw = violations * factor / num_spikes**2
+        root = sp.sqrt(sp.absolute(0.25 - zw))
+        fp = sp.where(zw > 0.25, 0.5 + root, 0.5 - root)
+    return sp.where(num_spikes == 0, 0.0, fp)
+
+def refperiod_violation_curve(spike_trains, refperiods, total_time=None,
+                              progress=ProgressIndicator()):
+    """ Return the number of refractory period violations and the
+    resulting false positive rates (see :func:`calculate_refperiod_fp`)
+    for many candidate refractory periods. The interspike intervals of each
+    unit are computed and sorted once, the violation counts for all
+    candidates are then read from the sorted intervals. Evaluating many
+    candidates costs about the same as evaluating one.
+
+    :param spike_trains: Dictionary of lists of `SpikeTrain` objects,
+        indexed by unit.
+    :type spike_trains: dict or
+        :class:`spykeutils.spike_train_set.SpikeTrainSet`
+    :param refperiods: The candidate refractory periods. If the spike
+        sorting algorithm includes a censored period, the false positive
+        rates are only valid if it is subtracted from the candidates (see
+        :func:`calculate_refperiod_fp`).
+    :type refperiods: Quantity 1D
+    :param total_time: The total recording time used for the false
+        positive rates. If None, the summed length of all spike trains of
+        each unit is used.
+    :type total_time: Quantity scalar
+    :param progress: A `ProgressIndicator` object for the operation.
+    :type progress: :class:`spykeutils.progress_indicator.ProgressIndicator`
+    :returns: Two values:
+
+        * A dictionary (with the same indices as `spike_trains`) of
+          arrays with the number of violations for each candidate.
+        * A dictionary (with the same indices as `spike_trains`) of
+          arrays with the false positive rate for each candidate.
+    :rtype: dict, dict
+    """
+    if not isinstance(refperiods, pq.Quantity) or \
+       refperiods.simplified.dimensionality != pq.s.dimensionality:
+        raise ValueError('refperiods must be a time quantity!')
+
+    units = refperiods.units
+    refs = sp.atleast_1d(conversions.magnitude(refperiods, units))
+    train_set = as_spike_train_set(spike_trains, units).sorted()
+    num_units = len(train_set.units)
+
+    # Only intervals shorter than the longest candidate are needed
+    isi = _interspike_intervals(train_set)
+    short = sp.flatnonzero(isi < refs.max())
+    spike_unit = sp.repeat(train_set.unit_index, train_set.spike_counts())
+    isi_unit = spike_unit[short]
+    order = sp.lexsort((isi[short], isi_unit))
+    isi = isi[short][order]
+    unit_bounds = sp.searchsorted(isi_unit[order], sp.arange(num_units + 1))
 
-    return fp
+    num_spikes = sp.bincount(train_set.unit_index,
+                             train_set.spike_counts(), num_units)
+    if total_time is None:
+        time = sp.bincount(train_set.unit_index,
+                           train_set.t_stop - train_set.t_start, num_units)
+    else:
+        time = sp.ones(num_units) * conversions.scalar(total_time, units)
 
-def calculate_overlap_fp_fn(templates, spikes):
+    progress.set_ticks(num_units)
+    counts = {}
+    fp = {}
+    for i, u in enumerate(train_set.units):
+        counts[u] = sp.searchsorted(isi[unit_bounds[i]:unit_bounds[i + 1]],
+                                    refs, 'left')
+        fp[u] = _refperiod_fp(num_spikes[i], counts[u],
+                              time[i] / (2 * refs))
+        progress.step()
+
+    return counts, fp
+
+def calculate_overlap_fp_fn(templates, spikes, chunk_size=None, n_jobs=1,
+                            max_distance=None, progress=ProgressIndicator(),
+                            checkpoint=None):
     """ Return a dict of tuples (False positive rate, false negative rate)
     indexed by unit. Details for the calculation can be found in
     (Hill et al. The Journal of Neuroscience. 2011). This function works on
     prewhitened data, which means it assumes that all clusters have a uniform
     normal distribution. Data can be prewhitened using the noise covariance
-    matrix.
+    matrix with :func:`whitening_factor` and :func:`whiten`.
 
     The calculation for total false positive and false negative rates does
     not follow (Hill et al. The Journal of Neuroscience. 2011), where a
     simple addition of pairwise probabilities is proposed. Instead, the
     total error probabilities are estimated using all clusters at once.
+    Posteriors are computed and normalized in log space, so spikes far
+    away from all templates do not lead to numerical problems.
 
     :param dict templates: Dictionary of prewhitened templates (cluster means)
         as numpy arrays for all units.
     :param dict spikes: Dictionary of lists of prewhitened spike waveforms
-        as numpy arrays for all units.
+        as numpy arrays for all units. Instead of lists, two-dimensional
+        arrays (spikes x dimensions) can be used, including memory-mapped
+        arrays (e.g. from :func:`numpy.load` with ``mmap_mode='r'``).
+    :param int chunk_size: If given, spikes are processed in chunks of
+        at most this many spikes per unit. Only the current chunk is
+        converted and held in memory together with its posteriors, so
+        memory use does not depend on the size of the clusters when
+        ``spikes`` contains memory-mapped arrays. Default: None, all
+        spikes of a unit are processed at once.
+    :param int n_jobs: Number of threads that process the spikes of
+        different units in parallel. The results are identical to
+        processing with one thread. Default: 1
+    :param float max_distance: If given, only pairs of units with a
+        template distance of at most this value (in units of the noise
+        standard deviation) are considered. Neighbouring templates are
+        found with a KD-tree and the posterior of each spike is only
+        evaluated for templates that neighbour its unit. Pairwise values
+        of other pairs are zero and are not included in the results.
+        :func:`calculate_overlap_truncation_bound` bounds the resulting
+        error of the false positive rates. Default: None, all pairs are
+        considered.
+    :param progress: Set this parameter to report progress.
+    :type progress: :class:`spykeutils.progress_indicator.ProgressIndicator`
+    :param checkpoint: If given, the posterior sums of each unit are
+        stored in this checkpoint when they are complete. If the
+        operation is cancelled, they are kept and a later call with the
+        same checkpoint only processes the remaining units.
+    :type checkpoint: :class:`spykeutils.result_cache.Checkpoint`
     :returns: Two values:
 
         * A dictionary (indexed by unit of total
@@ -113,87 +299,850 @@ def calculate_overlap_fp_fn(templates, spikes):
           of pairwise (false positives, false negatives) tuples.
     :rtype: dict, dict
     """
-    units = templates.keys()
-    prior = {}
-    total_spikes = 0
-    for u, mean in templates.iteritems():
-        total_spikes += len(spikes[u])
-
-    false_positive = {}
-    false_negative = {}
-    for u, s in spikes.iteritems():
-        prior[u] = len(s) / total_spikes
-        false_positive[u] = 0
-        false_negative[u] = 0
-
-    # Arrays of unnormalized posteriors (likelihood times prior)
-    # for all units
-    posterior = {}
-
-    # Calculate posteriors
-    for u1 in units[:]:
-        if not spikes[u1]:
-            units.remove(u1)
-            continue
-        posterior[u1] = {}
-        for u2, mean in templates.iteritems():
-            llh = _multi_norm(sp.array(spikes[u1]), mean)
-            posterior[u1][u2] = llh*prior[u2]
+    if checkpoint is not None:
+        checkpoint.start(calculate_overlap_fp_fn, {'templates': templates,
+            'spikes': spikes, 'max_distance': max_distance})
 
-    # Calculate pairwise false positives/negatives
-    singles = {u:{} for u in units}
+    units = [u for u in templates if spikes[u] is not None and
+             len(spikes[u])]
+    counts = sp.array([len(spikes[u]) for u in units], dtype=sp.float64)
+    log_prior = sp.log(counts / counts.sum()) if units else counts
+    means = sp.array([templates[u] for u in units], dtype=sp.float64)
+
+    # Sums of normalized posteriors and of pairwise posteriors, indexed by
+    # (source unit, template unit)
+    posterior_sums = sp.zeros((len(units), len(units)))
+    pair_sums = sp.zeros((len(units), len(units)))
+    progress.set_ticks(len(units))
+    progress.set_status('Calculating posteriors')
+
+    neighbours = _template_neighbours(means, max_distance)
+
+    def unit_sums(i):
+        if checkpoint is not None and \
+                checkpoint.token(units[i]) in checkpoint:
+            return checkpoint.get(checkpoint.token(units[i]))
+        columns = neighbours[i]
+        post, pairs = _unit_posterior_sums(
+            spikes[units[i]], means[columns], log_prior[columns],
+            sp.searchsorted(columns, i), chunk_size)
+        post_row = sp.zeros(len(units))
+        post_row[columns] = post
+        pair_row = sp.zeros(len(units))
+        pair_row[columns] = pairs
+        return post_row, pair_row
+
+    pool = None
+    if n_jobs > 1 and len(units) > 1:
+        pool = ThreadPool(min(n_jobs, len(units)))
+        results = pool.imap(unit_sums, xrange(len(units)))
+    else:
+        results = (unit_sums(i) for i in xrange(len(units)))
+    try:
+        for i, sums in enumerate(results):
+            posterior_sums[i], pair_sums[i] = sums
+            if checkpoint is not None:
+                checkpoint.add(checkpoint.token(units[i]), sums)
+            progress.step()
+    except CancelException:
+        if checkpoint is not None:
+            checkpoint.save()
+        raise
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if checkpoint is not None:
+        checkpoint.clear()
+
+    # Pairwise false positives/negatives
+    singles = {u: {} for u in units}
     for i, u1 in enumerate(units):
-        u1 = units[i]
-        for u2 in units[i+1:]:
-            f1 = sp.sum(posterior[u1][u2] /
-                        (posterior[u1][u1] + posterior[u1][u2]),
-                dtype=sp.double)
-            #false_positive[u1] += f1
-            #false_negative[u2] += f1
-
-            f2 = sp.sum(posterior[u2][u1] /
-                        (posterior[u2][u1] + posterior[u2][u2]),
-                dtype=sp.double)
-            #false_negative[u1] += f2
-            #false_positive[u2] += f1
-
-            singles[u1][u2] = (f1 / len(spikes[u1]) if spikes[u1] else 0,
-                               f2 / len(spikes[u1]) if spikes[u1] else 0)
-            singles[u2][u1] = (f2 / len(spikes[u2]) if spikes[u2] else 0,
-                               f1 / len(spikes[u2]) if spikes[u2] else 0)
-
-    # Calculate complete false positives/negatives with extended bayes
-    for u1 in units:
-        numerator = posterior[u1][u1]
-        normalizer = sum(posterior[u1][u2] for u2 in units)
-        false_positive[u1] = sp.sum((normalizer-numerator)/normalizer)
-
-        other_units = units[:]
-        other_units.remove(u1)
-        numerator = sp.vstack((posterior[u][u1] for u in other_units))
-        normalizer = sp.vstack(sum(posterior[u][u2] for u2 in units) for u in other_units)
-        false_negative[u1] = sp.sum(numerator/normalizer)
-
-    # Prepare return values, convert sums to means
-    totals = {}
-    for u,fp in false_positive.iteritems():
-        fn = false_negative[u]
-        if not spikes[u]:
-            totals[u] = (0,0)
-        else:
-            num = len(spikes[u])
-            totals[u] = (fp / num, fn / num)
+        for j in neighbours[i][neighbours[i] > i]:
+            u2 = units[j]
+            f1 = pair_sums[i, j]
+            f2 = pair_sums[j, i]
+            singles[u1][u2] = (f1 / counts[i], f2 / counts[i])
+            singles[u2][u1] = (f2 / counts[j], f1 / counts[j])
+
+    # Complete false positives/negatives with extended bayes, converted
+    # from sums to means
+    off_diagonal = posterior_sums * (1 - sp.eye(len(units)))
+    false_positive = off_diagonal.sum(axis=1) / counts
+    false_negative = off_diagonal.sum(axis=0) / counts
+
+    totals = {u: (0, 0) for u in spikes}
+    for i, u in enumerate(units):
+        totals[u] = (false_positive[i], false_negative[i])
     return totals, singles
 
-def _multi_norm(x, mean):
-    """ Evaluate pdf of multivariate normal distribution with a mean
-        at rows of x with high precision.
+def calculate_overlap_truncation_bound(templates, spikes, max_distance,
+                                       chunk_size=None):
+    """ Return upper bounds for the error of the total false positive
+    rates of :func:`calculate_overlap_fp_fn` with ``max_distance``. For
+    each spike, the posterior mass of the ignored templates is bounded
+    using only the distance of the spike to its own template, since the
+    ignored templates are at least ``max_distance`` away from it.
+
+    :param dict templates: Dictionary of prewhitened templates (cluster
+        means) as numpy arrays for all units.
+    :param dict spikes: Dictionary of lists or two-dimensional arrays of
+        prewhitened spike waveforms for all units, as for
+        :func:`calculate_overlap_fp_fn`.
+    :param float max_distance: The ``max_distance`` parameter used with
+        :func:`calculate_overlap_fp_fn`.
+    :param int chunk_size: If given, spikes are processed in chunks of
+        at most this many spikes per unit. Default: None, all spikes of a
+        unit are processed at once.
+    :returns: A dictionary (indexed by unit) of upper bounds for the mean
+        posterior mass per spike that was dropped by ignoring distant
+        templates. The false positive rate of a unit is underestimated by
+        at most this value.
+    :rtype: dict
+    """
+    units = [u for u in templates if spikes[u] is not None and
+             len(spikes[u])]
+    counts = sp.array([len(spikes[u]) for u in units], dtype=sp.float64)
+    means = sp.array([templates[u] for u in units], dtype=sp.float64)
+    neighbours = _template_neighbours(means, max_distance)
+
+    bounds = {}
+    for i, u in enumerate(units):
+        dropped_prior = (counts.sum() - counts[neighbours[i]].sum()) / \
+                        counts.sum()
+        dropped = 0.0
+        if dropped_prior > 0:
+            # Dropped templates are at least max_distance away from the
+            # own template, so they are at least max_distance - r away
+            # from a spike with distance r to its own template.
+            step = chunk_size or len(spikes[u])
+            log_own = sp.log(counts[i] / counts.sum())
+            for start in xrange(0, len(spikes[u]), step):
+                x = sp.asarray(spikes[u][start:start + step],
+                               dtype=sp.float64)
+                r = sp.sqrt(cdist(x, means[i:i + 1], 'sqeuclidean')[:, 0])
+                gap = sp.maximum(max_distance - r, 0)
+                log_bound = sp.log(dropped_prior) - log_own + \
+                            0.5 * (r * r - gap * gap)
+                dropped += sp.exp(sp.minimum(log_bound, 0)).sum()
+        bounds[u] = dropped / counts[i]
+    return bounds
+
+def _template_neighbours(means, max_distance):
+    """ Return a list with the sorted indices of the templates within
+    ``max_distance`` of each template (all templates if ``max_distance``
+    is None).
+    """
+    if max_distance is None or not len(means):
+        return [sp.arange(len(means))] * len(means)
+    tree = cKDTree(means)
+    return [sp.array(sorted(n), dtype=int)
+            for n in tree.query_ball_point(means, max_distance)]
+
+def _unit_posterior_sums(spikes, means, log_prior, index, chunk_size):
+    """ Return the sums of :func:`_posterior_sums` over all spikes of one
+    unit, processed in chunks of ``chunk_size`` spikes.
+    """
+    posterior_sums = sp.zeros(len(means))
+    pair_sums = sp.zeros(len(means))
+    step = chunk_size or len(spikes)
+    for start in xrange(0, len(spikes), step):
+        x = sp.asarray(spikes[start:start + step], dtype=sp.float64)
+        posterior, pairs = _posterior_sums(x, means, log_prior, index)
+        posterior_sums += posterior
+        pair_sums += pairs
+    return posterior_sums, pair_sums
+
+def _posterior_sums(x, means, log_prior, index):
+    """ Return the sums of normalized posteriors and of pairwise
+    posteriors for the spikes of one unit.
+
+    Likelihoods are evaluated in log space for all templates with a
+    single distance computation. The normalization constant of the normal
+    distribution is omitted since only posterior ratios are used.
+
+    :param ndarray x: Prewhitened spikes of the unit (spikes x dimensions).
+    :param ndarray means: Stacked templates (units x dimensions).
+    :param ndarray log_prior: Logarithm of the prior for each unit.
+    :param int index: Index of the unit the spikes belong to.
+    :returns: Two values:
+
+        * Sums of posteriors normalized over all units, indexed by
+          template.
+        * Sums of posteriors normalized over the pair of the spike's
+          own unit and the template unit, indexed by template.
+    """
+    sq_dist = cdist(x, means, 'sqeuclidean')
+    log_post = sq_dist * -0.5 + log_prior
+    posterior = _normalized_posterior_sums(log_post)
+
+    own = log_post[:, index][:, sp.newaxis]
+    pairs = sp.exp(log_post - sp.logaddexp(own, log_post)).sum(axis=0)
+    return posterior, pairs
+
+def approximate_overlap_fp_fn(templates, spikes, max_samples=1000,
+                              confidence=0.95, random_state=None,
+                              progress=ProgressIndicator()):
+    """ Estimate the results of :func:`calculate_overlap_fp_fn` from a
+    random subsample of at most ``max_samples`` spikes per unit. The
+    runtime depends on the number of units, but not on the number of
+    spikes in large clusters.
+
+    The subsample is stratified by unit: spikes are drawn without
+    replacement from each unit separately and the unit priors use the
+    full spike counts. Confidence intervals are computed with a normal
+    approximation of the stratified estimate (including the finite
+    population correction, so units with at most ``max_samples`` spikes
+    do not add uncertainty).
+
+    :param dict templates: Dictionary of prewhitened templates (cluster means)
+        as numpy arrays for all units.
+    :param dict spikes: Dictionary of lists of prewhitened spike waveforms
+        as numpy arrays for all units. Instead of lists, two-dimensional
+        arrays (spikes x dimensions) can be used, including memory-mapped
+        arrays.
+    :param int max_samples: The maximum number of spikes used per unit.
+    :param float confidence: The confidence level of the intervals.
+    :param random_state: Seed (int) or ``RandomState`` object used to
+        draw the subsamples. If None, a new unseeded ``RandomState`` is
+        used.
+    :param progress: Set this parameter to report progress.
+    :type progress: :class:`spykeutils.progress_indicator.ProgressIndicator`
+    :returns: Four values:
+
+        * A dictionary (indexed by unit of total
+          (false positives, false negatives) tuples.
+        * A dictionary of dictionaries, both indexed by units,
+          of pairwise (false positives, false negatives) tuples.
+        * A dictionary (indexed by unit) of confidence intervals for the
+          totals: ((false positive lower, false positive upper),
+          (false negative lower, false negative upper)) tuples.
+        * A dictionary of dictionaries, both indexed by units, of
+          confidence intervals for the pairwise values in the same
+          format.
+    :rtype: dict, dict, dict, dict
+    """
+    units = [u for u in templates if spikes[u] is not None and
+             len(spikes[u])]
+    counts = sp.array([len(spikes[u]) for u in units], dtype=sp.float64)
+    log_prior = sp.log(counts / counts.sum()) if units else counts
+    means = sp.array([templates[u] for u in units], dtype=sp.float64)
+    rng = sampling.random_state(random_state)
+    progress.set_ticks(len(units))
+    progress.set_status('Calculating posteriors')
+
+    # Means and variances of per-spike values in each unit subsample,
+    # indexed by (source unit, template unit)
+    post_mean = sp.zeros((len(units), len(units)))
+    post_var = sp.zeros((len(units), len(units)))
+    pair_mean = sp.zeros((len(units), len(units)))
+    pair_var = sp.zeros((len(units), len(units)))
+    fp_mean = sp.zeros(len(units))
+    fp_var = sp.zeros(len(units))
+    # Factors for the variance of a subsample mean
+    mean_var = sp.zeros(len(units))
+    for i, u in enumerate(units):
+        num = min(max_samples, len(spikes[u]))
+        index = sampling.sample_indices(rng, len(spikes[u]), num)
+        if isinstance(spikes[u], list):
+            x = sp.array([spikes[u][k] for k in index], dtype=sp.float64)
+        else:
+            x = sp.asarray(spikes[u][index], dtype=sp.float64)
+        x = x.reshape(num, -1)
+        if num > 1:
+            mean_var[i] = (1 - num / counts[i]) / num
+
+        log_post = cdist(x, means, 'sqeuclidean') * -0.5 + log_prior
+        posterior = _normalized_posteriors(log_post)
+        own = log_post[:, i][:, sp.newaxis]
+        pairs = sp.exp(log_post - sp.logaddexp(own, log_post))
+        posterior[:, i] = 0
+        false_positive = posterior.sum(axis=1)
+
+        ddof = 1 if num > 1 else 0
+        post_mean[i] = posterior.mean(axis=0)
+        post_var[i] = posterior.var(axis=0, ddof=ddof)
+        pair_mean[i] = pairs.mean(axis=0)
+        pair_var[i] = pairs.var(axis=0, ddof=ddof)
+        fp_mean[i] = false_positive.mean()
+        fp_var[i] = false_positive.var(ddof=ddof)
+        progress.step()
+
+    z = norm.ppf(0.5 + confidence / 2.0)
+
+    def interval(value, variance):
+        half = z * sp.sqrt(variance)
+        return max(value - half, 0.0), min(value + half, 1.0)
+
+    # Totals: false negatives of a unit are estimated from all strata
+    false_negative = (counts[:, sp.newaxis] * post_mean).sum(axis=0) / counts
+    fn_var = (counts[:, sp.newaxis] ** 2 * mean_var[:, sp.newaxis] *
+              post_var).sum(axis=0) / counts ** 2
+    totals = {u: (0, 0) for u in spikes}
+    intervals = {u: ((0, 0), (0, 0)) for u in spikes}
+    for i, u in enumerate(units):
+        totals[u] = (fp_mean[i], false_negative[i])
+        intervals[u] = (interval(fp_mean[i], fp_var[i] * mean_var[i]),
+                        interval(false_negative[i], fn_var[i]))
+
+    # Pairwise values
+    singles = {u: {} for u in units}
+    single_intervals = {u: {} for u in units}
+    for i, u1 in enumerate(units):
+        for j, u2 in enumerate(units):
+            if i == j:
+                continue
+            ratio = counts[j] / counts[i]
+            fp = pair_mean[i, j]
+            fn = pair_mean[j, i] * ratio
+            singles[u1][u2] = (fp, fn)
+            single_intervals[u1][u2] = (
+                interval(fp, pair_var[i, j] * mean_var[i]),
+                interval(fn, pair_var[j, i] * mean_var[j] * ratio ** 2))
+
+    return totals, singles, intervals, single_intervals
+
+def calculate_isolation_metrics(spikes, chunk_size=10000,
+                                progress=ProgressIndicator()):
+    """ Return isolation distance, L-ratio and silhouette value for all
+    units. The mean and covariance of each cluster is computed once and
+    the Mahalanobis distances of each spike to all clusters are then
+    evaluated together in chunks, so all metrics are computed in the same
+    pass over the spikes.
+
+    * The isolation distance of a unit is the squared Mahalanobis
+      distance from the unit's cluster of the n-th closest spike of other
+      units, where n is the number of spikes of the unit (Harris et al.
+      Neuron. 2001). It is NaN if there are fewer spikes of other units.
+    * The L-ratio is the sum of chi-square tail probabilities of the
+      squared Mahalanobis distances of all spikes of other units, divided
+      by the number of spikes of the unit (Schmitzer-Torbert et al.
+      Neuroscience. 2005).
+    * The silhouette value is the mean silhouette of the unit's spikes.
+      It is computed from the Mahalanobis distances to cluster means
+      instead of mean pairwise distances: the silhouette of a spike is
+      (b - a) / max(a, b), where a is the distance to its own cluster and
+      b is the smallest distance to another cluster.
+
+    Clusters with fewer spikes than the number of dimensions + 1 have no
+    valid covariance, all their metrics are NaN. Their spikes are still
+    used for the metrics of other units.
+
+    :param dict spikes: Dictionary of lists of spike features or waveforms
+        as numpy arrays for all units. Instead of lists, two-dimensional
+        arrays (spikes x dimensions) can be used, including memory-mapped
+        arrays.
+    :param int chunk_size: The maximum number of spikes processed at once.
+    :param progress: Set this parameter to report progress.
+    :type progress: :class:`spykeutils.progress_indicator.ProgressIndicator`
+    :returns: Three dictionaries indexed by unit: isolation distances,
+        L-ratios and silhouette values.
+    :rtype: dict, dict, dict
+    """
+    units = [u for u in spikes if spikes[u] is not None and len(spikes[u])]
+    progress.set_ticks(2 * len(units))
+    progress.set_status('Calculating cluster statistics')
+
+    # Cluster means and inverse Cholesky factors of cluster covariances
+    counts = sp.array([len(spikes[u]) for u in units])
+    dims = sp.asarray(spikes[units[0]][0]).size if units else 0
+    means = []
+    inv_factors = []
+    for u in units:
+        n, mean, scatter = 0, 0, 0
+        for start in xrange(0, len(spikes[u]), chunk_size):
+            x = sp.asarray(spikes[u][start:start + chunk_size],
+                           dtype=sp.float64)
+            n, mean, scatter = _merge_scatter(n, mean, scatter,
+                                              x.reshape(len(x), -1))
+        if len(mean) != dims:
+            raise ValueError('All spikes need the same number of dimensions!')
+        means.append(mean)
+        if n > dims:
+            factor = cholesky(scatter / (n - 1), lower=True)
+            inv_factors.append(
+                solve_triangular(factor, sp.eye(dims), lower=True))
+        else:
+            inv_factors.append(None)
+        progress.step()
+    valid = sp.array([w is not None for w in inv_factors], dtype=bool)
+
+    progress.set_status('Calculating isolation metrics')
+    l_sums = sp.zeros(len(units))
+    silhouette_sums = sp.zeros(len(units))
+    # Smallest distances of spikes from other units for each cluster
+    nearest = [sp.zeros(0) for _ in units]
+    thresholds = sp.empty(len(units))
+    thresholds.fill(sp.inf)
+    for i, u in enumerate(units):
+        others = sp.arange(len(units)) != i
+        for start in xrange(0, counts[i], chunk_size):
+            x = sp.asarray(spikes[u][start:start + chunk_size],
+                           dtype=sp.float64)
+            x = x.reshape(len(x), -1)
+            sq_dist = sp.empty((len(x), len(units)))
+            sq_dist.fill(sp.inf)
+            for k in sp.flatnonzero(valid):
+                y = sp.dot(x - means[k], inv_factors[k].T)
+                sq_dist[:, k] = (y * y).sum(axis=1)
+
+            l_sums[others] += chdtrc(dims, sq_dist[:, others]).sum(axis=0)
+            for k in sp.flatnonzero(valid & others):
+                d = sq_dist[:, k]
+                nearest[k] = _smallest(sp.concatenate(
+                    (nearest[k], d[d < thresholds[k]])), counts[k])
+                if len(nearest[k]) == counts[k]:
+                    thresholds[k] = nearest[k].max()
+            if valid[i] and (valid & others).any():
+                a = sp.sqrt(sq_dist[:, i])
+                b = sp.sqrt(sq_dist[:, others].min(axis=1))
+                silhouette_sums[i] += ((b - a) / sp.maximum(a, b)).sum()
+            else:
+                silhouette_sums[i] = sp.nan
+        progress.step()
+
+    isolation = {}
+    l_ratio = {}
+    silhouette = {}
+    for i, u in enumerate(units):
+        if not valid[i]:
+            isolation[u] = l_ratio[u] = silhouette[u] = sp.nan
+            continue
+        if len(nearest[i]) < counts[i]:
+            isolation[u] = sp.nan
+        else:
+            isolation[u] = nearest[i].max()
+        l_ratio[u] = l_sums[i] / counts[i]
+        silhouette[u] = silhouette_sums[i] / counts[i]
+    return isolation, l_ratio, silhouette
+
+def _smallest(values, n):
+    """ Return the ``n`` smallest entries of ``values`` (unordered).
+    """
+    if len(values) <= n:
+        return values
+    return sp.partition(values, n - 1)[:n]
+
+def _normalized_posterior_sums(log_post):
+    """ Return the sums of posteriors normalized over all units from a
+    table of unnormalized log posteriors (spikes x units).
     """
-    d = x.shape[1]
-    fac = (2*sp.pi) ** (-d/2.0)
-    y = cdist(x, sp.atleast_2d(mean), 'sqeuclidean') * -0.5
+    return _normalized_posteriors(log_post).sum(axis=0)
+
+def _normalized_posteriors(log_post):
+    """ Return posteriors normalized over all units from a table of
+    unnormalized log posteriors (spikes x units).
+    """
+    peak = log_post.max(axis=1)[:, sp.newaxis]
+    normalizer = sp.log(sp.exp(log_post - peak).sum(axis=1))[:, sp.newaxis]
+    return sp.exp(log_post - peak - normalizer)
+
+class QualityTracker(object):
+    """ Keeps refractory period violations and overlap false
+    positive/negative rates of a sorting up to date while units are
+    merged, split or extended during curation.
+
+    The tracker caches the sorted spike times and violation counts of
+    each unit, the squared distances of all spikes to all templates and
+    the pairwise posterior sums. An update only computes distances to
+    the templates of changed units (and of new spikes to all templates),
+    and pairwise sums of pairs that include a changed unit. The results
+    of :meth:`overlap` are the same as :func:`calculate_overlap_fp_fn`
+    with the cluster means as templates.
+
+    :param dict spike_times: Dictionary of spike times (Quantity 1D or
+        SpikeTrain), indexed by unit.
+    :param dict waveforms: Dictionary of prewhitened waveforms, indexed by
+        unit. Each entry is an array or list with one waveform per spike
+        time, in the same order as the spike times.
+    :param refperiod: The refractory period (time).
+    :type refperiod: Quantity scalar
+    """
+
+    def __init__(self, spike_times, waveforms, refperiod):
+        self.refperiod = conversions.scalar(refperiod, pq.s)
+        self._times = {}
+        self._sorted = {}
+        self._violations = {}
+        self._waveforms = {}
+        self._templates = {}
+        self._sq_dist = {}
+        self._pairs = {}
+        self._overlap = None
+
+        for u in waveforms:
+            self._set_unit(u, conversions.magnitude(spike_times[u], pq.s),
+                           self._waveform_array(waveforms[u]), {})
+        self._update_likelihoods(self.units)
+
+    @property
+    def units(self):
+        """ A list of all units in the tracker.
+        """
+        return self._waveforms.keys()
+
+    def spike_counts(self):
+        """ Return a dictionary of spike counts indexed by unit.
+        """
+        return {u: len(t) for u, t in self._times.iteritems()}
+
+    def violations(self):
+        """ Return a dictionary of the number of refractory period
+        violations indexed by unit.
+        """
+        return dict(self._violations)
+
+    def overlap(self):
+        """ Return false positive and false negative rates like
+        :func:`calculate_overlap_fp_fn`.
+
+        :returns: Two values:
 
-    return fac * sp.exp(sp.longdouble(y))
+            * A dictionary (indexed by unit of total
+              (false positives, false negatives) tuples.
+            * A dictionary of dictionaries, both indexed by units,
+              of pairwise (false positives, false negatives) tuples.
+        :rtype: dict, dict
+        """
+        if self._overlap is not None:
+            return self._overlap
+
+        units = self.units
+        counts = sp.array([len(self._times[u]) for u in units],
+                          dtype=sp.float64)
+        log_counts = sp.log(counts)
+        posterior_sums = sp.zeros((len(units), len(units)))
+        for i, u in enumerate(units):
+            sq_dist = sp.column_stack([self._sq_dist[u][v] for v in units])
+            posterior_sums[i] = _normalized_posterior_sums(
+                sq_dist * -0.5 + log_counts)
+
+        off_diagonal = posterior_sums * (1 - sp.eye(len(units)))
+        false_positive = off_diagonal.sum(axis=1) / counts
+        false_negative = off_diagonal.sum(axis=0) / counts
+        totals = {}
+        singles = {}
+        for i, u in enumerate(units):
+            totals[u] = (false_positive[i], false_negative[i])
+            singles[u] = {v: (self._pairs[u][v] / counts[i],
+                              self._pairs[v][u] / counts[i])
+                          for v in units if v != u}
+
+        self._overlap = totals, singles
+        return self._overlap
+
+    def metrics(self):
+        """ Return the current quality metrics.
+
+        :returns: Three values: the dictionary of
+            :meth:`violations` and the two dictionaries of
+            :meth:`overlap`.
+        """
+        totals, singles = self.overlap()
+        return self.violations(), totals, singles
+
+    def add_spikes(self, unit, spike_times, waveforms):
+        """ Add spikes to a unit. If the unit does not exist yet, it is
+        created.
+
+        :param unit: The unit.
+        :param spike_times: The times of the new spikes.
+        :type spike_times: Quantity 1D
+        :param waveforms: The prewhitened waveforms of the new spikes.
+        :returns: The updated :meth:`metrics`.
+        """
+        times = conversions.magnitude(spike_times, pq.s)
+        if not len(times):
+            return self.metrics()
+        waveforms = self._waveform_array(waveforms)
+
+        others = [u for u in self.units if u != unit]
+        sq_dist = {}
+        if others:
+            new_dist = cdist(waveforms, sp.array(
+                [self._templates[u] for u in others]), 'sqeuclidean')
+            sq_dist = dict(zip(others, new_dist.T))
+
+        if unit in self._waveforms:
+            old_dist = self._sq_dist[unit]
+            sq_dist = {u: sp.concatenate((old_dist[u], sq_dist[u]))
+                       for u in others}
+            sorted_times = sp.sort(times)
+            sorted_times = sp.insert(self._sorted[unit], sp.searchsorted(
+                self._sorted[unit], sorted_times), sorted_times)
+            times = sp.concatenate((self._times[unit], times))
+            waveforms = sp.vstack((self._waveforms[unit], waveforms))
+            self._set_unit(unit, times, waveforms, sq_dist, sorted_times)
+        else:
+            self._set_unit(unit, times, waveforms, sq_dist)
+
+        self._update_likelihoods([unit])
+        return self.metrics()
+
+    def merge(self, unit1, unit2):
+        """ Merge the spikes of ``unit2`` into ``unit1``. ``unit2`` is
+        removed.
+
+        :returns: The updated :meth:`metrics`.
+        :raises ValueError: If a unit does not exist or both units are
+            the same.
+        """
+        if unit1 == unit2:
+            raise ValueError('Cannot merge a unit with itself!')
+        if unit1 not in self._waveforms or unit2 not in self._waveforms:
+            raise ValueError('Unknown unit for merge!')
+        others = [u for u in self.units if u not in (unit1, unit2)]
+        sq_dist = {u: sp.concatenate((self._sq_dist[unit1][u],
+                                      self._sq_dist[unit2][u]))
+                   for u in others}
+        sorted2 = self._sorted[unit2]
+        sorted_times = sp.insert(self._sorted[unit1], sp.searchsorted(
+            self._sorted[unit1], sorted2), sorted2)
+        times = sp.concatenate((self._times[unit1], self._times[unit2]))
+        waveforms = sp.vstack((self._waveforms[unit1],
+                               self._waveforms[unit2]))
+
+        self._remove_unit(unit2)
+        self._set_unit(unit1, times, waveforms, sq_dist, sorted_times)
+        self._update_likelihoods([unit1])
+        return self.metrics()
+
+    def split(self, unit, mask, new_unit):
+        """ Move some spikes of a unit to a new unit.
+
+        :param unit: The unit to split.
+        :param ndarray mask: A boolean array with one entry per spike
+            of ``unit`` (in the order the spikes were added). Spikes
+            where it is ``True`` are moved to ``new_unit``.
+        :param new_unit: The new unit. It must not exist yet.
+        :returns: The updated :meth:`metrics`.
+        :raises ValueError: If ``unit`` does not exist or ``new_unit``
+            already exists.
+        """
+        if unit not in self._waveforms:
+            raise ValueError('Unknown unit for split!')
+        if new_unit in self._waveforms:
+            raise ValueError('Unit for split already exists!')
+        mask = sp.asarray(mask, dtype=bool)
+        keep = ~mask
+        others = [u for u in self.units if u != unit]
+        sq_dist = self._sq_dist[unit]
+        times = self._times[unit]
+        waveforms = self._waveforms[unit]
+
+        self._remove_unit(unit)
+        self._set_unit(unit, times[keep], waveforms[keep],
+                       {u: sq_dist[u][keep] for u in others})
+        self._set_unit(new_unit, times[mask], waveforms[mask],
+                       {u: sq_dist[u][mask] for u in others})
+        self._update_likelihoods([unit, new_unit])
+        return self.metrics()
+
+    @staticmethod
+    def _waveform_array(waveforms):
+        waveforms = sp.asarray(waveforms, dtype=sp.float64)
+        return waveforms.reshape(len(waveforms), -1)
+
+    def _set_unit(self, unit, times, waveforms, sq_dist, sorted_times=None):
+        """ Set spikes of a unit with cached distances to templates of
+        other units. Units without spikes are not stored.
+        """
+        if not len(times):
+            return
+        if sorted_times is None:
+            sorted_times = sp.sort(times)
+        self._times[unit] = times
+        self._sorted[unit] = sorted_times
+        self._violations[unit] = int(
+            (sp.diff(sorted_times) < self.refperiod).sum())
+        self._waveforms[unit] = waveforms
+        self._templates[unit] = waveforms.mean(axis=0)
+        self._sq_dist[unit] = sq_dist
+
+    def _remove_unit(self, unit):
+        for cache in (self._times, self._sorted, self._violations,
+                      self._waveforms, self._templates, self._sq_dist,
+                      self._pairs):
+            cache.pop(unit, None)
+        for cache in (self._sq_dist, self._pairs):
+            for row in cache.itervalues():
+                row.pop(unit, None)
+
+    def _update_likelihoods(self, changed):
+        """ Compute distances to the templates of changed units and
+        pairwise sums for all pairs including a changed unit.
+        """
+        units = self.units
+        changed = [u for u in changed if u in self._waveforms]
+        if changed:
+            means = sp.array([self._templates[u] for u in changed])
+            for u in units:
+                sq_dist = cdist(self._waveforms[u], means, 'sqeuclidean')
+                self._sq_dist[u].update(zip(changed, sq_dist.T))
+
+        for u in units:
+            self._pairs.setdefault(u, {})
+        for u in changed:
+            for v in units:
+                if v != u:
+                    self._pairs[u][v] = self._pair_sum(u, v)
+                    self._pairs[v][u] = self._pair_sum(v, u)
+        self._overlap = None
+
+    def _pair_sum(self, unit1, unit2):
+        """ Sum of posteriors of ``unit2`` normalized over both units for
+        the spikes of ``unit1``.
+        """
+        own = self._sq_dist[unit1][unit1] * -0.5 + \
+              sp.log(len(self._times[unit1]))
+        other = self._sq_dist[unit1][unit2] * -0.5 + \
+                sp.log(len(self._times[unit2]))
+        return sp.exp(other - sp.logaddexp(own, other)).sum()
+
+def noise_covariance(signal, spike_trains, snippet_length,
+                     chunk_size=100000):
+    """ Estimate the noise covariance of a signal from snippets that do not
+    contain spikes. The signal is cut into consecutive snippets of
+    ``snippet_length`` samples. Snippets closer than ``snippet_length``
+    samples to a spike are discarded. The signal is read in chunks, so
+    signals backed by memory-mapped arrays are never loaded completely.
+
+    Snippets are vectors of all samples and channels in the same order as
+    the flattened waveforms of :class:`neo.core.Spike` objects (samples x
+    channels, flattened row by row).
+
+    :param signal: The signal.
+    :type signal: AnalogSignal or AnalogSignalArray
+    :param sequence spike_trains: A list of SpikeTrain objects with all
+        spikes in the signal. A dictionary of SpikeTrain lists can also
+        be used.
+    :param int snippet_length: The number of samples in a snippet. This
+        should be the length of the spike waveforms that will be whitened.
+    :param int chunk_size: The maximum number of samples read from the
+        signal at once.
+    :returns: The covariance matrix (in squared units of the signal).
+    :rtype: ndarray
+    """
+    if isinstance(spike_trains, dict):
+        spike_trains = sum(spike_trains.values(), [])
+    rate = conversions.scalar(signal.sampling_rate, pq.Hz)
+    t_start = conversions.scalar(signal.t_start, pq.s)
+    samples = [sp.round_((conversions.magnitude(t, pq.s) - t_start) * rate)
+               for t in spike_trains]
+    samples = sp.concatenate(samples).astype(int) if samples else \
+        sp.zeros(0, dtype=int)
+
+    # Mark snippets intersecting the region around a spike
+    num_snippets = signal.shape[0] // snippet_length
+    first = (samples - 2 * snippet_length) // snippet_length + 1
+    last = -((-samples - snippet_length) // snippet_length)
+    marks = sp.zeros(num_snippets + 1, dtype=int)
+    sp.add.at(marks, sp.clip(first, 0, num_snippets), 1)
+    sp.add.at(marks, sp.clip(last, 0, num_snippets), -1)
+    spike_free = sp.cumsum(marks[:-1]) == 0
+
+    # Accumulate mean and scatter matrix of centered chunks
+    step = max(chunk_size // snippet_length, 1)
+    n = 0
+    mean = 0
+    scatter = 0
+    for start in xrange(0, num_snippets, step):
+        stop = min(start + step, num_snippets)
+        chunk = sp.asarray(
+            signal[start * snippet_length:stop * snippet_length],
+            dtype=sp.float64)
+        x = chunk.reshape(stop - start, -1)[spike_free[start:stop]]
+        n, mean, scatter = _merge_scatter(n, mean, scatter, x)
+
+    if n < 2:
+        raise ValueError('Not enough spike-free snippets in signal!')
+    return scatter / (n - 1)
+
+def _merge_scatter(n, mean, scatter, x):
+    """ Add the rows of ``x`` to the number of samples, mean and scatter
+    matrix of previous samples and return the updated values.
+    """
+    if not len(x):
+        return n, mean, scatter
+    chunk_mean = x.mean(axis=0)
+    centered = x - chunk_mean
+    delta = chunk_mean - mean
+    scatter = scatter + sp.dot(centered.T, centered) + \
+              sp.outer(delta, delta) * (n * len(x) / (n + len(x)))
+    mean = mean + delta * (len(x) / (n + len(x)))
+    return n + len(x), mean, scatter
+
+def whitening_factor(signal, spike_trains, snippet_length, key=None,
+                     chunk_size=100000):
+    """ Return the lower Cholesky factor of the noise covariance of a
+    signal, as used by :func:`whiten`. The factor is computed with
+    :func:`noise_covariance` and cached: later calls with the same
+    signal (or key) and snippet length return the cached factor without
+    reading the signal. The cache holds at most 64 MiB of factors and
+    drops the least recently used ones. It does not keep signals alive.
+
+    :param signal: The signal.
+    :type signal: AnalogSignal or AnalogSignalArray
+    :param sequence spike_trains: A list of SpikeTrain objects with all
+        spikes in the signal. A dictionary of SpikeTrain lists can also
+        be used.
+    :param int snippet_length: The number of samples in a snippet. This
+        should be the length of the spike waveforms that will be whitened.
+    :param key: A hashable object identifying the noise source, e.g.
+        the RecordingChannelGroup of the signal. Signals with the same key
+        share the cached factor. If this is ``None``, the factor is only
+        reused for the same signal object.
+    :param int chunk_size: The maximum number of samples read from the
+        signal at once.
+    :rtype: ndarray
+    """
+    if key is None:
+        cache_key = ('signal', id(signal), snippet_length)
+    else:
+        cache_key = ('key', key, snippet_length)
+    try:
+        ref, factor = _whitening_factors.get(cache_key)
+        # A signal key is only valid while the signal exists, its id
+        # can be reused by a new object afterwards.
+        if key is not None or ref() is signal:
+            return factor
+    except KeyError:
+        pass
+
+    factor = cholesky(noise_covariance(signal, spike_trains, snippet_length,
+                                       chunk_size), lower=True)
+    ref = weakref.ref(signal) if key is None else None
+    _whitening_factors.put(cache_key, (ref, factor))
+    return factor
+
+def clear_whitening_cache():
+    """ Remove all factors cached by :func:`whitening_factor`.
+    """
+    _whitening_factors.clear()
+
+def whiten(waveforms, factor, chunk_size=10000):
+    """ Return prewhitened waveforms for use with
+    :func:`calculate_overlap_fp_fn`. Whitening is done with one
+    triangular solve per chunk of waveforms.
+
+    :param waveforms: The waveforms to whiten, as array (waveforms x
+        samples x channels or waveforms x dimensions) or list of arrays.
+        Templates can be whitened the same way.
+    :param ndarray factor: The lower Cholesky factor of the noise
+        covariance, e.g. from :func:`whitening_factor`.
+    :param int chunk_size: The maximum number of waveforms whitened at
+        once.
+    :returns: The whitened waveforms (waveforms x dimensions).
+    :rtype: ndarray
+    """
+    num = len(waveforms)
+    ret = sp.empty((num, factor.shape[0]))
+    for start in xrange(0, num, chunk_size):
+        x = sp.asarray(waveforms[start:start + chunk_size],
+                       dtype=sp.float64)
+        x = x.reshape(len(x), -1)
+        ret[start:start + len(x)] = solve_triangular(
+            factor, x.T, lower=True).T
+    return ret
 
 if __name__ == '__main__':
     import matplotlib.pyplot as plt
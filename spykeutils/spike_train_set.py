@@ -0,0 +1,234 @@
+""" A compact container for many spike trains of many units.
+"""
+
+import scipy as sp
+import quantities as pq
+import neo
+
+import conversions
+
+
+class SpikeTrainSet(object):
+    """ Stores the spike times of all spike trains of multiple units in
+    one contiguous float array. It is an alternative to the dictionaries
+    of SpikeTrain lists used by most analysis functions: operations on
+    whole datasets become a few array operations instead of loops over
+    thousands of small SpikeTrain objects.
+    :func:`spykeutils.correlogram.correlogram`,
+    :func:`spykeutils.rate_estimation.psth`,
+    :func:`spykeutils.rate_estimation.spike_density_estimation` and
+    :func:`spykeutils.sorting_quality_assesment.get_refperiod_violations`
+    accept a :class:`SpikeTrainSet` wherever they take a dictionary of
+    SpikeTrain lists.
+
+    :param ndarray times: All spike times, stored train by train.
+    :param ndarray offsets: Start index of each spike train in ``times``
+        and the total number of spikes as last element (length is the
+        number of spike trains + 1).
+    :param ndarray unit_index: Index into ``units`` for each spike train.
+    :param ndarray t_start: Start time of each spike train.
+    :param ndarray t_stop: Stop time of each spike train.
+    :param sequence units: The units (or other indices) of the set. These
+        are used as dictionary indices in the results of analysis
+        functions.
+    :param Quantity time_unit: The unit of all times in the set.
+    :param bool is_sorted: Set this to ``True`` if the spike times in each
+        train are sorted.
+    """
+
+    def __init__(self, times, offsets, unit_index, t_start, t_stop, units,
+                 time_unit=pq.s, is_sorted=False):
+        self.times = sp.asarray(times, dtype=sp.float64)
+        self.offsets = sp.asarray(offsets, dtype=int)
+        self.unit_index = sp.asarray(unit_index, dtype=int)
+        self.t_start = sp.asarray(t_start, dtype=sp.float64)
+        self.t_stop = sp.asarray(t_stop, dtype=sp.float64)
+        self.units = list(units)
+        self.time_unit = time_unit
+        self.is_sorted = is_sorted
+        self._unit_index = None
+
+        if len(self.offsets) != len(self.unit_index) + 1 or \
+                self.offsets[-1] != len(self.times):
+            raise ValueError('Offsets do not match spike times and trains!')
+
+    @classmethod
+    def from_dict(cls, trains, time_unit=pq.s):
+        """ Create a set from a dictionary of SpikeTrain lists.
+
+        :param dict trains: A dictionary of SpikeTrain lists.
+        :param Quantity time_unit: The unit of the times in the new set.
+        :rtype: :class:`SpikeTrainSet`
+        """
+        units = []
+        arrays = []
+        unit_index = []
+        starts = []
+        stops = []
+        for u, tL in trains.iteritems():
+            units.append(u)
+            unit_index.extend([len(units) - 1] * len(tL))
+            arrays.extend(conversions.spike_times(tL, time_unit))
+            s, e = conversions.train_intervals(tL, time_unit)
+            starts.append(s)
+            stops.append(e)
+
+        offsets = sp.zeros(len(arrays) + 1, dtype=int)
+        offsets[1:] = sp.cumsum([len(a) for a in arrays])
+        if arrays:
+            times = sp.concatenate(arrays)
+        else:
+            times = sp.array([])
+        if starts:
+            starts = sp.concatenate(starts)
+            stops = sp.concatenate(stops)
+        return cls(times, offsets, unit_index, starts, stops, units,
+                   time_unit)
+
+    def to_dict(self):
+        """ Return a dictionary of SpikeTrain lists with the contents of
+        the set.
+
+        :rtype: dict
+        """
+        unit = self.time_unit
+        ret = {}
+        for i, u in enumerate(self.units):
+            ret[u] = [neo.SpikeTrain(self.train(r) * unit,
+                                     t_start=self.t_start[r] * unit,
+                                     t_stop=self.t_stop[r] * unit)
+                      for r in self.unit_trains(i)]
+        return ret
+
+    @property
+    def num_trains(self):
+        """ The number of spike trains in the set. """
+        return len(self.unit_index)
+
+    def __len__(self):
+        return len(self.unit_index)
+
+    def train(self, index):
+        """ Return the spike times of one spike train (a view into
+        :attr:`times`).
+
+        :param int index: The index of the spike train.
+        :rtype: ndarray
+        """
+        return self.times[self.offsets[index]:self.offsets[index + 1]]
+
+    def _by_unit(self):
+        """ Return the spike train indices sorted by unit, the spike times
+        sorted by unit and offsets of each unit into both arrays. They are
+        computed on first use, so each unit lookup is a slice.
+        """
+        if self._unit_index is None:
+            order = sp.argsort(self.unit_index, kind='mergesort')
+            train_offsets = sp.searchsorted(self.unit_index[order],
+                                            sp.arange(len(self.units) + 1))
+            counts = self.spike_counts()[order]
+            spike_offsets = sp.zeros(len(order) + 1, dtype=int)
+            spike_offsets[1:] = sp.cumsum(counts)
+            spikes = sp.arange(spike_offsets[-1]) + sp.repeat(
+                self.offsets[:-1][order] - spike_offsets[:-1], counts)
+            self._unit_index = (order, self.times[spikes], train_offsets,
+                                spike_offsets[train_offsets])
+        return self._unit_index
+
+    def unit_trains(self, index):
+        """ Return the indices of all spike trains of a unit.
+
+        :param int index: The index of the unit in :attr:`units`.
+        :rtype: ndarray
+        """
+        order, _, train_offsets, _ = self._by_unit()
+        return order[train_offsets[index]:train_offsets[index + 1]]
+
+    def spike_counts(self):
+        """ Return the number of spikes in each spike train.
+
+        :rtype: ndarray
+        """
+        return sp.diff(self.offsets)
+
+    def train_index(self):
+        """ Return the index of the spike train for each spike.
+
+        :rtype: ndarray
+        """
+        return sp.repeat(sp.arange(self.num_trains), self.spike_counts())
+
+    def unit_spikes(self, index):
+        """ Return the spike times of all spike trains of a unit in one
+        array. The array is a view of a cached array, so it should not be
+        modified in place.
+
+        :param int index: The index of the unit in :attr:`units`.
+        :rtype: ndarray
+        """
+        _, times, _, spike_offsets = self._by_unit()
+        return times[spike_offsets[index]:spike_offsets[index + 1]]
+
+    def shared_interval(self):
+        """ Return the maximum start time and the minimum stop time of
+        all spike trains in the set (as floats in :attr:`time_unit`).
+        """
+        if not self.num_trains:
+            return -sp.inf, sp.inf
+        return self.t_start.max(), self.t_stop.min()
+
+    def rescaled(self, time_unit):
+        """ Return the set with all times in a different unit. If the
+        unit is the same, the set itself is returned.
+
+        :param Quantity time_unit: The new time unit.
+        :rtype: :class:`SpikeTrainSet`
+        """
+        factor = conversions.conversion_factor(self.time_unit, time_unit)
+        if factor == 1.0:
+            return self
+        return SpikeTrainSet(self.times * factor, self.offsets,
+                             self.unit_index, self.t_start * factor,
+                             self.t_stop * factor, self.units, time_unit,
+                             self.is_sorted)
+
+    def sorted(self):
+        """ Return the set with spike times sorted within each spike
+        train. If the set is already sorted, it is returned itself.
+
+        :rtype: :class:`SpikeTrainSet`
+        """
+        if self.is_sorted:
+            return self
+
+        # Find trains that are not sorted, only these need to be sorted
+        decreasing = sp.diff(self.times) < 0
+        borders = self.offsets[1:-1] - 1
+        decreasing[borders[(borders >= 0) &
+                           (borders < len(decreasing))]] = False
+        times = self.times
+        if decreasing.any():
+            train_index = self.train_index()
+            unsorted = sp.unique(train_index[1:][decreasing])
+            spikes = sp.flatnonzero(sp.in1d(train_index, unsorted))
+            order = sp.lexsort((times[spikes], train_index[spikes]))
+            times = times.copy()
+            times[spikes] = times[spikes[order]]
+
+        return SpikeTrainSet(times, self.offsets, self.unit_index,
+                             self.t_start, self.t_stop, self.units,
+                             self.time_unit, True)
+
+
+def as_spike_train_set(trains, time_unit):
+    """ Return a :class:`SpikeTrainSet` for a dictionary of SpikeTrain
+    lists or an existing set, with all times in the given unit.
+
+    :param trains: A dictionary of SpikeTrain lists or a
+        :class:`SpikeTrainSet`.
+    :param Quantity time_unit: The time unit of the returned set.
+    :rtype: :class:`SpikeTrainSet`
+    """
+    if isinstance(trains, SpikeTrainSet):
+        return trains.rescaled(time_unit)
+    return SpikeTrainSet.from_dict(trains, time_unit)
@@ -0,0 +1,78 @@
+""" Timing of the analysis functions that convert quantities once at
+function entry. Not part of the test suite. Run as::
+
+    python spykeutils/tests/benchmark_conversions.py [path]
+
+spykeutils is imported from ``path`` (e.g. a checkout of an older
+version for comparison) or from the checkout containing this script.
+"""
+
+import os
+import sys
+import time
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.path.insert(0, sys.argv[1])
+    else:
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                        os.pardir, os.pardir))
+
+import scipy as sp
+import quantities as pq
+import neo
+
+import spykeutils
+import spykeutils.correlogram as cg
+import spykeutils.rate_estimation as re
+import spykeutils.sorting_quality_assesment as qa
+
+
+def make_trains(num_units=3, num_trials=20, num_spikes=200, seed=1):
+    """ Return a dictionary of SpikeTrain lists with uniformly distributed
+    spikes in 10 second trials.
+    """
+    rng = sp.random.RandomState(seed)
+    trains = {}
+    for u in xrange(num_units):
+        unit = neo.Unit(name='Unit %d' % u)
+        trains[unit] = [
+            neo.SpikeTrain(sp.sort(rng.rand(num_spikes)) * 10 * pq.s,
+                           10 * pq.s)
+            for _ in xrange(num_trials)]
+    return trains
+
+
+def timed(function, *args, **kwargs):
+    """ Return the best wall time of three calls in seconds. """
+    best = sp.inf
+    for _ in xrange(3):
+        start = time.time()
+        function(*args, **kwargs)
+        best = min(best, time.time() - start)
+    return best
+
+
+def main():
+    trains = make_trains()
+    train = trains.values()[0][0]
+    steps = sp.linspace(10, 1000, 20) * pq.ms
+
+    results = [
+        ('correlogram', timed(cg.correlogram, trains, 1 * pq.ms,
+                              100 * pq.ms, False)),
+        ('psth', timed(re.psth, trains, 100 * pq.ms)),
+        ('spike_density_estimation',
+         timed(re.spike_density_estimation, trains)),
+        ('optimal_gauss_kernel_size',
+         timed(re.optimal_gauss_kernel_size, train, steps)),
+        ('get_refperiod_violations',
+         timed(qa.get_refperiod_violations, trains, 2 * pq.ms))]
+
+    print 'spykeutils from %s' % spykeutils.__file__
+    for name, t in results:
+        print '%-28s %8.1f ms' % (name, t * 1000)
+
+
+if __name__ == '__main__':
+    main()
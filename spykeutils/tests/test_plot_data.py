@@ -0,0 +1,99 @@
+try:
+    import unittest2 as ut
+except ImportError:
+    import unittest as ut
+
+import scipy as sp
+import quantities as pq
+import neo
+from spykeutils.plot_data import (MinMaxPyramid, stack_waveforms,
+                                  nan_separated)
+
+class RecordingArray(object):
+    """ Array wrapper that records all indices used to read from it. """
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+        self.reads = []
+
+    def __getitem__(self, key):
+        self.reads.append(key)
+        return self.data[key]
+
+class TestMinMaxPyramid(ut.TestCase):
+    def setUp(self):
+        rng = sp.random.RandomState(0)
+        self.data = rng.randn(100003, 3)
+        self.data[54321, 1] = 40
+
+    def test_build_reads_row_chunks(self):
+        samples = RecordingArray(self.data)
+        p = MinMaxPyramid(samples, chunk_size=30000)
+        self.assertEqual(len(samples.reads), 11)
+        for key in samples.reads:
+            self.assertTrue(isinstance(key, slice))
+        self.assertTrue(sp.all(p.minimum() == self.data.min(axis=0)))
+        self.assertTrue(sp.all(p.maximum() == self.data.max(axis=0)))
+
+    def test_envelope(self):
+        p = MinMaxPyramid(self.data)
+        for start, stop in ((0, 100003), (50000, 60000), (54000, 54800)):
+            x, y = p.envelope(1, start, stop, 500)
+            self.assertTrue(len(x) <= 1000)
+            self.assertEqual(y.max(), self.data[start:stop, 1].max())
+            self.assertEqual(y.min(), self.data[start:stop, 1].min())
+            self.assertTrue(sp.all((x >= start) & (x < stop)))
+
+        x, y = p.envelope(2, 100, 300, 500)
+        self.assertTrue(sp.all(x == sp.arange(100, 300)))
+        self.assertTrue(sp.all(y == self.data[100:300, 2]))
+        self.assertEqual(len(p.envelope(0, 200, 100, 500)[0]), 0)
+
+    def test_windows(self):
+        samples = RecordingArray(self.data)
+        p = MinMaxPyramid(samples, prefetch=0.5, window_bytes=2 * 8 * 2000)
+        samples.reads = []
+        self.assertTrue(sp.all(p.read(0, 1000, 2000) ==
+                               self.data[1000:2000, 0]))
+        self.assertEqual(samples.reads, [(slice(500, 2500), 0)])
+        p.read(0, 1200, 2200) # Within prefetch margin
+        self.assertEqual(len(samples.reads), 1)
+        p.read(1, 1000, 2000)
+        p.read(2, 1000, 2000) # Drops least recently used window
+        self.assertEqual(sorted(p._windows), [1, 2])
+        self.assertTrue(p._cached_bytes <= p.window_bytes)
+
+class TestWaveforms(ut.TestCase):
+    def setUp(self):
+        self.spikes = [
+            neo.Spike(1 * pq.s, waveform=sp.array([[1, 2], [3, 4],
+                [5, 6]]) * pq.mV, sampling_rate=1 * pq.kHz,
+                left_sweep=1 * pq.ms),
+            neo.Spike(2 * pq.s, waveform=sp.array([[7, 8]]) * pq.uV,
+                sampling_rate=2 * pq.kHz)]
+
+    def test_stack_waveforms(self):
+        starts, steps, waveforms = stack_waveforms(self.spikes, pq.ms, 1,
+                                                   pq.mV)
+        self.assertTrue(sp.allclose(starts, [999, 2000]))
+        self.assertTrue(sp.allclose(steps, [1, 0.5]))
+        self.assertEqual(waveforms.shape, (2, 3))
+        self.assertTrue(sp.allclose(waveforms[0], [2, 4, 6]))
+        self.assertAlmostEqual(waveforms[1, 0], 0.008)
+        self.assertTrue(sp.isnan(waveforms[1, 1:]).all())
+
+    def test_nan_separated(self):
+        starts, steps, waveforms = stack_waveforms(self.spikes, pq.ms, 0,
+                                                   pq.mV)
+        x, y = nan_separated(starts, steps, waveforms)
+        self.assertEqual(len(x), 8)
+        self.assertTrue(sp.isnan(x[[3, 7]]).all())
+        self.assertTrue(sp.isnan(y[[3, 6, 7]]).all())
+        self.assertTrue(sp.allclose(x[:3], [999, 1000, 1001]))
+        self.assertTrue(sp.allclose(x[4:7], [2000, 2000.5, 2001]))
+        self.assertTrue(sp.allclose(y[:3], [1, 3, 5]))
+        self.assertAlmostEqual(y[4], 0.007)
+        self.assertTrue(sp.isnan(y[5]))
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,146 @@
+try:
+    import unittest2 as ut
+except ImportError:
+    import unittest as ut
+
+import json
+import multiprocessing
+
+from spykeutils.progress_indicator import (ProgressIndicator,
+    ThrottledProgressIndicator, InstrumentedProgressIndicator,
+    ProgressProxy, CancelException)
+
+
+class RecordingIndicator(ProgressIndicator):
+    def __init__(self):
+        self.calls = []
+
+    def set_ticks(self, ticks):
+        self.calls.append(('ticks', ticks))
+
+    def step(self, num_steps=1):
+        self.calls.append(('step', num_steps))
+
+    def set_status(self, new_status):
+        self.calls.append(('status', new_status))
+
+    def done(self):
+        self.calls.append(('done',))
+
+
+class CancellingIndicator(ProgressIndicator):
+    def step(self, num_steps=1):
+        raise CancelException()
+
+
+def _step_worker(progress, steps):
+    for _ in xrange(steps):
+        progress.step()
+
+
+def _endless_worker(progress, cancelled):
+    try:
+        while True:
+            progress.step()
+    except CancelException:
+        with cancelled.get_lock():
+            cancelled.value += 1
+
+
+class TestThrottledProgressIndicator(ut.TestCase):
+    def test_min_steps(self):
+        inner = RecordingIndicator()
+        progress = ThrottledProgressIndicator(inner, min_steps=10,
+                                              interval=1e6)
+        progress.set_ticks(25)
+        for _ in xrange(25):
+            progress.step()
+        progress.done()
+        self.assertEqual(inner.calls, [('ticks', 25), ('step', 10),
+            ('step', 10), ('step', 5), ('done',)])
+
+    def test_status_flushes(self):
+        inner = RecordingIndicator()
+        progress = ThrottledProgressIndicator(inner, interval=1e6)
+        progress.step(3)
+        progress.set_status('Next')
+        progress.step(2)
+        self.assertEqual(inner.calls, [('step', 3), ('status', 'Next')])
+
+    def test_interval(self):
+        inner = RecordingIndicator()
+        progress = ThrottledProgressIndicator(inner, interval=0)
+        progress.step(2)
+        self.assertEqual(inner.calls, [('step', 2)])
+
+
+class TestInstrumentedProgressIndicator(ut.TestCase):
+    def test_report(self):
+        inner = RecordingIndicator()
+        progress = InstrumentedProgressIndicator(inner)
+        progress.begin('Test')
+        progress.set_ticks(10)
+        progress.set_status('First')
+        progress.step(4)
+        progress.set_status('Second')
+        progress.step(2)
+        self.assertTrue(progress.eta() is None or progress.eta() >= 0)
+        progress.done()
+
+        report = progress.report()
+        self.assertEqual(report['title'], 'Test')
+        self.assertEqual(report['steps'], 6)
+        self.assertEqual(report['ticks'], 10)
+        self.assertEqual([p['status'] for p in report['phases']],
+                         ['Test', 'First', 'Second'])
+        self.assertEqual([p['steps'] for p in report['phases']], [0, 4, 2])
+        self.assertAlmostEqual(sum(p['time'] for p in report['phases']),
+                               report['time'])
+        self.assertTrue(report['peak_rss'] > 0)
+        self.assertEqual(json.loads(progress.report_json()), report)
+        self.assertEqual(inner.calls[-1], ('done',))
+
+    def test_eta_after_new_ticks(self):
+        progress = InstrumentedProgressIndicator()
+        progress.steps_per_second = lambda: 2.0
+        progress.begin('Test')
+        progress.set_ticks(10)
+        progress.step(10)
+        self.assertEqual(progress.eta(), 0)
+        progress.set_ticks(5)
+        progress.step(1)
+        self.assertEqual(progress.eta(), 2.0)
+        self.assertEqual(progress.steps, 11)
+
+
+class TestProgressProxy(ut.TestCase):
+    def test_steps_from_workers(self):
+        inner = RecordingIndicator()
+        with ProgressProxy(inner, interval=1) as proxy:
+            workers = [multiprocessing.Process(target=_step_worker,
+                                               args=(proxy.worker(), 100))
+                       for _ in xrange(3)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+        self.assertEqual(sum(c[1] for c in inner.calls), 300)
+
+    def test_cancel_stops_workers(self):
+        cancelled = multiprocessing.Value('i', 0)
+        proxy = ProgressProxy(CancellingIndicator(), interval=1)
+        proxy.start()
+        workers = [multiprocessing.Process(target=_endless_worker,
+                                           args=(proxy.worker(), cancelled))
+                   for _ in xrange(2)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join(10)
+        self.assertFalse(any(w.is_alive() for w in workers))
+        self.assertEqual(cancelled.value, 2)
+        self.assertRaises(CancelException, proxy.stop)
+
+
+if __name__ == '__main__':
+    ut.main()
@@ -3,8 +3,11 @@ try:
 except ImportError:
     import unittest as ut
 
+import weakref
 
 import scipy as sp
+import scipy.linalg
+from scipy.stats import chi2
 import quantities as pq
 import neo
 from neo.test.tools import assert_arrays_equal
@@ -25,11 +28,298 @@ class TestQualityAssessment(ut.TestCase):
         assert_arrays_equal(r2[1][0], neo.SpikeTrain(sp.array([18])*pq.s,20*pq.s))
         assert_arrays_equal(r2[1][1], neo.SpikeTrain(sp.array([])*pq.s,10800*pq.ms))
 
+    def test_refperiod_violation_indices(self):
+        t1 = sp.array([0, 5, 10, 12, 17, 18])
+        t2 = sp.array([20000, 18000, 14000, 9000, 0, 5000])
+        st1 = neo.SpikeTrain(t1*pq.s,20*pq.s)
+        st2 = neo.SpikeTrain(t2*pq.ms,20*pq.s)
+        n, per_unit, s, indices, bounds = qa.get_refperiod_violation_indices(
+            {0: [st1], 1: [st2, st1]}, 3.0*pq.s)
+
+        self.assertEqual(n, 5)
+        self.assertEqual(per_unit[0], 2)
+        self.assertEqual(per_unit[1], 3)
+        self.assertEqual(len(bounds), 4)
+        for r in xrange(3):
+            v = s.times[indices[bounds[r]:bounds[r+1]]]
+            if s.unit_index[r] == 0 or len(v) == 2:
+                assert_arrays_equal(v, sp.array([10.0, 17.0]))
+            else:
+                assert_arrays_equal(v, sp.array([18.0]))
+
     def test_refperiod_fp(self):
         r = qa.calculate_refperiod_fp({1:100, 2:100, 3:100}, 2*pq.ms, {1:19, 2:100, 3:200}, 100*pq.ms)
         self.assertAlmostEqual(r[1], 0.05)
         self.assertAlmostEqual(r[2], 0.5)
         self.assertAlmostEqual(r[3], 1.0)
 
+    def test_refperiod_fp_arrays(self):
+        num_spikes = sp.array([[100, 100, 100], [0, 100, 200]])
+        violations = sp.array([[19, 100, 200], [5, 0, 76]])
+        r = qa.calculate_refperiod_fp(num_spikes, 2*pq.ms, violations,
+            sp.array([100, 100, 100])*pq.ms)
+        self.assertEqual(r.shape, (2, 3))
+        self.assertTrue(sp.allclose(r, [[0.05, 0.5, 1.0], [0, 0, 0.05]]))
+
+    def test_refperiod_violation_curve(self):
+        t1 = sp.array([0, 5, 10, 12, 17, 18])
+        t2 = sp.array([20000, 18000, 14000, 9000, 0, 5000])
+        st1 = neo.SpikeTrain(t1*pq.s,20*pq.s)
+        st2 = neo.SpikeTrain(t2*pq.ms,20*pq.s)
+        trains = {0: [st1], 1: [st2, st1]}
+        refperiods = sp.array([0.5, 1.5, 3.0, 4.5, 6.0]) * pq.s
+        counts, fp = qa.refperiod_violation_curve(trains, refperiods,
+            20*pq.s)
+
+        for i, r in enumerate(refperiods):
+            n, v = qa.get_refperiod_violations(trains, r)
+            for u in trains:
+                self.assertEqual(counts[u][i], sum(len(x) for x in v[u]))
+                num = sum(len(x) for x in trains[u])
+                expected = qa.calculate_refperiod_fp({u: num}, r,
+                    {u: counts[u][i]}, 20*pq.s)[u]
+                self.assertAlmostEqual(fp[u][i], expected)
+
+    def test_overlap_fp_fn(self):
+        templates = {1: sp.array([0.0, 0.0]), 2: sp.array([2.0, 0.0])}
+        spikes = {1: [sp.array([0.0, 0.0])], 2: [sp.array([2.0, 0.0])]}
+        totals, singles = qa.calculate_overlap_fp_fn(templates, spikes)
+        r = 1 / (1 + sp.exp(2))
+        for u in (1, 2):
+            self.assertAlmostEqual(totals[u][0], r)
+            self.assertAlmostEqual(totals[u][1], r)
+        self.assertAlmostEqual(singles[1][2][0], r)
+        self.assertAlmostEqual(singles[2][1][1], r)
+
+    def test_overlap_fp_fn_distant_spikes(self):
+        templates = {1: sp.array([0.0]), 2: sp.array([2.0]),
+                     3: sp.array([5.0])}
+        spikes = {1: [sp.array([100.0])], 2: [sp.array([100.0])], 3: []}
+        totals, singles = qa.calculate_overlap_fp_fn(templates, spikes)
+        self.assertAlmostEqual(totals[1][0], 1.0)
+        self.assertAlmostEqual(totals[2][0], 0.0)
+        self.assertEqual(totals[3], (0, 0))
+        self.assertNotIn(3, singles)
+
+    def test_overlap_fp_fn_chunked(self):
+        sp.random.seed(2)
+        templates = {}
+        spikes = {}
+        for u, n in enumerate([40, 25, 70]):
+            templates[u] = sp.random.randn(4)
+            spikes[u] = sp.random.randn(n, 4) + templates[u]
+        totals, singles = qa.calculate_overlap_fp_fn(templates, spikes)
+        ctotals, csingles = qa.calculate_overlap_fp_fn(
+            templates, spikes, chunk_size=16)
+        for u in templates:
+            self.assertTrue(sp.allclose(totals[u], ctotals[u]))
+            for u2 in singles[u]:
+                self.assertTrue(sp.allclose(singles[u][u2], csingles[u][u2]))
+
+    def test_overlap_fp_fn_parallel(self):
+        sp.random.seed(3)
+        templates = {}
+        spikes = {}
+        for u, n in enumerate([40, 25, 70, 10]):
+            templates[u] = sp.random.randn(4)
+            spikes[u] = sp.random.randn(n, 4) + templates[u]
+        totals, singles = qa.calculate_overlap_fp_fn(templates, spikes,
+            chunk_size=8)
+        ptotals, psingles = qa.calculate_overlap_fp_fn(templates, spikes,
+            chunk_size=8, n_jobs=3)
+        self.assertEqual(totals, ptotals)
+        self.assertEqual(singles, psingles)
+
+    def test_overlap_fp_fn_max_distance(self):
+        sp.random.seed(4)
+        templates = {}
+        spikes = {}
+        for u in xrange(6):
+            templates[u] = sp.zeros(3)
+            templates[u][0] = 3 * u + 12 * (u // 3)
+            spikes[u] = sp.random.randn(50, 3) + templates[u]
+        totals, singles = qa.calculate_overlap_fp_fn(templates, spikes)
+        ntotals, nsingles = qa.calculate_overlap_fp_fn(
+            templates, spikes, max_distance=10)
+        bounds = qa.calculate_overlap_truncation_bound(templates, spikes, 10)
+        cbounds = qa.calculate_overlap_truncation_bound(templates, spikes,
+            10, chunk_size=7)
+
+        self.assertEqual(set(nsingles[0]), set([1, 2]))
+        self.assertEqual(set(nsingles[3]), set([4, 5]))
+        for u in templates:
+            self.assertAlmostEqual(bounds[u], cbounds[u])
+            self.assertTrue(bounds[u] < 1e-3)
+            self.assertTrue(totals[u][0] - bounds[u] <= ntotals[u][0])
+            self.assertTrue(ntotals[u][0] <= totals[u][0])
+            for u2 in nsingles[u]:
+                self.assertTrue(sp.allclose(singles[u][u2], nsingles[u][u2]))
+
+    def test_noise_whitening(self):
+        sp.random.seed(5)
+        mixing = sp.array([[1.0, 0.0], [0.8, 0.5]])
+        data = sp.dot(sp.random.randn(200000, 2), mixing.T)
+        spike_times = sp.arange(100, 200000, 997)
+        for t in spike_times:
+            data[t:t + 5] += 50
+        signal = neo.AnalogSignalArray(data * pq.uV,
+            sampling_rate=10 * pq.kHz)
+        train = neo.SpikeTrain(spike_times / 10.0 * pq.ms, 20 * pq.s)
+
+        cov = qa.noise_covariance(signal, [train], 5, chunk_size=3000)
+        expected = sp.kron(sp.eye(5), sp.dot(mixing, mixing.T))
+        self.assertTrue(sp.absolute(cov - expected).max() < 0.05)
+
+        qa.clear_whitening_cache()
+        factor = qa.whitening_factor(signal, {0: [train]}, 5, key='group')
+        self.assertIs(qa.whitening_factor(None, None, 5, key='group'),
+                      factor)
+        noise = sp.dot(sp.random.randn(100000, 2), mixing.T)
+        white = qa.whiten(noise.reshape(-1, 5, 2), factor, chunk_size=777)
+        self.assertEqual(white.shape, (20000, 10))
+        self.assertTrue(
+            sp.absolute(sp.cov(white.T) - sp.eye(10)).max() < 0.05)
+
+        # Without a key, factors are only shared by the same signal
+        rcg = neo.RecordingChannelGroup()
+        signal.recordingchannelgroup = rcg
+        factor = qa.whitening_factor(signal, [train], 5)
+        self.assertIs(qa.whitening_factor(signal, [train], 5), factor)
+        other = neo.AnalogSignalArray(noise * 2 * pq.uV,
+            sampling_rate=10 * pq.kHz)
+        other.recordingchannelgroup = rcg
+        other_factor = qa.whitening_factor(other, [], 5)
+        self.assertTrue(
+            sp.absolute(other_factor - 2 * factor).max() < 0.1)
+
+        ref = weakref.ref(other)
+        del other
+        self.assertIsNone(ref())
+        qa.clear_whitening_cache()
+
+    def test_isolation_metrics(self):
+        sp.random.seed(6)
+        spikes = {0: sp.random.randn(300, 3),
+                  1: sp.random.randn(200, 3) * 2 + [4, 0, 0],
+                  2: sp.random.randn(3, 3)}
+        iso, l_ratio, sil = qa.calculate_isolation_metrics(spikes,
+            chunk_size=64)
+
+        def sq_dist(x, u):
+            inv = sp.linalg.inv(sp.cov(spikes[u].T))
+            dx = x - spikes[u].mean(axis=0)
+            return (sp.dot(dx, inv) * dx).sum(axis=1)
+
+        others = sp.vstack((spikes[0], spikes[2]))
+        d = sq_dist(others, 1)
+        self.assertAlmostEqual(iso[1], sp.sort(d)[199])
+        self.assertAlmostEqual(l_ratio[1],
+            chi2.sf(d, 3).sum() / 200)
+        a = sp.sqrt(sq_dist(spikes[0], 0))
+        b = sp.sqrt(sq_dist(spikes[0], 1))
+        self.assertAlmostEqual(sil[0], ((b - a) / sp.maximum(a, b)).mean())
+        self.assertTrue(sp.isnan(iso[0]))
+        self.assertFalse(sp.isnan(l_ratio[0]))
+        self.assertTrue(sp.isnan(sil[2]))
+
+    def test_isolation_metrics_dimensions(self):
+        self.assertEqual(qa.calculate_isolation_metrics({}), ({}, {}, {}))
+        spikes = {0: sp.random.randn(5, 3), 1: sp.random.randn(5, 2)}
+        self.assertRaises(ValueError, qa.calculate_isolation_metrics,
+                          spikes)
+
+    def _assert_tracker_matches(self, tracker, times, waveforms):
+        templates = {u: sp.mean(w, axis=0) for u, w in waveforms.iteritems()}
+        totals, singles = qa.calculate_overlap_fp_fn(templates, waveforms)
+        violations, ttotals, tsingles = tracker.metrics()
+        self.assertEqual(set(ttotals), set(totals))
+        for u in totals:
+            self.assertTrue(sp.allclose(totals[u], ttotals[u]))
+            self.assertEqual(set(singles[u]), set(tsingles[u]))
+            for u2 in singles[u]:
+                self.assertTrue(sp.allclose(singles[u][u2], tsingles[u][u2]))
+            n, v = qa.get_refperiod_violations(
+                {u: [neo.SpikeTrain(times[u], 100 * pq.s)]}, 2 * pq.ms)
+            self.assertEqual(violations[u], n)
+
+    def test_quality_tracker(self):
+        sp.random.seed(7)
+        times = {}
+        waveforms = {}
+        for u, n in enumerate([80, 60, 40]):
+            times[u] = sp.random.rand(n) * 100 * pq.s
+            waveforms[u] = sp.random.randn(n, 4) + 2 * u
+        tracker = qa.QualityTracker(times, waveforms, 2 * pq.ms)
+        self._assert_tracker_matches(tracker, times, waveforms)
+
+        tracker.merge(0, 1)
+        times[0] = sp.concatenate((times[0], times.pop(1))) * pq.s
+        waveforms[0] = sp.vstack((waveforms[0], waveforms.pop(1)))
+        self._assert_tracker_matches(tracker, times, waveforms)
+
+        mask = waveforms[0][:, 0] > 1
+        tracker.split(0, mask, 3)
+        times[3], times[0] = times[0][mask], times[0][~mask]
+        waveforms[3], waveforms[0] = waveforms[0][mask], waveforms[0][~mask]
+        self._assert_tracker_matches(tracker, times, waveforms)
+
+        new_times = sp.array([1.0, 1.001, 50.0]) * pq.s
+        new_waveforms = sp.random.randn(3, 4)
+        tracker.add_spikes(2, new_times, new_waveforms)
+        times[2] = sp.concatenate((times[2], new_times)) * pq.s
+        waveforms[2] = sp.vstack((waveforms[2], new_waveforms))
+        self._assert_tracker_matches(tracker, times, waveforms)
+        self.assertTrue(tracker.violations()[2] >= 1)
+
+    def test_quality_tracker_invalid_units(self):
+        sp.random.seed(9)
+        times = {0: sp.random.rand(20) * 10 * pq.s,
+                 1: sp.random.rand(30) * 10 * pq.s}
+        waveforms = {0: sp.random.randn(20, 3), 1: sp.random.randn(30, 3) + 1}
+        tracker = qa.QualityTracker(times, waveforms, 2 * pq.ms)
+
+        self.assertRaises(ValueError, tracker.merge, 0, 0)
+        self.assertRaises(ValueError, tracker.merge, 0, 5)
+        self.assertRaises(ValueError, tracker.merge, 5, 1)
+        self.assertRaises(ValueError, tracker.split, 5,
+                          sp.zeros(20, dtype=bool), 6)
+        self.assertRaises(ValueError, tracker.split, 0,
+                          sp.zeros(20, dtype=bool), 1)
+        self._assert_tracker_matches(tracker, times, waveforms)
+
+    def test_approximate_overlap_fp_fn(self):
+        sp.random.seed(8)
+        templates = {}
+        spikes = {}
+        for u, n in enumerate([3000, 2000, 50]):
+            templates[u] = sp.zeros(3)
+            templates[u][0] = 1.5 * u
+            spikes[u] = sp.random.randn(n, 3) + templates[u]
+        totals, singles = qa.calculate_overlap_fp_fn(templates, spikes)
+
+        atotals, asingles, intervals, sintervals = \
+            qa.approximate_overlap_fp_fn(templates, spikes, 5000)
+        for u in templates:
+            self.assertTrue(sp.allclose(totals[u], atotals[u]))
+            for i in (0, 1):
+                self.assertAlmostEqual(intervals[u][i][0], totals[u][i])
+                self.assertAlmostEqual(intervals[u][i][1], totals[u][i])
+
+        atotals, asingles, intervals, sintervals = \
+            qa.approximate_overlap_fp_fn(templates, spikes, 500,
+                confidence=0.999, random_state=1)
+        for u in templates:
+            for i in (0, 1):
+                self.assertTrue(intervals[u][i][0] - 1e-12 <= totals[u][i] <=
+                                intervals[u][i][1] + 1e-12)
+                if u < 2:
+                    self.assertTrue(
+                        intervals[u][i][1] - intervals[u][i][0] < 0.1)
+            for u2 in singles[u]:
+                for i in (0, 1):
+                    self.assertTrue(sintervals[u][u2][i][0] - 1e-12 <=
+                                    singles[u][u2][i] <=
+                                    sintervals[u][u2][i][1] + 1e-12)
+
 if __name__ == '__main__':
     ut.main()
\ No newline at end of file
@@ -0,0 +1,67 @@
+try:
+    import unittest2 as ut
+except ImportError:
+    import unittest as ut
+
+import scipy as sp
+import quantities as pq
+import neo
+import spykeutils.rate_estimation as re
+
+class TestRateEstimation(ut.TestCase):
+    def setUp(self):
+        sp.random.seed(123)
+        self.trains = []
+        for _ in xrange(5):
+            t = sp.sort(sp.random.rand(50)) * 10
+            self.trains.append(neo.SpikeTrain(t * pq.s, 10 * pq.s))
+
+    def test_optimal_hist_bin_size(self):
+        steps = sp.array([0.1, 0.25, 0.5, 1.0, 2.0]) * pq.s
+        best, cost = re.optimal_hist_bin_size(self.trains, steps)
+
+        x = sp.hstack([sp.asarray(t) for t in self.trains])
+        for i, s in enumerate(sp.asarray(steps)):
+            n = int(sp.floor(10 / s))
+            k = sp.histogram(x, sp.arange(n + 1) * s)[0]
+            c = (2 * k.mean() - k.var()) / (5 * s) ** 2
+            self.assertAlmostEqual(cost[i], c)
+        self.assertEqual(best, steps[sp.argmin(cost)])
+
+    def test_psth_bootstrap(self):
+        rates, bins = re.psth({0: self.trains}, 1 * pq.s)
+        ci1, b1 = re.psth_bootstrap_interval({0: self.trains}, 1 * pq.s,
+            bootstrap_samples=200, random_state=1, batch_size=64)
+        ci2, b2 = re.psth_bootstrap_interval({0: self.trains}, 1 * pq.s,
+            bootstrap_samples=200, random_state=1)
+
+        self.assertTrue(sp.all(b1 == bins))
+        self.assertTrue(sp.all(ci1[0][0] == ci2[0][0]))
+        self.assertTrue(sp.all(ci1[0][1] == ci2[0][1]))
+        self.assertTrue(sp.all(ci1[0][0] <= rates[0]))
+        self.assertTrue(sp.all(ci1[0][1] >= rates[0]))
+
+        ci3, _ = re.psth_bootstrap_interval({0: self.trains}, 1 * pq.s,
+            rate_correction=False, bootstrap_samples=200, random_state=1,
+            batch_size=64)
+        self.assertTrue(sp.allclose(ci3[0][0], ci1[0][0] * 5))
+        self.assertTrue(sp.allclose(ci3[0][1], ci1[0][1] * 5))
+
+    def test_sde_bootstrap(self):
+        points = sp.linspace(0, 10, 50) * pq.s
+        kde, sizes, _ = re.spike_density_estimation({0: self.trains},
+            evaluation_points=points, kernel_size=1 * pq.s)
+        ci = re.spike_density_bootstrap_interval({0: self.trains}, points,
+            kernel_size=sizes, bootstrap_samples=100, random_state=2)
+        ci2 = re.spike_density_bootstrap_interval({0: self.trains}, points,
+            kernel_size=1 * pq.s, bootstrap_samples=100, random_state=2)
+
+        self.assertTrue(sp.all(ci[0][0] <= ci[0][1]))
+        self.assertTrue(sp.all(ci[0][0] == ci2[0][0]))
+        self.assertEqual(ci[0][0].units, pq.Hz)
+        rate = sp.asarray(kde[0].rescale(pq.Hz))
+        self.assertTrue(sp.all(sp.asarray(ci[0][0]) <= rate + 1e-9))
+        self.assertTrue(sp.all(sp.asarray(ci[0][1]) >= rate - 1e-9))
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,155 @@
+try:
+    import unittest2 as ut
+except ImportError:
+    import unittest as ut
+
+import os
+import shutil
+import tempfile
+
+import scipy as sp
+import quantities as pq
+import neo
+import spykeutils.rate_estimation as re
+import spykeutils.result_cache as rc
+import spykeutils.sorting_quality_assesment as qa
+from spykeutils.correlogram import correlogram
+from spykeutils.progress_indicator import ProgressIndicator, CancelException
+
+class TestResultCache(ut.TestCase):
+    def setUp(self):
+        self.trains = {0: [neo.SpikeTrain(sp.array([1, 2, 3]) * pq.s,
+                                          5 * pq.s)]}
+
+    def tearDown(self):
+        rc.disable_memory_cache()
+        rc.disable_disk_cache()
+
+    def test_hits_and_misses(self):
+        cache = rc.enable_memory_cache()
+        r1, b1 = re.psth(self.trains, 1 * pq.s)
+        r2, b2 = re.psth(self.trains, 1 * pq.s)
+        r3, b3 = re.psth(self.trains, 500 * pq.ms)
+        stats = cache.statistics()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertTrue(sp.all(r1[0] == r2[0]))
+
+        # Returned results are copies
+        r2[0][0] = 100
+        r4, b4 = re.psth(self.trains, 1 * pq.s)
+        self.assertTrue(sp.all(r1[0] == r4[0]))
+
+    def test_content_changes_key(self):
+        cache = rc.enable_memory_cache()
+        re.psth(self.trains, 1 * pq.s)
+        other = {0: [neo.SpikeTrain(sp.array([1, 2, 4]) * pq.s, 5 * pq.s)]}
+        re.psth(other, 1 * pq.s)
+        self.assertEqual(cache.statistics()['hits'], 0)
+
+    def test_lru_eviction(self):
+        cache = rc.ResultCache(2500)
+        cache.put('a', sp.zeros(100))
+        cache.put('b', sp.zeros(100))
+        cache.get('a')
+        cache.put('c', sp.zeros(100))
+        self.assertRaises(KeyError, cache.get, 'b')
+        cache.get('a')
+        self.assertEqual(cache.statistics()['evictions'], 1)
+
+    def test_disk_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = rc.enable_disk_cache(directory)
+            u1, u2 = neo.Unit(name='a'), neo.Unit(name='b')
+            trains = {u1: self.trains[0], u2: self.trains[0]}
+            k1, s1, p1 = re.spike_density_estimation(trains,
+                kernel_size=1 * pq.s)
+
+            # New unit objects with the same names get the same results
+            v1, v2 = neo.Unit(name='a'), neo.Unit(name='b')
+            trains = {v1: self.trains[0], v2: self.trains[0]}
+            k2, s2, p2 = re.spike_density_estimation(trains,
+                kernel_size=1 * pq.s)
+
+            self.assertEqual(cache.statistics()['hits'], 1)
+            self.assertEqual(set(k2.keys()), set([v1, v2]))
+            self.assertTrue(sp.all(k1[u1] == k2[v1]))
+            self.assertEqual(k2[v1].units, pq.Hz)
+            self.assertEqual(s2[v2], 1 * pq.s)
+            self.assertTrue(sp.all(p1 == p2))
+        finally:
+            shutil.rmtree(directory)
+
+
+class CancelAfter(ProgressIndicator):
+    def __init__(self, steps):
+        self.steps = steps
+
+    def step(self, num_steps=1):
+        self.steps -= 1
+        if self.steps < 0:
+            raise CancelException()
+
+
+class TestCheckpoint(ut.TestCase):
+    def test_correlogram_resume(self):
+        sp.random.seed(9)
+        trains = {}
+        for name in 'abcd':
+            trains[neo.Unit(name=name)] = [neo.SpikeTrain(
+                sp.sort(sp.random.rand(50)) * 10 * pq.s, 10 * pq.s)]
+        expected, bins = correlogram(trains, 10 * pq.ms, 100 * pq.ms, True)
+
+        checkpoint = rc.Checkpoint()
+        self.assertRaises(CancelException, correlogram, trains, 10 * pq.ms,
+            100 * pq.ms, True, progress=CancelAfter(4), checkpoint=checkpoint)
+        self.assertEqual(len(checkpoint), 5)
+
+        # Only the remaining pairs are computed
+        cancel = CancelAfter(100)
+        result, bins = correlogram(trains, 10 * pq.ms, 100 * pq.ms, True,
+            progress=cancel, checkpoint=checkpoint)
+        self.assertEqual(cancel.steps, 90)
+        self.assertEqual(len(checkpoint), 0)
+        for u1 in expected:
+            for u2 in expected[u1]:
+                self.assertTrue(sp.all(expected[u1][u2] == result[u1][u2]))
+
+    def test_overlap_resume_from_file(self):
+        sp.random.seed(10)
+        templates = {}
+        spikes = {}
+        for u in xrange(4):
+            templates[u] = sp.random.randn(3)
+            spikes[u] = sp.random.randn(30, 3) + templates[u]
+        expected, singles = qa.calculate_overlap_fp_fn(templates, spikes)
+
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'overlap.checkpoint')
+            self.assertRaises(CancelException, qa.calculate_overlap_fp_fn,
+                templates, spikes, progress=CancelAfter(2),
+                checkpoint=rc.Checkpoint(filename))
+            checkpoint = rc.Checkpoint(filename)
+            self.assertEqual(len(checkpoint), 3)
+
+            # A checkpoint from different data is not used
+            other = dict(spikes)
+            other[0] = other[0] + 1
+            checkpoint.start(qa.calculate_overlap_fp_fn, {
+                'templates': templates, 'spikes': other,
+                'max_distance': None})
+            self.assertEqual(len(checkpoint), 0)
+
+            checkpoint = rc.Checkpoint(filename)
+            totals, singles = qa.calculate_overlap_fp_fn(templates, spikes,
+                checkpoint=checkpoint)
+            self.assertEqual(totals, expected)
+            self.assertFalse(os.path.exists(filename))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,35 @@
+try:
+    import unittest2 as ut
+except ImportError:
+    import unittest as ut
+
+import scipy as sp
+from spykeutils import sampling
+
+class TestSampling(ut.TestCase):
+    def test_random_state(self):
+        rng = sp.random.RandomState(1)
+        self.assertTrue(sampling.random_state(rng) is rng)
+        self.assertEqual(sampling.random_state(3).randint(1000),
+                         sp.random.RandomState(3).randint(1000))
+
+    def test_sample_indices(self):
+        rng = sp.random.RandomState(0)
+        for n, k in ((10**9, 1000), (100, 60), (5, 5), (5, 0)):
+            index = sampling.sample_indices(rng, n, k)
+            self.assertEqual(len(index), k)
+            self.assertEqual(len(sp.unique(index)), k)
+            self.assertTrue(sp.all(sp.diff(index) > 0))
+            self.assertTrue(sp.all((index >= 0) & (index < n)))
+        self.assertRaises(ValueError, sampling.sample_indices, rng, 3, 4)
+
+    def test_sample_indices_uniform(self):
+        rng = sp.random.RandomState(0)
+        counts = sp.zeros(20)
+        for _ in xrange(2000):
+            counts[sampling.sample_indices(rng, 20, 3)] += 1
+        # Expected 300 per index, standard deviation about 16
+        self.assertTrue(sp.all(abs(counts - 300) < 80))
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,78 @@
+try:
+    import unittest2 as ut
+except ImportError:
+    import unittest as ut
+
+import scipy as sp
+import quantities as pq
+import neo
+from neo.test.tools import assert_arrays_equal
+import spykeutils.rate_estimation as re
+import spykeutils.correlogram as cg
+import spykeutils.sorting_quality_assesment as qa
+from spykeutils.spike_train_set import SpikeTrainSet
+
+class TestSpikeTrainSet(ut.TestCase):
+    def setUp(self):
+        self.u1 = neo.Unit(name='a')
+        self.u2 = neo.Unit(name='b')
+        self.trains = {
+            self.u1: [neo.SpikeTrain(sp.array([3, 1, 2]) * pq.s, 4 * pq.s),
+                      neo.SpikeTrain(sp.array([500, 2500]) * pq.ms,
+                                     4 * pq.s)],
+            self.u2: [neo.SpikeTrain(sp.array([]) * pq.s, 4 * pq.s),
+                      neo.SpikeTrain(sp.array([0.5, 0.6]) * pq.s,
+                                     4 * pq.s, t_start=0.1 * pq.s)]}
+
+    def test_round_trip(self):
+        s = SpikeTrainSet.from_dict(self.trains, pq.ms)
+        self.assertEqual(s.num_trains, 4)
+        self.assertEqual(len(s.times), 7)
+        self.assertEqual(s.shared_interval(), (100.0, 4000.0))
+
+        d = s.sorted().to_dict()
+        self.assertEqual(set(d.keys()), set([self.u1, self.u2]))
+        assert_arrays_equal(d[self.u1][0],
+            sp.array([1000, 2000, 3000]) * pq.ms)
+        assert_arrays_equal(d[self.u2][1], sp.array([500, 600]) * pq.ms)
+        self.assertEqual(d[self.u2][1].t_start, 100 * pq.ms)
+
+    def test_unit_lookup(self):
+        s = SpikeTrainSet(sp.arange(9.0), [0, 2, 2, 5, 6, 9],
+                          [1, 0, 1, 2, 1], sp.zeros(5), sp.ones(5) * 10,
+                          ['a', 'b', 'c'])
+        for i in xrange(3):
+            assert_arrays_equal(s.unit_trains(i),
+                                sp.flatnonzero(s.unit_index == i))
+            spike_unit = sp.repeat(s.unit_index, s.spike_counts())
+            assert_arrays_equal(s.unit_spikes(i), s.times[spike_unit == i])
+        assert_arrays_equal(s.unit_spikes(1), sp.array([0, 1, 2, 3, 4, 6, 7, 8]))
+
+    def test_analysis_functions(self):
+        s = SpikeTrainSet.from_dict(self.trains, pq.s)
+
+        r1, b1 = re.psth(self.trains, 1 * pq.s)
+        r2, b2 = re.psth(s, 1 * pq.s)
+        assert_arrays_equal(b1, b2)
+        for u in self.trains:
+            assert_arrays_equal(r1[u], r2[u])
+
+        k1, _, _ = re.spike_density_estimation(self.trains,
+            kernel_size=200 * pq.ms)
+        k2, _, _ = re.spike_density_estimation(s, kernel_size=200 * pq.ms)
+        for u in self.trains:
+            self.assertTrue(sp.allclose(sp.asarray(k1[u]),
+                                        sp.asarray(k2[u])))
+
+        c1, _ = cg.correlogram(self.trains, 100 * pq.ms, 1 * pq.s, False)
+        c2, _ = cg.correlogram(s, 100 * pq.ms, 1 * pq.s, False)
+        assert_arrays_equal(c1[self.u1][self.u2], c2[self.u1][self.u2])
+
+        n1, v1 = qa.get_refperiod_violations(self.trains, 150 * pq.ms)
+        n2, v2 = qa.get_refperiod_violations(s, 150 * pq.ms)
+        self.assertEqual(n1, 1)
+        self.assertEqual(n2, 1)
+        assert_arrays_equal(v2[self.u2][1], sp.array([500]) * pq.ms)
+
+if __name__ == '__main__':
+    ut.main()